@@ -0,0 +1,11 @@
+import os
+import sys
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
+django.setup()
+
+from benchmarks.runner import main
+
+sys.exit(main())
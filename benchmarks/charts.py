@@ -0,0 +1,65 @@
+import pickle
+import time
+import numpy as np
+
+from caches.charts import decode_chart, encode_chart, load_chart
+
+# (days, points, step in ms) like CoinGecko's market_chart granularity
+CHART_RANGES = [
+    (1, 288, 5 * 60 * 1000),
+    (30, 720, 60 * 60 * 1000),
+    (365, 366, 24 * 60 * 60 * 1000),
+]
+
+def make_market_chart(points: int, step_ms: int, seed: int = 1) -> dict:
+    """
+    Random-walk market_chart in CoinGecko's shape.
+    """
+    rng = np.random.default_rng(seed)
+    timestamps = (1700000000000 + np.arange(points) * step_ms + rng.integers(0, 2000, points)).tolist()
+    prices = (30000 * np.exp(np.cumsum(rng.normal(0, 0.01, points)))).tolist()
+    return {
+        "prices": [[ts, price] for ts, price in zip(timestamps, prices)],
+        "market_caps": [[ts, price * 19e6] for ts, price in zip(timestamps, prices)],
+        "total_volumes": [[ts, price * 1e6 * rng.random()] for ts, price in zip(timestamps, prices)],
+    }
+
+def time_us(function, value, rounds: int) -> float:
+    """
+    Median time of one call in microseconds.
+    """
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        function(value)
+        timings.append(time.perf_counter() - start)
+    return round(float(np.median(timings)) * 1e6, 1)
+
+def benchmark_chart_codec(rounds: int = 200) -> dict:
+    """
+    Compares the chart format of caches.charts with the pickled lists
+    stored before: size, encode and decode time, and load_chart, which
+    decodes back to lists like the cache read path does.
+    """
+    results = {}
+    for days, points, step_ms in CHART_RANGES:
+        chart = make_market_chart(points, step_ms)
+        pickled = pickle.dumps(chart, pickle.HIGHEST_PROTOCOL)
+        encoded = encode_chart(chart)
+        results[f"{days}d ({points} points)"] = {
+            "pickle_bytes": len(pickled),
+            "pickle_encode_us": time_us(lambda value: pickle.dumps(value, pickle.HIGHEST_PROTOCOL), chart, rounds),
+            "pickle_decode_us": time_us(pickle.loads, pickled, rounds),
+            "columnar_bytes": len(encoded),
+            "encode_us": time_us(encode_chart, chart, rounds),
+            "decode_us": time_us(decode_chart, encoded, rounds),
+            "load_chart_us": time_us(load_chart, encoded, rounds),
+        }
+    return results
+
+def format_chart_report(results: dict) -> str:
+    columns = ["pickle_bytes", "pickle_encode_us", "pickle_decode_us", "columnar_bytes", "encode_us", "decode_us", "load_chart_us"]
+    lines = [f"{'chart':22} " + " ".join(f"{column:>16}" for column in columns)]
+    for name, result in results.items():
+        lines.append(f"{name:22} " + " ".join(f"{result[column]:>16}" for column in columns))
+    return "\n".join(lines)
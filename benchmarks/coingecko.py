@@ -0,0 +1,72 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Points CoinGecko returns per market_chart range (5min, hourly or daily data)
+CHART_POINTS = {"1": 288, "7": 168, "30": 720, "180": 180, "365": 366}
+DAY_MS = 24 * 60 * 60 * 1000
+
+class FakeCoinGeckoServer:
+    """
+    Local HTTP server answering the CoinGecko endpoints used by the tasks.
+    Queued (status, headers) responses are returned before the default
+    200 response; every request is recorded. With full_charts, market_chart
+    returns as many points as CoinGecko does for the range, otherwise one.
+    """
+    def __init__(self, full_charts: bool = False):
+        self.requests = []
+        self.responses = []
+        self.full_charts = full_charts
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = {key: values[0] for key, values in parse_qs(url.query).items()}
+                server.requests.append((url.path, params))
+
+                status_code, headers = server.responses.pop(0) if server.responses else (200, {})
+                body = json.dumps(server.get_body(url.path, params) if status_code == 200 else {"error": status_code})
+
+                self.send_response(status_code)
+                self.send_header("Content-Type", "application/json")
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body.encode())
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}/api/v3"
+
+    def get_chart(self, days: str) -> dict:
+        if not self.full_charts:
+            return {"prices": [[1700000000000, 100.0]], "market_caps": [[1700000000000, 1.0]], "total_volumes": [[1700000000000, 1.0]]}
+
+        points = CHART_POINTS.get(days, 100)
+        step = int(days) * DAY_MS // points
+        timestamps = [1700000000000 + index * step for index in range(points)]
+        return {
+            "prices": [[ts, 100.0 + index % 50] for index, ts in enumerate(timestamps)],
+            "market_caps": [[ts, 1e9 + index * 1e5] for index, ts in enumerate(timestamps)],
+            "total_volumes": [[ts, 1e7 + index * 1e3] for index, ts in enumerate(timestamps)],
+        }
+
+    def get_body(self, path, params):
+        parts = path.strip("/").split("/")[2:]
+        if parts == ["coins", "markets"]:
+            return [{"id": coin_id, "current_price": 100.0} for coin_id in params["ids"].split(",")]
+        if parts[-1] == "market_chart":
+            return self.get_chart(params.get("days", "1"))
+        return {"id": parts[1], "market_data": {"current_price": {"usd": 100.0}}}
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,118 @@
+import uuid
+from dataclasses import dataclass
+from typing import Callable
+from django.contrib.auth.tokens import default_token_generator
+from django.test import Client
+from django.urls import reverse
+from django.utils.encoding import force_bytes
+from django.utils.http import urlencode, urlsafe_base64_encode
+
+from benchmarks.seed import PASSWORD
+from users.models import ExpiringToken
+
+@dataclass
+class Route:
+    """
+    One benchmarked request. prepare(client) runs untimed before every
+    request and returns the keyword arguments of the request: path, data,
+    content_type and optionally the Client to send it with.
+    """
+    name: str
+    method: str
+    prepare: Callable
+    expected: tuple = (200,)
+    # needs a Celery broker and worker
+    tasks: bool = False
+
+class BenchmarkClient:
+    """
+    State of one concurrent client: an authenticated Django test client for
+    its user, plus a spare user for the routes that log in, log out or
+    change credentials, so they do not invalidate the main session.
+    """
+    def __init__(self, user, spare, coin):
+        self.user, self.spare, self.coin = user, spare, coin
+        self.client = self.login(user)
+        self.spare_client = Client(raise_request_exception=False)
+        self.job_id = None
+
+    def login(self, user):
+        client = Client(raise_request_exception=False)
+        client.cookies["auth_token"] = ExpiringToken.objects.get(user=user).key
+        return client
+
+    def spare_token(self):
+        token, _ = ExpiringToken.objects.get_or_create(user=self.spare)
+        self.spare_client.cookies["auth_token"] = token.key
+        return {"client": self.spare_client}
+
+    def spare_link(self):
+        self.spare.refresh_from_db()
+        return {"uid": urlsafe_base64_encode(force_bytes(self.spare.pk)), "token": default_token_generator.make_token(self.spare)}
+
+def get(name, *args, **params):
+    path = reverse(name, args=args)
+    return {"path": f"{path}?{urlencode(params)}" if params else path}
+
+def coin_name(client):
+    return client.coin.name.lower()
+
+def import_csv(client):
+    rows = "\n".join(f"{client.coin.slug},buy,0.01,100," for _ in range(5))
+    return {
+        "path": reverse("my-coin-transactions-import"),
+        "data": f"coin,transaction_type,amount,price_per_coin,created_at\n{rows}\n",
+        "content_type": "text/csv",
+    }
+
+def verify_email(client):
+    type(client.spare).objects.filter(pk=client.spare.pk).update(unconfirmed_email=f"verify-{uuid.uuid4().hex}@example.com")
+    return get("verify-email", **client.spare_link())
+
+def create_job(client):
+    if client.job_id is None:
+        response = client.client.post(f"{reverse('cache-single-coin', args=['data', client.coin.slug])}?async=true")
+        client.job_id = response.json()["job_id"]
+    return get("coin-cache-job", client.job_id)
+
+def post(name, data=None, *args, **params):
+    return {**get(name, *args, **params), "data": data or {}, "content_type": "application/json"}
+
+ROUTES = [
+    # reads
+    Route("coins", "GET", lambda c: get("coins")),
+    Route("me", "GET", lambda c: get("me")),
+    Route("my-wallet", "GET", lambda c: get("my-wallet")),
+    Route("my-wallet-transactions", "GET", lambda c: get("my-wallet-transactions", page_size=100)),
+    Route("my-wallet-transactions:coin", "GET", lambda c: get("my-wallet-transactions", "coin", page_size=100)),
+    Route("my-coin-transactions", "GET", lambda c: get("my-coin-transactions", page_size=100)),
+    Route("my-coin-transaction", "GET", lambda c: get("my-coin-transaction", coin_name(c), page_size=100)),
+    Route("my-coin-holdings", "GET", lambda c: get("my-coin-holdings")),
+    Route("my-coin-holding", "GET", lambda c: get("my-coin-holding", coin_name(c))),
+    Route("my-coin-portfolio", "GET", lambda c: get("my-coin-portfolio")),
+    Route("my-coin-portfolio-history", "GET", lambda c: get("my-coin-portfolio-history", days=30, max_points=300)),
+    Route("coin-cache", "GET", lambda c: get("coin-cache")),
+    Route("coin-chart", "GET", lambda c: get("coin-chart", c.coin.slug, days=30, max_points=300)),
+
+    # writes
+    Route("my-wallet-deposit", "POST", lambda c: post("my-wallet-deposit", {"amount": "10", "transaction_source": "fiat"})),
+    Route("my-wallet-withdraw", "POST", lambda c: post("my-wallet-withdraw", {"amount": "1", "transaction_source": "fiat"})),
+    Route("my-coin-trade", "POST", lambda c: post("my-coin-trade", {"transaction_type": "buy", "amount": "0.01", "price_per_coin": "100"}, coin_name(c)), (201,)),
+    Route("my-coin-transaction:post", "POST", lambda c: post("my-coin-transaction", {"transaction_type": "buy", "amount": "0.01", "price_per_coin": "100"}, coin_name(c)), (201,)),
+    Route("my-coin-transactions-import", "POST", import_csv, (201,)),
+    Route("me-update", "PATCH", lambda c: post("me-update", {"username": f"bench_{uuid.uuid4().hex[:12]}"})),
+
+    # auth, on the spare user
+    Route("login", "POST", lambda c: {**post("login", {"email": c.spare.email, "password": PASSWORD}), "client": c.spare_client}),
+    Route("logout", "POST", lambda c: {**post("logout"), **c.spare_token()}),
+    Route("register", "POST", lambda c: post("register", {"email": f"{uuid.uuid4().hex}@example.com", "username": uuid.uuid4().hex[:16], "password": PASSWORD}), (201,)),
+    Route("request-password-reset", "POST", lambda c: post("request-password-reset", {"email": c.spare.email})),
+    Route("confirm-password-reset", "POST", lambda c: post("confirm-password-reset", {**c.spare_link(), "new_password": PASSWORD})),
+    Route("verify-email", "GET", verify_email),
+
+    # coin cache refreshes, against the fake CoinGecko server
+    Route("coin-cache:post", "POST", lambda c: post("coin-cache"), tasks=True),
+    Route("cache-single-coin", "POST", lambda c: post("cache-single-coin", None, "chart", c.coin.slug, days=7), tasks=True),
+    Route("cache-single-coin:async", "POST", lambda c: post("cache-single-coin", None, "data", c.coin.slug, **{"async": "true"}), (202,), tasks=True),
+    Route("coin-cache-job", "GET", create_job, tasks=True),
+]
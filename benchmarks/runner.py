@@ -0,0 +1,300 @@
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import ExitStack
+from django.db import connection, connections
+from django.test.runner import DiscoverRunner
+from django.test.utils import CaptureQueriesContext, override_settings
+import numpy as np
+
+from benchmarks.charts import benchmark_chart_codec, format_chart_report
+from benchmarks.coingecko import FakeCoinGeckoServer
+from benchmarks.routes import ROUTES, BenchmarkClient
+from benchmarks.seed import seed, seed_users
+from benchmarks.servers import SERVER_ROUTES, format_server_report, run_asgi, run_wsgi
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baselines", "default.json")
+# queries per request are averages, cache hits make them vary slightly
+QUERY_SLACK = 0.5
+
+def send_request(route, state):
+    kwargs = route.prepare(state)
+    client = kwargs.pop("client", state.client)
+    return getattr(client, route.method.lower())(kwargs.pop("path"), **kwargs)
+
+def run_route(route, clients: list, requests: int) -> dict:
+    """
+    Sends requests to one route from all clients concurrently and returns
+    latency percentiles (ms), throughput (req/s) and queries per request.
+    Every client first sends one untimed request to warm up.
+    """
+    latencies, queries, failures = [], [], []
+    sent = iter(range(requests))
+    lock = threading.Lock()
+    ready = threading.Barrier(len(clients) + 1)
+
+    def worker(state):
+        try:
+            try:
+                send_request(route, state)
+            finally:
+                ready.wait()
+            while True:
+                with lock:
+                    if next(sent, None) is None:
+                        return
+                kwargs = route.prepare(state)
+                client = kwargs.pop("client", state.client)
+                send = getattr(client, route.method.lower())
+
+                with CaptureQueriesContext(connection) as captured:
+                    start = time.perf_counter()
+                    response = send(kwargs.pop("path"), **kwargs)
+                    elapsed = time.perf_counter() - start
+
+                with lock:
+                    latencies.append(elapsed * 1000)
+                    queries.append(len(captured))
+                    if response.status_code not in route.expected:
+                        failures.append(response.status_code)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=worker, args=(state,)) for state in clients]
+    for thread in threads:
+        thread.start()
+    ready.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    return {
+        **summarize(latencies, failures, wall),
+        "queries_per_request": round(float(np.mean(queries)), 2),
+    }
+
+def summarize(latencies: list, failures: list, wall: float) -> dict:
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        "requests": len(latencies),
+        "errors": len(failures),
+        "error_statuses": sorted(set(failures)),
+        "p50_ms": round(float(p50), 2),
+        "p95_ms": round(float(p95), 2),
+        "p99_ms": round(float(p99), 2),
+        "throughput_rps": round(len(latencies) / wall, 1),
+    }
+
+def compare_servers(routes: list, clients: list, levels: list, requests: int, threads: int, report=None) -> dict:
+    """
+    Runs every route under WSGI and ASGI with the same number of clients,
+    for each concurrency level. Results are keyed "route@clients".
+    report, if given, is called with the name and result of each run.
+    """
+    results = {}
+    for route in routes:
+        for level in levels:
+            name = f"{route.name}@{level}"
+            results[name] = {
+                "wsgi": summarize(*run_wsgi(route, clients[:level], requests, threads)),
+                "asgi": summarize(*run_asgi(route, clients[:level], requests)),
+            }
+            if report:
+                report(name, results[name])
+    return results
+
+def print_server_result(name: str, result: dict):
+    print(f"  {name}: wsgi {result['wsgi']['p50_ms']}ms, asgi {result['asgi']['p50_ms']}ms p50", flush=True)
+
+def compare(results: dict, baseline: dict, tolerance: float, min_delta_ms: float) -> list:
+    """
+    Returns the regressions of results against a baseline: more queries
+    per request, a median latency above the tolerance (relative, but at
+    least min_delta_ms, so tiny timings do not flap) or unexpected
+    responses. The tail percentiles are only reported: with concurrent
+    writers waiting on each other they vary too much between runs.
+    """
+    regressions = []
+    for name, base in baseline.items():
+        result = results.get(name)
+        if result is None:
+            continue
+        if result["queries_per_request"] > base["queries_per_request"] + QUERY_SLACK:
+            regressions.append(f"{name}: {result['queries_per_request']} queries/request (baseline {base['queries_per_request']})")
+        limit = max(base["p50_ms"] * (1 + tolerance), base["p50_ms"] + min_delta_ms)
+        if result["p50_ms"] > limit:
+            regressions.append(f"{name}: p50 {result['p50_ms']}ms (baseline {base['p50_ms']}ms, limit {limit:.2f}ms)")
+        if result["errors"]:
+            regressions.append(f"{name}: {result['errors']} unexpected responses {result['error_statuses']}")
+    return regressions
+
+def missing_baselines(results: dict, baseline: dict) -> list:
+    """
+    Measured routes without a baseline entry, which compare() cannot check.
+    """
+    return [name for name in results if name not in baseline]
+
+def format_report(results: dict) -> str:
+    lines = [f"{'route':34} {'req':>5} {'err':>4} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'req/s':>8} {'queries':>8}"]
+    for name, result in results.items():
+        lines.append(
+            f"{name:34} {result['requests']:>5} {result['errors']:>4} {result['p50_ms']:>8} {result['p95_ms']:>8} "
+            f"{result['p99_ms']:>8} {result['throughput_rps']:>8} {result['queries_per_request']:>8}"
+        )
+    return "\n".join(lines)
+
+def warm_coin_cache(coins):
+    """
+    Fills the coin and chart caches by running the refresh tasks in process.
+    """
+    from caches.tasks import cache_coin_chart, cache_coins_markets
+    from caches.utils import ALLOWED_DAYS
+
+    cache_coins_markets.apply(args=[[coin.slug for coin in coins]])
+    for coin in coins:
+        for days in ALLOWED_DAYS:
+            cache_coin_chart.apply(args=[coin.slug, str(days)])
+
+def benchmark(options) -> dict:
+    """
+    Seeds the test database, starts the fake CoinGecko server (and a Celery
+    worker unless disabled), then benchmarks every route in turn. With
+    --servers the server routes are compared under WSGI and ASGI instead.
+    """
+    from django.core.cache import cache
+    from config.celery import app
+
+    users, coins = seed(options.users, options.transactions, options.coins)
+    if options.servers:
+        # read-only routes, the clients can share users
+        clients = [
+            BenchmarkClient(users[index % len(users)], None, coins[index % len(coins)])
+            for index in range(max(options.server_concurrency))
+        ]
+    else:
+        spares = seed_users(options.concurrency, prefix="spare")
+        clients = [
+            BenchmarkClient(users[index % len(users)], spares[index], coins[index % len(coins)])
+            for index in range(options.concurrency)
+        ]
+    warm_coin_cache(coins)
+
+    routes = [route for route in (SERVER_ROUTES if options.servers else ROUTES) if options.tasks or not route.tasks]
+    if options.routes:
+        routes = [route for route in routes if route.name in options.routes]
+
+    with ExitStack() as stack:
+        if any(route.tasks for route in routes):
+            from celery.contrib.testing.worker import start_worker
+            stack.enter_context(start_worker(app, pool="threads", concurrency=4, perform_ping_check=False))
+        else:
+            # tasks dispatched by other routes (queued mail) run in process
+            app.conf.task_always_eager = True
+            stack.callback(setattr, app.conf, "task_always_eager", False)
+
+        if options.servers:
+            results = compare_servers(
+                routes, clients, options.server_concurrency, options.requests, options.wsgi_threads, report=print_server_result,
+            )
+        else:
+            results = {}
+            for route in routes:
+                results[route.name] = run_route(route, clients, options.requests)
+                print(f"  {route.name}: {results[route.name]['p50_ms']}ms p50", flush=True)
+
+    cache.delete_pattern("*")
+    return results
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Latency benchmark of the API routes.")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--transactions", type=int, default=200, help="Coin transactions per user.")
+    parser.add_argument("--coins", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent clients.")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per route.")
+    parser.add_argument("--route", dest="routes", action="append", help="Only benchmark this route (repeatable).")
+    parser.add_argument("--no-tasks", dest="tasks", action="store_false", help="Skip the routes that need a Celery worker.")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="Baseline to compare against.")
+    parser.add_argument("--save-baseline", action="store_true", help="Store the results as the new baseline.")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="Allowed relative p50 increase.")
+    parser.add_argument("--min-delta-ms", type=float, default=5.0, help="p50 increases below this never fail.")
+    parser.add_argument("--output", help="Also write the results as JSON to this file.")
+    parser.add_argument("--servers", action="store_true", help="Compare WSGI and ASGI under the same load instead.")
+    parser.add_argument(
+        "--server-concurrency", type=lambda value: [int(level) for level in value.split(",")], default=[8, 64, 256],
+        help="Concurrent clients of the server comparison, comma separated.",
+    )
+    parser.add_argument("--wsgi-threads", type=int, default=16, help="Threads of the WSGI server.")
+    parser.add_argument("--charts", action="store_true", help="Compare the chart cache format with pickle instead.")
+    return parser.parse_args(argv)
+
+def main(argv=None) -> int:
+    options = parse_args(argv)
+    if options.charts:
+        results = benchmark_chart_codec()
+        print(format_chart_report(results))
+        if options.output:
+            with open(options.output, "w") as file:
+                json.dump(results, file, indent=2)
+        return 0
+
+    runner = DiscoverRunner(verbosity=0, interactive=False)
+    runner.setup_test_environment()
+    # a throwaway database file, so concurrent clients do not share one
+    # in-memory connection and a run never touches the test database
+    db_file = None
+    if connection.vendor == "sqlite":
+        db_file = tempfile.NamedTemporaryFile(suffix=".sqlite3", delete=False).name
+        connections["default"].settings_dict["TEST"]["NAME"] = db_file
+    old_config = runner.setup_databases()
+
+    server = FakeCoinGeckoServer(full_charts=True).start()
+    overrides = override_settings(
+        COINGECKO_API_URL=server.url,
+        COINGECKO_API_KEY=None,
+        COINGECKO_RATE_LIMIT=600000,
+        COINGECKO_RATE_BURST=10000,
+        RATELIMIT_ENABLE=False,
+        # all clients share one IP
+        API_RATE_LIMITS={},
+    )
+    try:
+        with overrides:
+            results = benchmark(options)
+    finally:
+        server.stop()
+        runner.teardown_databases(old_config)
+        runner.teardown_test_environment()
+        if db_file and os.path.exists(db_file):
+            os.remove(db_file)
+
+    print(format_server_report(results) if options.servers else format_report(results))
+    if options.output:
+        with open(options.output, "w") as file:
+            json.dump(results, file, indent=2)
+    if options.servers:
+        return 0
+
+    if options.save_baseline:
+        os.makedirs(os.path.dirname(options.baseline), exist_ok=True)
+        with open(options.baseline, "w") as file:
+            json.dump(results, file, indent=2)
+        print(f"Baseline saved to {options.baseline}")
+        return 0
+
+    if not os.path.exists(options.baseline):
+        print(f"No baseline at {options.baseline}, run with --save-baseline first.")
+        return 0
+
+    with open(options.baseline) as file:
+        baseline = json.load(file)
+    for name in missing_baselines(results, baseline):
+        print(f"WARNING {name}: no baseline entry, not compared")
+    regressions = compare(results, baseline, options.tolerance, options.min_delta_ms)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
@@ -0,0 +1,71 @@
+from datetime import timedelta
+from decimal import Decimal
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.utils import timezone
+
+from coins.imports import import_transactions
+from coins.models import Coin
+from users.models import ExpiringToken
+from wallets.models import Wallet, WalletTransaction
+
+PASSWORD = "benchmark-password"
+
+def seed_coins(count: int) -> list:
+    return Coin.objects.bulk_create(
+        Coin(name=f"Benchcoin {index}", symbol=f"BC{index}", slug=f"benchcoin-{index}")
+        for index in range(count)
+    )
+
+def seed_users(count: int, prefix: str = "bench") -> list:
+    """
+    Creates verified users sharing one password hash, each with a wallet
+    and a valid auth token.
+    """
+    password = make_password(PASSWORD)
+    users = get_user_model().objects.bulk_create(
+        get_user_model()(email=f"{prefix}{index}@example.com", username=f"{prefix}{index}", password=password, verified=True)
+        for index in range(count)
+    )
+    Wallet.objects.bulk_create(Wallet(user=user) for user in users)
+    for user in users:
+        ExpiringToken.objects.create(user=user)
+    return users
+
+def seed_history(user, coins: list, transactions: int):
+    """
+    Gives a user a funded wallet and a coin history of the given length,
+    spread over all coins: two buys for every sell, one trade per minute.
+    Each sell sells half of the coin bought just before it.
+    """
+    wallet = Wallet.objects.get(user=user)
+    deposits = [
+        WalletTransaction(wallet=wallet, transaction_type="deposit", transaction_source="fiat", amount=Decimal("1000.00"))
+        for _ in range(max(1, transactions // 2))
+    ]
+    WalletTransaction.objects.bulk_create(deposits)
+    Wallet.objects.filter(pk=wallet.pk).update(balance=wallet.get_ledger_balance())
+
+    start = timezone.now() - timedelta(minutes=transactions + 1)
+    rows = [
+        {
+            "coin": coins[(index - (index % 3 == 2)) % len(coins)].slug,
+            "transaction_type": "sell" if index % 3 == 2 else "buy",
+            "amount": "0.5" if index % 3 == 2 else "1",
+            "price_per_coin": str(100 + index % 50),
+            "created_at": (start + timedelta(minutes=index)).isoformat(),
+        }
+        for index in range(transactions)
+    ]
+    if rows:
+        import_transactions(user, rows)
+
+def seed(users: int, transactions: int, coins: int) -> tuple:
+    """
+    Seeds users x transactions x coins and returns (users, coins).
+    """
+    coin_objects = seed_coins(coins)
+    user_objects = seed_users(users)
+    for user in user_objects:
+        seed_history(user, coin_objects, transactions)
+    return user_objects, coin_objects
@@ -0,0 +1,194 @@
+import asyncio
+import io
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.core.cache import cache
+from django.core.handlers.wsgi import WSGIHandler
+
+from benchmarks.routes import Route, get, post
+from caches.utils import coin_key
+from config.asgi import AsyncViewsASGIHandler
+
+def refresh_data(client):
+    # expire the entry, so every request starts or joins a refresh
+    cache.delete(coin_key(client.coin.slug))
+    return post("cache-single-coin", None, "data", client.coin.slug)
+
+# Routes compared under both servers
+SERVER_ROUTES = [
+    Route("coin-cache", "GET", lambda c: get("coin-cache")),
+    # a sync view, which Django runs in a single shared thread under ASGI
+    Route("me", "GET", lambda c: get("me")),
+    Route("cache-single-coin", "POST", refresh_data, tasks=True),
+]
+
+def get_token(state) -> str:
+    return state.client.cookies["auth_token"].value
+
+def split_path(path: str) -> tuple:
+    path, _, query = path.partition("?")
+    return path, query
+
+def wsgi_environ(method: str, path: str, token: str) -> dict:
+    path, query = split_path(path)
+    return {
+        "REQUEST_METHOD": method,
+        "SCRIPT_NAME": "",
+        "PATH_INFO": path,
+        "QUERY_STRING": query,
+        "SERVER_NAME": "testserver",
+        "SERVER_PORT": "80",
+        "SERVER_PROTOCOL": "HTTP/1.1",
+        "REMOTE_ADDR": "127.0.0.1",
+        "HTTP_COOKIE": f"auth_token={token}",
+        "HTTP_ACCEPT_ENCODING": "gzip",
+        "CONTENT_LENGTH": "0",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": "http",
+        "wsgi.input": io.BytesIO(b""),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+
+def asgi_scope(method: str, path: str, token: str) -> dict:
+    path, query = split_path(path)
+    return {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query.encode(),
+        "root_path": "",
+        "headers": [
+            (b"host", b"testserver"),
+            (b"cookie", f"auth_token={token}".encode()),
+            (b"accept-encoding", b"gzip"),
+        ],
+        "client": ("127.0.0.1", 50000),
+        "server": ("testserver", 80),
+    }
+
+def call_wsgi(handler, environ: dict) -> int:
+    statuses = []
+    response = handler(environ, lambda status, headers, exc_info=None: statuses.append(int(status.split()[0])))
+    try:
+        for _ in response:
+            pass
+    finally:
+        # sends request_finished, like a WSGI server
+        response.close()
+    return statuses[0]
+
+async def call_asgi(application, scope: dict) -> int:
+    messages = [{"type": "http.request", "body": b"", "more_body": False}]
+    disconnected = asyncio.Event()
+    statuses = []
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        # Django stops listening for a disconnect once it has responded
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            statuses.append(message["status"])
+
+    await application(scope, receive, send)
+    return statuses[0]
+
+def run_wsgi(route, clients: list, requests: int, threads: int) -> tuple:
+    """
+    Sends requests from all clients concurrently to the WSGI handler, run
+    by a pool of threads like a threaded WSGI server. The latency includes
+    the wait for a free thread.
+    Returns the latencies (ms), the unexpected statuses and the wall time.
+    """
+    handler = WSGIHandler()
+    latencies, failures = [], []
+    sent = iter(range(requests))
+    lock = threading.Lock()
+
+    with ThreadPoolExecutor(threads) as pool:
+        def request(state):
+            kwargs = route.prepare(state)
+            environ = wsgi_environ(route.method, kwargs["path"], get_token(state))
+            start = time.perf_counter()
+            status = pool.submit(call_wsgi, handler, environ).result()
+            return (time.perf_counter() - start) * 1000, status
+
+        def client(state):
+            while True:
+                with lock:
+                    if next(sent, None) is None:
+                        return
+                elapsed, status = request(state)
+                with lock:
+                    latencies.append(elapsed)
+                    if status not in route.expected:
+                        failures.append(status)
+
+        # one untimed request per client to warm up
+        for state in clients:
+            request(state)
+
+        workers = [threading.Thread(target=client, args=(state,)) for state in clients]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        wall = time.perf_counter() - start
+    return latencies, failures, wall
+
+def run_asgi(route, clients: list, requests: int) -> tuple:
+    """
+    Sends requests from all clients concurrently to the ASGI application
+    (config.asgi), all on one event loop like an ASGI server worker.
+    Returns the latencies (ms), the unexpected statuses and the wall time.
+    """
+    application = AsyncViewsASGIHandler()
+    latencies, failures = [], []
+    sent = iter(range(requests))
+
+    async def request(state):
+        kwargs = route.prepare(state)
+        scope = asgi_scope(route.method, kwargs["path"], get_token(state))
+        start = time.perf_counter()
+        status = await call_asgi(application, scope)
+        return (time.perf_counter() - start) * 1000, status
+
+    async def client(state):
+        while next(sent, None) is not None:
+            elapsed, status = await request(state)
+            latencies.append(elapsed)
+            if status not in route.expected:
+                failures.append(status)
+
+    async def run():
+        for state in clients:
+            await request(state)
+        start = time.perf_counter()
+        await asyncio.gather(*[client(state) for state in clients])
+        return time.perf_counter() - start
+
+    wall = asyncio.run(run())
+    return latencies, failures, wall
+
+def format_server_report(results: dict) -> str:
+    lines = [f"{'route@clients':28} {'server':>6} {'req':>5} {'err':>4} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'req/s':>8}"]
+    for name, servers in results.items():
+        for server, result in servers.items():
+            lines.append(
+                f"{name:28} {server:>6} {result['requests']:>5} {result['errors']:>4} {result['p50_ms']:>8} "
+                f"{result['p95_ms']:>8} {result['p99_ms']:>8} {result['throughput_rps']:>8}"
+            )
+    return "\n".join(lines)
@@ -0,0 +1,87 @@
+import json
+from django.core.cache import cache
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+
+from benchmarks.charts import benchmark_chart_codec, format_chart_report
+from benchmarks.routes import ROUTES, BenchmarkClient
+from benchmarks.runner import BASELINE_PATH, compare, compare_servers, missing_baselines, run_route
+from benchmarks.seed import seed, seed_users
+from benchmarks.servers import SERVER_ROUTES
+from coins.models import CoinHolding
+from wallets.models import Wallet
+
+def make_result(p50_ms=10.0, queries=2.0, errors=0):
+    return {"p50_ms": p50_ms, "queries_per_request": queries, "errors": errors, "error_statuses": []}
+
+class BaselineComparisonTests(SimpleTestCase):
+    def test_unchanged_results_pass(self):
+        baseline = {"me": make_result()}
+        self.assertEqual(compare({"me": make_result(p50_ms=14.0)}, baseline, tolerance=0.5, min_delta_ms=5.0), [])
+
+    def test_regressions_are_reported(self):
+        baseline = {"me": make_result(), "coins": make_result(p50_ms=1.0)}
+        results = {"me": make_result(p50_ms=20.0, queries=3.0), "coins": make_result(p50_ms=5.9, errors=1)}
+
+        regressions = compare(results, baseline, tolerance=0.5, min_delta_ms=5.0)
+
+        self.assertEqual(len(regressions), 3)
+        self.assertIn("me: 3.0 queries/request", regressions[0])
+        self.assertIn("me: p50 20.0ms", regressions[1])
+        self.assertIn("coins: 1 unexpected responses", regressions[2])
+
+    def test_routes_without_baseline_are_reported(self):
+        results = {"me": make_result(), "my-coin-portfolio": make_result()}
+        self.assertEqual(missing_baselines(results, {"me": make_result()}), ["my-coin-portfolio"])
+
+    def test_committed_baseline_covers_every_route(self):
+        # recorded with --no-tasks, see the README
+        with open(BASELINE_PATH) as file:
+            baseline = json.load(file)
+        routes = {route.name: make_result() for route in ROUTES if not route.tasks}
+        self.assertEqual(missing_baselines(routes, baseline), [])
+
+class ChartCodecBenchmarkTests(SimpleTestCase):
+    def test_every_range_is_compared_with_pickle(self):
+        results = benchmark_chart_codec(rounds=2)
+
+        self.assertEqual(list(results), ["1d (288 points)", "30d (720 points)", "365d (366 points)"])
+        for result in results.values():
+            self.assertEqual(set(result), {
+                "pickle_bytes", "pickle_encode_us", "pickle_decode_us",
+                "columnar_bytes", "encode_us", "decode_us", "load_chart_us",
+            })
+        self.assertEqual(len(format_chart_report(results).splitlines()), 4)
+
+class BenchmarkSmokeTests(TransactionTestCase):
+    """
+    Runs a few routes with a tiny data set.
+    """
+    def test_routes_run_against_seeded_data(self):
+        users, coins = seed(users=2, transactions=12, coins=2)
+        spares = seed_users(2, prefix="spare")
+        self.assertEqual(CoinHolding.objects.filter(user=users[0], amount__gt=0).count(), 2)
+
+        clients = [BenchmarkClient(users[index], spares[index], coins[index]) for index in range(2)]
+        routes = {route.name: route for route in ROUTES}
+        for name, route_clients in (("coins", clients), ("my-coin-transactions", clients), ("my-wallet-deposit", clients[:1])):
+            result = run_route(routes[name], route_clients, requests=6)
+            self.assertEqual((result["requests"], result["errors"]), (6, 0), name)
+            self.assertGreater(result["queries_per_request"], 0)
+
+        # 6 timed and 1 warm-up deposits of 10
+        balances = Wallet.objects.filter(user__in=users).values_list("balance", flat=True)
+        self.assertEqual(sum(balances), 2 * 6000 + 7 * 10)
+
+    @override_settings(RATELIMIT_ENABLE=False, API_RATE_LIMITS={})
+    def test_servers_are_compared_under_the_same_load(self):
+        cache.clear()
+        users, coins = seed(users=2, transactions=2, coins=2)
+        clients = [BenchmarkClient(users[index % 2], None, coins[index % 2]) for index in range(4)]
+
+        routes = [route for route in SERVER_ROUTES if not route.tasks]
+        results = compare_servers(routes, clients, levels=[1, 4], requests=8, threads=2)
+
+        self.assertEqual(list(results), ["coin-cache@1", "coin-cache@4", "me@1", "me@4"])
+        for name, servers in results.items():
+            for server in ("wsgi", "asgi"):
+                self.assertEqual((servers[server]["requests"], servers[server]["errors"]), (8, 0), f"{name} {server}")
@@ -0,0 +1,165 @@
+import asyncio
+from asgiref.sync import sync_to_async
+from celery import states
+from celery.backends.redis import RedisBackend
+from celery.exceptions import TimeoutError
+from celery.result import AsyncResult
+from django.http import JsonResponse
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import status
+from rest_framework.exceptions import NotAuthenticated, Throttled
+
+from config.async_cache import get_async_redis
+from config.celery import app
+from config.metrics import timed
+from config.throttling import SlidingWindowThrottle
+from coins.models import Coin
+from caches.snapshot import aget_market_snapshot
+from caches.views import CoinCacheRefreshMixin, snapshot_response
+from users.authentication import CookieTokenAuthentication
+
+# Result polling interval: starts short, grows up to the maximum
+POLL_INTERVAL = 0.05
+MAX_POLL_INTERVAL = 0.5
+
+def get_result_redis():
+    return get_async_redis(app.conf.result_backend)
+
+async def await_result(task_id: str, timeout: float = 30):
+    """
+    Waits for a task like AsyncResult.get, but polls the Redis result
+    backend with the async client instead of blocking a thread. Other
+    result backends are waited for in a thread.
+    """
+    if not isinstance(app.backend, RedisBackend):
+        return await sync_to_async(AsyncResult(task_id, app=app).get, thread_sensitive=False)(timeout=timeout)
+
+    key = app.backend.get_key_for_task(task_id)
+    deadline = asyncio.get_running_loop().time() + timeout
+    interval = POLL_INTERVAL
+    while True:
+        payload = await get_result_redis().get(key)
+        if payload is not None:
+            meta = app.backend.decode_result(payload)
+            if meta["status"] in states.PROPAGATE_STATES:
+                raise meta["result"]
+            if meta["status"] in states.READY_STATES:
+                return meta["result"]
+
+        remaining = deadline - asyncio.get_running_loop().time()
+        if remaining <= 0:
+            raise TimeoutError("The operation timed out.")
+        await asyncio.sleep(min(interval, remaining))
+        interval = min(interval * 2, MAX_POLL_INTERVAL)
+
+def error_response(exc) -> JsonResponse:
+    return JsonResponse({"detail": exc.detail}, status=exc.status_code)
+
+class AsyncCoinCacheBase(CoinCacheRefreshMixin, View):
+    """
+    Async counterpart of CoinCacheBase, served under ASGI (config.asgi).
+    Authentication and the rate limit run on the async Redis client, and
+    the waits for Celery results poll the result backend without holding
+    a thread. Dispatching tasks is quick and runs in a thread.
+    """
+    throttle_costs = {}
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # like APIView, the token cookie is not checked for CSRF
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    async def dispatch(self, request, *args, **kwargs):
+        with timed("auth"):
+            authenticator = CookieTokenAuthentication()
+            credentials = await authenticator.aauthenticate(request)
+            if credentials is None:
+                response = error_response(NotAuthenticated())
+                response["WWW-Authenticate"] = authenticator.authenticate_header(request)
+                return response
+            request.user, request.auth = credentials
+
+            throttle = SlidingWindowThrottle()
+            if not await throttle.aallow_request(request, self):
+                exc = Throttled(throttle.wait())
+                response = error_response(exc)
+                response["Retry-After"] = "%d" % exc.wait
+                return response
+
+        with timed("view"):
+            return await super().dispatch(request, *args, **kwargs)
+
+    async def run_task(self, slug: str, kind: str, args: list):
+        """
+        Run a Celery task (see start_task) and wait for it.
+        """
+        try:
+            message, task_id = await sync_to_async(self.start_task, thread_sensitive=False)(slug, kind, args)
+            if task_id:
+                with timed("celery"):
+                    await await_result(task_id)
+            return message
+        except Exception as e:
+            return f"{slug} {kind} failed: {str(e)}"
+
+    async def run_bulk_task(self, slugs: list) -> list:
+        """
+        Refresh the data of many coins with a single bulk task
+        (see start_bulk_task) and wait for it.
+        """
+        results, pending = await sync_to_async(self.start_bulk_task, thread_sensitive=False)(slugs)
+
+        async def wait(task_id, task_slugs, message):
+            try:
+                with timed("celery"):
+                    await await_result(task_id)
+                return [f"{slug} data {message}" for slug in task_slugs]
+            except Exception as e:
+                return [f"{slug} data failed: {str(e)}" for slug in task_slugs]
+
+        for task_results in await asyncio.gather(*[wait(*task) for task in pending]):
+            results += task_results
+        return results
+
+class AsyncCoinCacheView(AsyncCoinCacheBase):
+    """
+    CoinCacheView for ASGI. POST refreshes the data and the 1d charts of
+    all coins and waits for them concurrently.
+    """
+    throttle_costs = {"POST": 50}
+
+    async def get(self, request):
+        return snapshot_response(request, await aget_market_snapshot())
+
+    async def post(self, request):
+        slugs = [slug async for slug in Coin.objects.filter(is_active=True).values_list("slug", flat=True)]
+
+        if self.is_async(request):
+            jobs = [(slug, "chart", [slug, "1"]) for slug in slugs]
+            data = await sync_to_async(self.enqueue_tasks, thread_sensitive=False)(jobs, bulk_slugs=slugs)
+            return JsonResponse(data, status=status.HTTP_202_ACCEPTED)
+
+        results, charts = await asyncio.gather(
+            self.run_bulk_task(slugs),
+            asyncio.gather(*[self.run_task(slug, "chart", [slug, "1"]) for slug in slugs]),
+        )
+        return JsonResponse({"results": results + list(charts)}, status=status.HTTP_200_OK)
+
+class AsyncSingleCoinCacheView(AsyncCoinCacheBase):
+    """
+    SingleCoinCacheView for ASGI.
+    """
+    throttle_costs = {"POST": 10}
+
+    async def post(self, request, kind, slug):
+        args_list, error = self.get_task_args(request, kind, slug)
+        if error:
+            return JsonResponse({"error": error}, status=status.HTTP_400_BAD_REQUEST)
+
+        if self.is_async(request):
+            data = await sync_to_async(self.enqueue_tasks, thread_sensitive=False)([(slug, kind, args_list)])
+            return JsonResponse(data, status=status.HTTP_202_ACCEPTED)
+
+        result = await self.run_task(slug, kind, args_list)
+        return JsonResponse({"result": result}, status=status.HTTP_200_OK)
@@ -0,0 +1,177 @@
+import struct
+import zlib
+
+import numpy as np
+
+SERIES = ("prices", "market_caps", "total_volumes")
+
+# Binary layout of a market_chart:
+#   header: magic, flags (bit n: SERIES[n] present, bit 7: shared timestamps),
+#           one uint32 point count per present series
+#   body (zlib): per series int64 delta-encoded timestamps (once if shared),
+#                then per series float64 values
+MAGIC = b"MCH1"
+SHARED_TIMESTAMPS = 0x80
+
+HEADER = struct.Struct("<4sB")
+COUNT = struct.Struct("<I")
+
+# Point counts precomputed for every chart range, so typical chart widths
+# are served without touching the full series
+RESOLUTIONS = (100, 300, 1000)
+
+def encode_chart(market_chart: dict) -> bytes:
+    """
+    Encodes CoinGecko's market_chart response ({series: [[timestamp, value], ...]})
+    into compact columnar bytes.
+    """
+    chart = {}
+    for name in SERIES:
+        if name in market_chart:
+            points = np.asarray(market_chart[name], dtype=np.float64).reshape(-1, 2)
+            chart[name] = (points[:, 0].astype(np.int64), np.ascontiguousarray(points[:, 1]))
+    return encode_series(chart)
+
+def encode_series(chart: dict) -> bytes:
+    """
+    Encodes {series: (timestamps, values)} numpy arrays into columnar bytes.
+    """
+    names = [name for name in SERIES if name in chart]
+    columns = [chart[name] for name in names]
+
+    flags = sum(1 << SERIES.index(name) for name in names)
+    shared = len(columns) > 1 and all(np.array_equal(columns[0][0], ts) for ts, _ in columns[1:])
+    if shared:
+        flags |= SHARED_TIMESTAMPS
+
+    timestamps = [columns[0][0]] if shared else [ts for ts, _ in columns]
+    body = b"".join(np.diff(ts.astype(np.int64), prepend=np.int64(0)).tobytes() for ts in timestamps)
+    body += b"".join(values.astype(np.float64).tobytes() for _, values in columns)
+
+    header = HEADER.pack(MAGIC, flags) + b"".join(COUNT.pack(len(values)) for _, values in columns)
+    return header + zlib.compress(body)
+
+def decode_chart(blob: bytes) -> dict:
+    """
+    Decodes chart bytes into {series: (timestamps, values)} numpy arrays.
+    The value arrays are read-only views on the decompressed buffer.
+    """
+    magic, flags = HEADER.unpack_from(blob)
+    if magic != MAGIC:
+        raise ValueError("Not an encoded market chart")
+
+    names = [name for index, name in enumerate(SERIES) if flags & (1 << index)]
+    offset = HEADER.size
+    counts = []
+    for _ in names:
+        counts.append(COUNT.unpack_from(blob, offset)[0])
+        offset += COUNT.size
+
+    buffer = zlib.decompress(memoryview(blob)[offset:])
+    position = 0
+
+    def read(dtype, count):
+        nonlocal position
+        array = np.frombuffer(buffer, dtype=dtype, count=count, offset=position)
+        position += count * 8
+        return array
+
+    if flags & SHARED_TIMESTAMPS:
+        shared = np.cumsum(read(np.int64, counts[0]))
+        timestamps = [shared] * len(names)
+    else:
+        timestamps = [np.cumsum(read(np.int64, count)) for count in counts]
+
+    return {
+        name: (ts, read(np.float64, count))
+        for name, ts, count in zip(names, timestamps, counts)
+    }
+
+def chart_to_lists(chart: dict) -> dict:
+    """
+    Converts decoded series back to CoinGecko's [[timestamp, value], ...] shape.
+    """
+    return {
+        name: [list(point) for point in zip(ts.tolist(), values.tolist())]
+        for name, (ts, values) in chart.items()
+    }
+
+def load_series(data) -> dict:
+    """
+    Returns cached chart data as {series: (timestamps, values)} arrays,
+    for encoded charts as well as charts cached before they were stored encoded.
+    """
+    if isinstance(data, (bytes, bytearray)):
+        return decode_chart(data)
+    return decode_chart(encode_chart(data))
+
+def load_chart(data) -> dict:
+    """
+    Returns cached chart data in CoinGecko's shape, for encoded charts
+    as well as charts cached before they were stored encoded.
+    """
+    if isinstance(data, (bytes, bytearray)):
+        return chart_to_lists(decode_chart(data))
+    return data
+
+def lttb_indices(timestamps: np.ndarray, values: np.ndarray, max_points: int) -> np.ndarray:
+    """
+    Largest-Triangle-Three-Buckets: indices of at most max_points points that
+    keep the visual shape of the series. Bucket averages are computed for all
+    buckets at once; the point selection walks the buckets in order.
+    """
+    count = len(values)
+    if max_points >= count or max_points < 3:
+        return np.arange(count)
+
+    x = timestamps.astype(np.float64)
+    y = values
+    # max_points - 2 buckets between the fixed first and last point
+    edges = np.linspace(1, count - 1, max_points - 1).astype(np.int64)
+    sizes = np.diff(np.append(edges, count))
+    avg_x = np.add.reduceat(x, edges) / sizes
+    avg_y = np.add.reduceat(y, edges) / sizes
+    # the bucket after the last one is the last point itself
+    avg_x[-1], avg_y[-1] = x[-1], y[-1]
+
+    selected = np.empty(max_points, dtype=np.int64)
+    selected[0], selected[-1] = 0, count - 1
+    a = 0
+    for bucket in range(max_points - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        area = np.abs(
+            (x[a] - avg_x[bucket + 1]) * (y[start:end] - y[a])
+            - (x[a] - x[start:end]) * (avg_y[bucket + 1] - y[a])
+        )
+        a = start + int(np.argmax(area))
+        selected[bucket + 1] = a
+    return selected
+
+def downsample_chart(chart: dict, max_points: int = None, start: int = None, end: int = None) -> dict:
+    """
+    Slices every decoded series to the [start, end] time range and reduces
+    it to at most max_points points with LTTB.
+    """
+    result = {}
+    for name, (timestamps, values) in chart.items():
+        lower = 0 if start is None else np.searchsorted(timestamps, start, side="left")
+        upper = len(timestamps) if end is None else np.searchsorted(timestamps, end, side="right")
+        timestamps, values = timestamps[lower:upper], values[lower:upper]
+
+        if max_points is not None:
+            indices = lttb_indices(timestamps, values, max_points)
+            timestamps, values = timestamps[indices], values[indices]
+        result[name] = (timestamps, values)
+    return result
+
+def precompute_resolutions(encoded: bytes) -> dict:
+    """
+    Returns {points: encoded chart} for every resolution smaller than the chart.
+    """
+    chart = decode_chart(encoded)
+    longest = max((len(values) for _, values in chart.values()), default=0)
+    return {
+        points: encode_series(downsample_chart(chart, points))
+        for points in RESOLUTIONS
+        if points < longest
+    }
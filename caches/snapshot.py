@@ -0,0 +1,169 @@
+import gzip
+import hashlib
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django_redis import get_redis_connection
+
+from caches.utils import get_coin_cache_entries, now_ms, refresh_in_background
+from config.async_cache import aadd, adelete, aget
+
+SNAPSHOT_KEY = "snapshot:market"
+SNAPSHOT_TTL = 24 * 60 * 60  # 24h
+# Every build takes a generation before it reads the fragments; the
+# generation of the stored snapshot is kept next to it
+GENERATION_KEY = "snapshot:market:generation"
+STORED_GENERATION_KEY = "snapshot:market:stored"
+REVALIDATE_KEY = "snapshot:revalidating"
+REVALIDATE_INTERVAL = 30  # at most one background refresh check per 30s
+
+# Stores a snapshot only if no build of a later generation stored one yet,
+# so a slow build never overwrites the result of a newer one.
+# KEYS: snapshot, stored generation. ARGV: snapshot, generation, ttl (s).
+# Returns 1 if the snapshot was stored.
+STORE_SNAPSHOT_SCRIPT = """
+local stored = tonumber(redis.call('GET', KEYS[2])) or 0
+if stored >= tonumber(ARGV[2]) then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[3])
+redis.call('SET', KEYS[2], ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+
+_script = None
+
+def get_script():
+    global _script
+    if _script is None:
+        _script = get_redis_connection("default").register_script(STORE_SNAPSHOT_SCRIPT)
+    return _script
+
+def fragment_key(slug: str) -> str:
+    return f"snapshot:coin:{slug}"
+
+def encode_fragments(entries: dict, stale_at: dict) -> dict:
+    """
+    Encodes the JSON fragment of every coin entry once. Each fragment
+    keeps the soft expiry of the coin's keys next to its bytes.
+    """
+    fragments = {}
+    for slug, entry in entries.items():
+        fragments[fragment_key(slug)] = {
+            "body": json.dumps(entry, separators=(",", ":")).encode(),
+            "stale_at": {key: value for key, value in stale_at.items() if key.split(":")[1] == slug},
+        }
+    return fragments
+
+def get_active_slugs() -> list:
+    from coins.models import Coin
+    return list(Coin.objects.filter(is_active=True).values_list("slug", flat=True))
+
+def refresh_coin_snapshots(slugs) -> dict:
+    """
+    Re-encodes the snapshot fragments of the given coins and reassembles
+    the market snapshot. All other coins keep their encoded fragments.
+    """
+    slugs = list(slugs)
+    entries, stale_at = get_coin_cache_entries(slugs)
+
+    fragments = encode_fragments(entries, stale_at)
+    if fragments:
+        cache.set_many(fragments, timeout=SNAPSHOT_TTL)
+
+    removed = [fragment_key(slug) for slug in slugs if slug not in entries]
+    if removed:
+        cache.delete_many(removed)
+
+    return build_market_snapshot()
+
+def build_market_snapshot(slugs=None) -> dict:
+    """
+    Assembles the market snapshot from the pre-encoded coin fragments and
+    stores it as JSON bytes (gzip compressed if enabled) with an ETag.
+    Missing fragments are encoded from the coin caches on the fly.
+    The snapshot records the soft expiry of every key it contains.
+    Of concurrent builds, the one that read the fragments last wins.
+    """
+    if slugs is None:
+        slugs = get_active_slugs()
+
+    generation = get_redis_connection("default").incr(cache.make_key(GENERATION_KEY))
+    fragments = cache.get_many([fragment_key(slug) for slug in slugs])
+
+    missing = [slug for slug in slugs if fragment_key(slug) not in fragments]
+    if missing:
+        new_fragments = encode_fragments(*get_coin_cache_entries(missing))
+        if new_fragments:
+            cache.set_many(new_fragments, timeout=SNAPSHOT_TTL)
+            fragments.update(new_fragments)
+
+    included = [slug for slug in slugs if fragment_key(slug) in fragments]
+    body = b"{" + b",".join(
+        json.dumps(slug).encode() + b":" + fragments[fragment_key(slug)]["body"]
+        for slug in included
+    ) + b"}"
+
+    stale_at = {}
+    for slug in included:
+        stale_at.update(fragments[fragment_key(slug)]["stale_at"])
+
+    snapshot = {
+        "etag": f'"{hashlib.md5(body).hexdigest()}"',
+        "encoding": None,
+        "body": body,
+        "stale_at": stale_at,
+    }
+    if settings.MARKET_SNAPSHOT_COMPRESS:
+        snapshot["encoding"] = "gzip"
+        snapshot["body"] = gzip.compress(body)
+
+    get_script()(
+        keys=[cache.make_key(SNAPSHOT_KEY), cache.make_key(STORED_GENERATION_KEY)],
+        args=[cache.client.encode(snapshot), generation, SNAPSHOT_TTL],
+    )
+    return snapshot
+
+def get_stale_keys(snapshot: dict) -> list:
+    now = now_ms()
+    return [key for key, stale_at in snapshot["stale_at"].items() if now >= stale_at]
+
+def get_market_snapshot() -> dict:
+    """
+    Returns the stored market snapshot and builds it if it is missing.
+    Stale keys are served as they are and refreshed in the background.
+    """
+    snapshot = cache.get(SNAPSHOT_KEY)
+    if snapshot is None:
+        snapshot = build_market_snapshot()
+
+    stale_keys = get_stale_keys(snapshot)
+    if stale_keys and cache.add(REVALIDATE_KEY, 1, timeout=REVALIDATE_INTERVAL):
+        try:
+            refresh_in_background(stale_keys)
+        except Exception:
+            # a failed dispatch must not fail the read; next interval retries
+            cache.delete(REVALIDATE_KEY)
+
+    return snapshot
+
+async def aget_market_snapshot() -> dict:
+    """
+    get_market_snapshot for async views, with the async Redis client.
+    Building a missing snapshot and dispatching refreshes are rare and
+    run in a thread.
+    """
+    snapshot = await aget(SNAPSHOT_KEY)
+    if snapshot is None:
+        snapshot = await sync_to_async(build_market_snapshot)()
+
+    stale_keys = get_stale_keys(snapshot)
+    if stale_keys and await aadd(REVALIDATE_KEY, 1, timeout=REVALIDATE_INTERVAL):
+        try:
+            await sync_to_async(refresh_in_background, thread_sensitive=False)(stale_keys)
+        except Exception:
+            await adelete(REVALIDATE_KEY)
+
+    return snapshot
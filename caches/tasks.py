@@ -1,12 +1,173 @@
+import os
+import random
+import time
+import uuid
+from email.utils import parsedate_to_datetime
 from celery import shared_task
+from celery.exceptions import Ignore
 from django.core.cache import cache
 from django.conf import settings
+from django.utils.timezone import now
 import requests
+from requests.adapters import HTTPAdapter
+
+from caches.charts import RESOLUTIONS, encode_chart, precompute_resolutions
+from caches.snapshot import get_active_slugs, refresh_coin_snapshots
+from caches.throttle import acquire_coingecko_token, pause_coingecko_bucket
+from caches.utils import LOCK_LEASE, PRICE_VERSION_KEY, acquire_refresh_lock, bump_version, cache_envelopes, chart_key, chart_resolution_key, chart_version_key, coin_key, make_envelope, release_refresh_locks, renew_refresh_locks
+from config.celery import CHART_PREWARM_INTERVALS
 
 COIN_TTL = 24 * 60 * 60  # 24h
+MARKETS_PAGE_SIZE = 250  # CoinGecko maximum per page
+MAX_RETRIES = 5
+MAX_BACKOFF = 5 * 60  # 5min
+# Reschedules while waiting for a CoinGecko token are counted in their own
+# message header, so they do not use up the retries for upstream errors
+TOKEN_WAITS_HEADER = "coingecko_token_waits"
+MAX_TOKEN_WAITS = 50
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
 
-@shared_task
-def cache_coin_data(coin_id: str):
+# /coins/markets fields and where /coins/<id> keeps them in market_data:
+# amounts per currency ({"usd": ...}) or plain values
+MARKET_CURRENCY_FIELDS = [
+    "current_price", "market_cap", "fully_diluted_valuation", "total_volume", "high_24h", "low_24h",
+    "ath", "ath_change_percentage", "ath_date", "atl", "atl_change_percentage", "atl_date",
+]
+MARKET_PLAIN_FIELDS = [
+    "market_cap_rank", "price_change_24h", "price_change_percentage_24h", "market_cap_change_24h",
+    "market_cap_change_percentage_24h", "circulating_supply", "total_supply", "max_supply", "roi", "last_updated",
+]
+
+_session = None
+_session_pid = None
+
+def get_session() -> requests.Session:
+    """
+    Returns a keep-alive HTTP session for the current worker process.
+    A new session is created after a fork, so connections are never
+    shared between Celery worker processes.
+    """
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _session, _session_pid = session, os.getpid()
+    return _session
+
+def get_retry_after(resp) -> float:
+    """
+    Parses a Retry-After header given in seconds or as HTTP date.
+    """
+    value = resp.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - now()).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def get_token_waits(task) -> int:
+    # custom headers are request attributes in a worker, headers when applied eagerly
+    request = task.request
+    return getattr(request, TOKEN_WAITS_HEADER, None) or (request.headers or {}).get(TOKEN_WAITS_HEADER, 0)
+
+def wait_for_token(task, countdown: float, lock_keys: list, retry_args=None):
+    """
+    Reschedules the task (same id and retries) until a CoinGecko token is
+    free. Gives up with a RequestException after MAX_TOKEN_WAITS.
+    """
+    token_waits = get_token_waits(task) + 1
+    if token_waits > MAX_TOKEN_WAITS:
+        raise requests.exceptions.RetryError(f"No CoinGecko token after {MAX_TOKEN_WAITS} reschedules")
+    renew_refresh_locks(lock_keys, task.request.id, countdown + LOCK_LEASE)
+    task.signature_from_request(
+        task.request, retry_args, None, countdown=countdown, headers={TOKEN_WAITS_HEADER: token_waits},
+    ).apply_async()
+    raise Ignore()
+
+def coingecko_get(task, url: str, params: dict, lock_keys: list, retry_args=None):
+    """
+    Calls CoinGecko through the token bucket shared by all workers.
+    429 and 5xx responses are retried via Celery, honoring Retry-After or
+    backing off exponentially. Other errors raise a RequestException.
+    The refresh locks of lock_keys are extended over every reschedule.
+    """
+    # the token is reserved unless the wait is too long to sleep through
+    wait = acquire_coingecko_token()
+    if wait > settings.COINGECKO_MAX_TOKEN_WAIT:
+        wait_for_token(task, wait, lock_keys, retry_args)
+    if wait:
+        time.sleep(wait)
+
+    resp = get_session().get(url, params=params)
+
+    if resp.status_code in RETRY_STATUS_CODES and task.request.retries < task.max_retries:
+        retry_after = get_retry_after(resp)
+        if resp.status_code == 429 and retry_after:
+            pause_coingecko_bucket(retry_after)
+        if retry_after is None:
+            retry_after = min(MAX_BACKOFF, 2 ** task.request.retries)
+        renew_refresh_locks(lock_keys, task.request.id, retry_after + LOCK_LEASE)
+        raise task.retry(args=retry_args, countdown=retry_after, headers={TOKEN_WAITS_HEADER: get_token_waits(task)})
+
+    resp.raise_for_status()
+    return resp.json()
+
+def coin_from_market(row: dict) -> dict:
+    """
+    Converts a /coins/markets row (USD) into the shape of the /coins/<id>
+    document, so every coin:<slug> entry has the same schema.
+    """
+    market_data = {field: {"usd": row[field]} for field in MARKET_CURRENCY_FIELDS if field in row}
+    market_data.update({field: row[field] for field in MARKET_PLAIN_FIELDS if field in row})
+
+    data = {key: row[key] for key in ("id", "symbol", "name", "market_cap_rank", "last_updated") if key in row}
+    if "image" in row:
+        data["image"] = {"large": row["image"]}
+    data["market_data"] = market_data
+    return data
+
+def get_hard_ttl(redis_key: str) -> int:
+    """
+    Redis timeout of a coin or chart entry: COIN_TTL, but at least twice
+    the prewarm interval of a chart range, so the next prewarm always
+    lands before the chart expires, even when it is delayed.
+    """
+    kind, slug, *days = redis_key.split(":")
+    if kind == "chart":
+        return max(COIN_TTL, 2 * CHART_PREWARM_INTERVALS[int(days[0])])
+    return COIN_TTL
+
+def store_coin_cache(items: list):
+    """
+    Saves fetched (slug, redis_key, data) items wrapped with their cached_at
+    timestamp and soft expiry, and updates the coins' parts of the market
+    snapshot. get_hard_ttl() gives the hard expiry. New coin data bumps the
+    price version, new charts the chart version of their range.
+    """
+    cached_at = int(now().timestamp() * 1000)
+    values_by_ttl = {}
+    for _, redis_key, data in items:
+        values_by_ttl.setdefault(get_hard_ttl(redis_key), {})[redis_key] = make_envelope(data, cached_at, redis_key)
+
+    for timeout, values in values_by_ttl.items():
+        cache_envelopes(values, timeout=timeout)
+    refresh_coin_snapshots({slug for slug, _, _ in items})
+    versions = set()
+    for _, redis_key, _ in items:
+        kind, slug, *days = redis_key.split(":")
+        versions.add(PRICE_VERSION_KEY if kind == "coin" else chart_version_key(days[0]))
+    for version_key in versions:
+        bump_version(version_key)
+
+@shared_task(bind=True, max_retries=MAX_RETRIES)
+def cache_coin_data(self, coin_id: str):
     """
     Loads a single coin from CoinGecko and saves it in Redis.
     """
@@ -16,38 +177,122 @@ def cache_coin_data(coin_id: str):
     if settings.COINGECKO_API_KEY:
         params['x_cg_demo_api_key'] = settings.COINGECKO_API_KEY
 
+    redis_key = coin_key(coin_id.lower())
     try:
-        resp = requests.get(url, params=params)
-        resp.raise_for_status()
-        data = resp.json()
-
-        redis_key = f"coin:{coin_id.lower()}"
-        cache.set(redis_key, data, timeout=COIN_TTL)
+        data = coingecko_get(self, url, params, [redis_key])
+        store_coin_cache([(coin_id.lower(), redis_key, data)])
+        release_refresh_locks([redis_key], self.request.id)
 
         return f"{redis_key} cached successfully"
 
     except requests.RequestException as e:
+        release_refresh_locks([redis_key], self.request.id)
         return f"Error caching {coin_id}: {str(e)}"
     
-@shared_task
-def cache_coin_chart(coin_id: str, days: str):
+@shared_task(bind=True, max_retries=MAX_RETRIES)
+def cache_coin_chart(self, coin_id: str, days: str):
     """
-    Loads historical chart data for a coin and saves it permanently in Redis.
+    Loads historical chart data for a coin and saves it in Redis,
+    encoded in the compact columnar format of caches.charts, together
+    with its precomputed lower resolutions. Resolutions that are not
+    smaller than the new chart are removed.
     """
     url = f"{settings.COINGECKO_API_URL}/coins/{coin_id}/market_chart"
     params = {"vs_currency": "usd", "days": days}
     if settings.COINGECKO_API_KEY:
         params["x_cg_demo_api_key"] = settings.COINGECKO_API_KEY
 
+    redis_key = chart_key(coin_id.lower(), days)
     try:
-        resp = requests.get(url, params=params)
-        resp.raise_for_status()
-        data = resp.json()
-
-        redis_key = f"chart:{coin_id.lower()}:{days}"
-        cache.set(redis_key, data, timeout=COIN_TTL)
+        data = coingecko_get(self, url, params, [redis_key])
+        encoded = encode_chart(data)
+        resolutions = precompute_resolutions(encoded)
+        items = [(coin_id.lower(), redis_key, encoded)]
+        for points, downsampled in resolutions.items():
+            items.append((coin_id.lower(), chart_resolution_key(coin_id.lower(), days, points), downsampled))
+        store_coin_cache(items)
+        # resolutions the chart has become too short for would serve the old series
+        outdated = [chart_resolution_key(coin_id.lower(), days, points) for points in RESOLUTIONS if points not in resolutions]
+        if outdated:
+            cache.delete_many(outdated)
+        release_refresh_locks([redis_key], self.request.id)
 
         return f"{redis_key} cached successfully"
 
     except requests.RequestException as e:
-        return f"Error caching {coin_id} chart {days}d: {str(e)}"
\ No newline at end of file
+        release_refresh_locks([redis_key], self.request.id)
+        return f"Error caching {coin_id} chart {days}d: {str(e)}"
+
+@shared_task(bind=True, max_retries=MAX_RETRIES)
+def cache_coins_markets(self, coin_ids: list):
+    """
+    Loads many coins per request from CoinGecko's /coins/markets endpoint
+    and saves each of them in Redis under its own coin:<slug> key, in the
+    shape of cache_coin_data (see coin_from_market).
+    """
+    url = f"{settings.COINGECKO_API_URL}/coins/markets"
+    coin_ids = [coin_id.lower() for coin_id in coin_ids]
+
+    cached = []
+    try:
+        for start in range(0, len(coin_ids), MARKETS_PAGE_SIZE):
+            chunk = coin_ids[start:start + MARKETS_PAGE_SIZE]
+            params = {"vs_currency": "usd", "ids": ",".join(chunk), "per_page": MARKETS_PAGE_SIZE}
+            if settings.COINGECKO_API_KEY:
+                params["x_cg_demo_api_key"] = settings.COINGECKO_API_KEY
+
+            # a retry only fetches the coins that are not cached yet
+            rows = coingecko_get(self, url, params, [coin_key(slug) for slug in coin_ids[start:]], retry_args=[coin_ids[start:]])
+
+            items = [(row["id"], coin_key(row["id"]), coin_from_market(row)) for row in rows]
+            store_coin_cache(items)
+            release_refresh_locks([coin_key(slug) for slug in chunk], self.request.id)
+            cached += [slug for slug, _, _ in items]
+
+        return f"{len(cached)} coins cached successfully"
+
+    except requests.RequestException as e:
+        release_refresh_locks([coin_key(slug) for slug in coin_ids], self.request.id)
+        return f"Error caching markets ({len(cached)} of {len(coin_ids)} cached): {str(e)}"
+
+@shared_task
+def prewarm_coin_data(jitter: int = 0):
+    """
+    Periodic task (celery beat): refreshes the data of all active coins
+    with one bulk task, started after a random delay of up to jitter seconds.
+    """
+    task_id = str(uuid.uuid4())
+    countdown = random.uniform(0, jitter)
+    # coins that are already being refreshed are left out
+    slugs = [
+        slug for slug in get_active_slugs()
+        if not acquire_refresh_lock(coin_key(slug), task_id, lease=LOCK_LEASE + countdown)
+    ]
+    if slugs:
+        try:
+            cache_coins_markets.apply_async(args=[slugs], countdown=countdown, task_id=task_id)
+        except Exception:
+            release_refresh_locks([coin_key(slug) for slug in slugs], task_id)
+            raise
+    return f"{len(slugs)} coins scheduled for data prewarm"
+
+@shared_task
+def prewarm_coin_charts(days: str, jitter: int = 0):
+    """
+    Periodic task (celery beat): refreshes one chart range of all active
+    coins. Each coin starts after its own random delay of up to jitter
+    seconds, so the refreshes do not hit CoinGecko at the same moment.
+    """
+    scheduled = 0
+    for slug in get_active_slugs():
+        task_id = str(uuid.uuid4())
+        countdown = random.uniform(0, jitter)
+        if acquire_refresh_lock(chart_key(slug, days), task_id, lease=LOCK_LEASE + countdown):
+            continue
+        try:
+            cache_coin_chart.apply_async(args=[slug, str(days)], countdown=countdown, task_id=task_id)
+        except Exception:
+            release_refresh_locks([chart_key(slug, days)], task_id)
+            raise
+        scheduled += 1
+    return f"{scheduled} coins scheduled for {days}d chart prewarm"
@@ -1,8 +1,32 @@
+import asyncio
+import gzip
+import json
+import pickle
+import threading
+import time
 from django.test import TestCase, override_settings
-from unittest.mock import patch, MagicMock
+from django.contrib.auth import get_user_model
+from django.urls import reverse
+from unittest.mock import AsyncMock, patch, MagicMock
 from django.core.cache import cache
-from caches.tasks import cache_coin_data, cache_coin_chart
+import numpy as np
+from redis import Redis
+from rest_framework.test import APIClient
+from benchmarks.charts import make_market_chart
+from benchmarks.coingecko import FakeCoinGeckoServer
+from caches.async_views import await_result
+from celery.exceptions import TimeoutError
+from caches.tasks import MAX_TOKEN_WAITS, TOKEN_WAITS_HEADER, cache_coin_data, coingecko_get, cache_coin_chart, cache_coins_markets, coin_from_market, get_hard_ttl, get_session, prewarm_coin_charts, prewarm_coin_data, store_coin_cache
+from config.celery import CHART_PREWARM_INTERVALS, app, get_jitter
+from caches.charts import chart_to_lists, decode_chart, downsample_chart, encode_chart, load_chart, lttb_indices
+from caches.snapshot import SNAPSHOT_KEY, build_market_snapshot, refresh_coin_snapshots
+from caches.throttle import acquire_coingecko_token, pause_coingecko_bucket
+from caches.utils import ALLOWED_DAYS, CACHE_TTL_MS, LOCK_LEASE, acquire_refresh_lock, cache_envelopes, chart_key, chart_resolution_key, coin_key, is_stale, job_key, lock_key, make_envelope, now_ms, refresh_in_background
+from coins.models import Coin
+from config.async_cache import get_async_redis
 from requests.exceptions import RequestException
+from users.authentication import local_tokens
+from users.models import ExpiringToken
 
 @override_settings(COINGECKO_API_URL="https://api.coingecko.com/api/v3", COINGECKO_API_KEY="test-key")
 class CacheCoinTasksTests(TestCase):
@@ -12,60 +36,842 @@ class CacheCoinTasksTests(TestCase):
         """
         cache.clear()
 
-    @patch("caches.tasks.requests.get")
-    def test_cache_coin_data_success(self, mock_get):
+    @patch("caches.tasks.get_session")
+    def test_cache_coin_data_success(self, mock_session):
         """
         Test that coin data is fetched and cached successfully.
         """
         mock_resp = MagicMock()
         mock_resp.raise_for_status.return_value = None
         mock_resp.json.return_value = {"id": "bitcoin", "symbol": "btc"}
-        mock_get.return_value = mock_resp
+        mock_session.return_value.get.return_value = mock_resp
 
         result = cache_coin_data("bitcoin")
 
         redis_key = "coin:bitcoin"
         self.assertEqual(result, f"{redis_key} cached successfully")
-        self.assertEqual(cache.get(redis_key), {"id": "bitcoin", "symbol": "btc"})
-        mock_get.assert_called_once_with(
+        self.assertEqual(cache.get(redis_key)["data"], {"id": "bitcoin", "symbol": "btc"})
+        mock_session.return_value.get.assert_called_once_with(
             "https://api.coingecko.com/api/v3/coins/bitcoin",
             params={"x_cg_demo_api_key": "test-key"}
         )
 
-    @patch("caches.tasks.requests.get", side_effect=RequestException("API error"))
-    def test_cache_coin_data_failure(self, mock_get):
+    @patch("caches.tasks.get_session")
+    def test_cache_coin_data_failure(self, mock_session):
         """
         Test that an API error is handled properly and nothing is cached.
         """
+        mock_session.return_value.get.side_effect = RequestException("API error")
         result = cache_coin_data("bitcoin")
         self.assertIn("Error caching bitcoin", result)
         self.assertIsNone(cache.get("coin:bitcoin"))
 
-    @patch("caches.tasks.requests.get")
-    def test_cache_coin_chart_success(self, mock_get):
+    @patch("caches.tasks.get_session")
+    def test_cache_coin_chart_success(self, mock_session):
         """
         Test that historical coin chart data is fetched and cached successfully.
         """
         mock_resp = MagicMock()
         mock_resp.raise_for_status.return_value = None
         mock_resp.json.return_value = {"prices": [[1234567890, 20000]]}
-        mock_get.return_value = mock_resp
+        mock_session.return_value.get.return_value = mock_resp
 
         result = cache_coin_chart("bitcoin", "30")
 
         redis_key = "chart:bitcoin:30"
         self.assertEqual(result, f"{redis_key} cached successfully")
-        self.assertEqual(cache.get(redis_key), {"prices": [[1234567890, 20000]]})
-        mock_get.assert_called_once_with(
+        self.assertEqual(load_chart(cache.get(redis_key)["data"]), {"prices": [[1234567890, 20000]]})
+        mock_session.return_value.get.assert_called_once_with(
             "https://api.coingecko.com/api/v3/coins/bitcoin/market_chart",
             params={"vs_currency": "usd", "days": "30", "x_cg_demo_api_key": "test-key"}
         )
 
-    @patch("caches.tasks.requests.get", side_effect=RequestException("API error"))
-    def test_cache_coin_chart_failure(self, mock_get):
+    @patch("caches.tasks.get_session")
+    def test_cache_coin_chart_failure(self, mock_session):
         """
         Test that an API error during chart fetch is handled and cache remains empty.
         """
+        mock_session.return_value.get.side_effect = RequestException("API error")
         result = cache_coin_chart("bitcoin", "30")
         self.assertIn("Error caching bitcoin chart 30d", result)
-        self.assertIsNone(cache.get("chart:bitcoin:30"))
\ No newline at end of file
+        self.assertIsNone(cache.get("chart:bitcoin:30"))
+
+    @patch("caches.tasks.get_session")
+    def test_cache_coins_markets_fans_out(self, mock_session):
+        """
+        Test that the bulk task fetches coins in pages and caches each coin separately.
+        """
+        mock_resp = MagicMock()
+        mock_resp.json.side_effect = lambda: [
+            {"id": coin_id, "current_price": 1} for coin_id in mock_session.return_value.get.call_args.kwargs["params"]["ids"].split(",")
+        ]
+        mock_session.return_value.get.return_value = mock_resp
+        coin_ids = [f"coin-{i}" for i in range(300)]
+
+        result = cache_coins_markets(coin_ids)
+
+        self.assertEqual(result, "300 coins cached successfully")
+        self.assertEqual(mock_session.return_value.get.call_count, 2)
+        self.assertEqual(cache.get("coin:coin-299")["data"], {"id": "coin-299", "market_data": {"current_price": {"usd": 1}}})
+        self.assertIsNotNone(cache.get("coin:coin-0")["cached_at"])
+
+    def test_markets_rows_are_stored_like_coin_data(self):
+        """
+        Test that a /coins/markets row is stored in the /coins/<id> shape.
+        """
+        row = {
+            "id": "bitcoin", "symbol": "btc", "name": "Bitcoin", "image": "https://example.com/btc.png",
+            "current_price": 100.0, "market_cap": 2e12, "market_cap_rank": 1, "price_change_percentage_24h": -1.5,
+            "ath": 110.0, "ath_date": "2025-01-01T00:00:00.000Z", "last_updated": "2025-06-01T00:00:00.000Z",
+        }
+        self.assertEqual(coin_from_market(row), {
+            "id": "bitcoin", "symbol": "btc", "name": "Bitcoin", "market_cap_rank": 1,
+            "last_updated": "2025-06-01T00:00:00.000Z", "image": {"large": "https://example.com/btc.png"},
+            "market_data": {
+                "current_price": {"usd": 100.0}, "market_cap": {"usd": 2e12}, "ath": {"usd": 110.0},
+                "ath_date": {"usd": "2025-01-01T00:00:00.000Z"}, "market_cap_rank": 1,
+                "price_change_percentage_24h": -1.5, "last_updated": "2025-06-01T00:00:00.000Z",
+            },
+        })
+
+    def test_get_session_is_reused(self):
+        """
+        Test that the pooled session is shared by all tasks of a process.
+        """
+        self.assertIs(get_session(), get_session())
+
+@override_settings(API_RATE_LIMITS={})
+class CoinCacheReadBenchmarkTests(TestCase):
+    """
+    Counts the Redis round trips of a warm CoinCacheView.get against the
+    configured cache (a local Redis instance or stand-in), without the
+    rate limit check.
+    """
+    def setUp(self):
+        cache.clear()
+        self.cached_at = now_ms()
+        self.user = get_user_model().objects.create_user(email="bench@example.com", password="secret123")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def seed_coins(self, start, stop):
+        for i in range(start, stop):
+            coin = Coin.objects.create(name=f"Bench Coin {i}", symbol=f"BC{i}")
+            cache.set(coin_key(coin.slug), make_envelope({"id": coin.slug}, self.cached_at))
+            for days in ALLOWED_DAYS:
+                cache.set(chart_key(coin.slug, days), make_envelope({"prices": [[1, 2]]}, self.cached_at))
+
+    def count_round_trips(self):
+        self.client.get(reverse("coin-cache"))
+        with patch.object(Redis, "execute_command", autospec=True, side_effect=Redis.execute_command) as mock_execute:
+            response = self.client.get(reverse("coin-cache"))
+        self.assertEqual(response.status_code, 200)
+        return mock_execute.call_count, json.loads(response.content)
+
+    def test_round_trips_stay_flat_as_coin_list_grows(self):
+        """
+        Test that the market snapshot is served with a single round trip.
+        """
+        round_trips = []
+        for start, stop in ((0, 5), (5, 50)):
+            self.seed_coins(start, stop)
+            cache.delete(SNAPSHOT_KEY)
+            calls, data = self.count_round_trips()
+            round_trips.append(calls)
+            self.assertEqual(len(data), stop)
+
+        self.assertEqual(round_trips, [1, 1])
+
+    def test_response_contains_charts_and_cached_at(self):
+        """
+        Test that the snapshot returns the same structure as before.
+        """
+        self.seed_coins(0, 1)
+        _, data = self.count_round_trips()
+        entry = data["bench-coin-0"]
+        self.assertEqual(entry["data"], {"id": "bench-coin-0"})
+        self.assertEqual(entry["cached_at"], self.cached_at)
+        self.assertEqual(set(entry["charts"]), {str(days) for days in ALLOWED_DAYS})
+        self.assertEqual(entry["charts"]["7"], {"data": {"prices": [[1, 2]]}, "cached_at": self.cached_at})
+
+class MarketSnapshotTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        Coin.objects.create(name="Bitcoin", symbol="BTC")
+        self.user = get_user_model().objects.create_user(email="snapshot@example.com", password="secret123")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    @patch("caches.tasks.get_session")
+    def test_task_refreshes_snapshot(self, mock_session):
+        """
+        Test that a refresh task updates the snapshot and its ETag.
+        """
+        mock_resp = MagicMock()
+        mock_resp.json.return_value = {"id": "bitcoin", "symbol": "btc"}
+        mock_session.return_value.get.return_value = mock_resp
+
+        first = self.client.get(reverse("coin-cache"))
+        self.assertEqual(json.loads(first.content), {})
+
+        cache_coin_data("bitcoin")
+
+        second = self.client.get(reverse("coin-cache"))
+        self.assertNotEqual(first["ETag"], second["ETag"])
+        entry = json.loads(second.content)["bitcoin"]
+        self.assertEqual(entry["data"], {"id": "bitcoin", "symbol": "btc"})
+        self.assertIsNotNone(entry["cached_at"])
+
+    def test_etag_and_compression(self):
+        """
+        Test conditional requests and gzip delivery of the snapshot.
+        """
+        cache.set(coin_key("bitcoin"), make_envelope({"id": "bitcoin"}))
+        response = self.client.get(reverse("coin-cache"), HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertIn(b'"bitcoin"', gzip.decompress(response.content))
+
+        not_modified = self.client.get(reverse("coin-cache"), HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(not_modified.status_code, 304)
+
+    def test_slow_build_does_not_overwrite_newer_snapshot(self):
+        """
+        Test that a build that read the fragments before a concurrent one
+        does not store its older snapshot over the newer one.
+        """
+        cache.set(coin_key("bitcoin"), make_envelope({"id": "bitcoin", "price": 1}))
+        refresh_coin_snapshots(["bitcoin"])
+        get_many = cache.get_many
+        reads = []
+
+        def read_then_refresh(keys):
+            fragments = get_many(keys)
+            if not reads:
+                reads.append(keys)
+                # a newer price is stored while the slow build is running
+                cache.set(coin_key("bitcoin"), make_envelope({"id": "bitcoin", "price": 2}))
+                refresh_coin_snapshots(["bitcoin"])
+            return fragments
+
+        with patch.object(cache, "get_many", side_effect=read_then_refresh):
+            slow = build_market_snapshot()
+
+        self.assertIn(b'"price":1', gzip.decompress(slow["body"]))
+        response = self.client.get(reverse("coin-cache"))
+        self.assertEqual(json.loads(response.content)["bitcoin"]["data"]["price"], 2)
+
+    @patch("caches.snapshot.refresh_in_background")
+    def test_stale_entries_are_served_and_revalidated_once(self, mock_refresh):
+        """
+        Test that stale entries are returned immediately and refreshed in the background.
+        """
+        cache.set(coin_key("bitcoin"), make_envelope({"id": "bitcoin"}, now_ms() - CACHE_TTL_MS - 1))
+        cache.set(chart_key("bitcoin", 7), make_envelope({"prices": []}))
+
+        for _ in range(3):
+            response = self.client.get(reverse("coin-cache"))
+            self.assertEqual(json.loads(response.content)["bitcoin"]["data"], {"id": "bitcoin"})
+
+        mock_refresh.assert_called_once_with(["coin:bitcoin"])
+
+    @patch("config.celery.app.send_task")
+    def test_refresh_in_background_skips_keys_in_flight(self, mock_send_task):
+        cache.set(lock_key(chart_key("bitcoin", "7")), "running-task")
+
+        dispatched = refresh_in_background(["coin:bitcoin", "coin:ethereum", "chart:bitcoin:7", "chart:bitcoin:30"])
+
+        self.assertEqual(dispatched, 2)
+        sent = [(call.args[0], call.kwargs["args"]) for call in mock_send_task.call_args_list]
+        self.assertEqual(sent, [
+            ("caches.tasks.cache_coin_chart", ["bitcoin", "30"]),
+            ("caches.tasks.cache_coins_markets", [["bitcoin", "ethereum"]]),
+        ])
+
+    @patch("config.celery.app.send_task")
+    def test_entries_cached_before_envelopes_are_refreshed_misses(self, mock_send_task):
+        """
+        Test that raw values cached before entries were wrapped are not served but refreshed.
+        """
+        cache.set(coin_key("bitcoin"), {"id": "bitcoin"})
+        cache.set(chart_key("bitcoin", 7), {"prices": [[1, 2]]})
+
+        response = self.client.get(reverse("coin-cache"))
+        self.assertEqual((response.status_code, json.loads(response.content)), (200, {}))
+        chart = self.client.get(reverse("coin-chart", args=["bitcoin"]), {"days": 7})
+        self.assertEqual(chart.status_code, 404)
+
+        sent = {call.args[0] for call in mock_send_task.call_args_list}
+        self.assertEqual(sent, {"caches.tasks.cache_coin_chart", "caches.tasks.cache_coins_markets"})
+
+    @patch("config.celery.app.send_task", side_effect=ConnectionError("broker down"))
+    def test_failed_dispatch_releases_refresh_locks(self, mock_send_task):
+        with self.assertRaises(ConnectionError):
+            refresh_in_background(["coin:bitcoin", "chart:bitcoin:7"])
+        with self.assertRaises(ConnectionError):
+            refresh_in_background(["coin:bitcoin"])
+
+        self.assertIsNone(cache.get(lock_key(chart_key("bitcoin", "7"))))
+        self.assertIsNone(cache.get(lock_key(coin_key("bitcoin"))))
+
+class AsyncCacheRefreshTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        Coin.objects.create(name="Bitcoin", symbol="BTC")
+        Coin.objects.create(name="Ethereum", symbol="ETH")
+        self.user = get_user_model().objects.create_user(email="async@example.com", password="secret123")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    @patch("caches.views.group")
+    def test_refresh_checks_freshness_without_reading_entries(self, mock_group):
+        """
+        Test that a refresh reads the soft expiry of all keys with one
+        get_many of the stale_at side keys, never the cached entries.
+        """
+        cache_envelopes({
+            coin_key("bitcoin"): make_envelope({"id": "bitcoin"}),
+            chart_key("bitcoin", "1"): make_envelope(encode_chart(make_market_chart(288, 5 * 60 * 1000))),
+        }, timeout=None)
+
+        with patch.object(cache, "get", wraps=cache.get) as mock_get, patch.object(cache, "get_many", wraps=cache.get_many) as mock_get_many:
+            response = self.client.post(reverse("coin-cache") + "?async=true")
+
+        self.assertEqual((response.data["queued"], response.data["skipped"]), (2, 2))
+        read_keys = [call.args[0] for call in mock_get.call_args_list]
+        read_keys += [key for call in mock_get_many.call_args_list for key in call.args[0]]
+        self.assertEqual([key for key in read_keys if key.startswith(("coin:", "chart:"))], [])
+        self.assertEqual(mock_get_many.call_count, 1)
+
+    @patch("caches.views.AsyncResult")
+    @patch("caches.views.group")
+    def test_async_refresh_returns_job_and_reports_progress(self, mock_group, mock_async_result):
+        """
+        Test that an async POST enqueues one group and the job endpoint reports per-task states.
+        """
+        cache_envelopes({chart_key("ethereum", "1"): make_envelope({"prices": []})}, timeout=None)
+
+        response = self.client.post(reverse("coin-cache") + "?async=true")
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data["queued"], 2)
+        self.assertEqual(response.data["skipped"], 1)
+        mock_group.assert_called_once()
+
+        bulk_id = cache.get(lock_key(coin_key("bitcoin")))
+        mock_async_result.side_effect = lambda task_id, app: MagicMock(
+            state="SUCCESS" if task_id == bulk_id else "PENDING", result="ok"
+        )
+
+        status_response = self.client.get(reverse("coin-cache-job", args=[response.data["job_id"]]))
+
+        self.assertEqual(status_response.status_code, 200)
+        self.assertEqual(status_response.data["status"], "running")
+        self.assertEqual(status_response.data["completed"], 1)
+        bulk_task, chart_task = status_response.data["tasks"]
+        self.assertEqual((bulk_task["slugs"], bulk_task["state"]), (["bitcoin", "ethereum"], "SUCCESS"))
+        self.assertEqual((chart_task["slug"], chart_task["days"], chart_task["state"]), ("bitcoin", "1", "PENDING"))
+
+    @patch("caches.views.group")
+    def test_async_refresh_joins_keys_in_flight(self, mock_group):
+        """
+        Test that keys already being refreshed are joined instead of dispatched again.
+        """
+        cache.set(lock_key(chart_key("bitcoin", "1")), "running-task")
+
+        response = self.client.post(reverse("coin-cache") + "?async=true")
+
+        self.assertEqual((response.data["queued"], response.data["joined"]), (2, 1))
+        job = cache.get(job_key(response.data["job_id"]))
+        self.assertIn({"slug": "bitcoin", "kind": "chart", "days": "1", "task_id": "running-task"}, job["tasks"])
+
+    def test_unknown_job_returns_404(self):
+        response = self.client.get(reverse("coin-cache-job", args=["missing"]))
+        self.assertEqual(response.status_code, 404)
+
+class SingleFlightRefreshTests(TestCase):
+    """
+    Runs N parallel refresh requests for the same key against a worker
+    stand-in that executes the real task in a thread.
+    """
+    PARALLEL_REQUESTS = 10
+
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user(email="flight@example.com", password="secret123")
+        self.results = {}
+
+        session_patcher = patch("caches.tasks.get_session")
+        self.mock_session = session_patcher.start()
+        self.addCleanup(session_patcher.stop)
+
+        def slow_upstream(url, params):
+            time.sleep(0.2)
+            return MagicMock(status_code=200, json=MagicMock(return_value={"prices": [[1, 2]]}))
+        self.mock_session.return_value.get.side_effect = slow_upstream
+
+    def send_task(self, name, args, task_id):
+        worker = threading.Thread(target=cache_coin_chart.apply, kwargs={"args": args, "task_id": task_id})
+        worker.start()
+        self.results[task_id] = worker
+        return self.get_result(task_id)
+
+    def get_result(self, task_id, app=None):
+        def get(timeout):
+            while task_id not in self.results:
+                time.sleep(0.01)
+            self.results[task_id].join(timeout)
+        return MagicMock(get=get)
+
+    def test_one_upstream_fetch_per_key(self):
+        barrier = threading.Barrier(self.PARALLEL_REQUESTS)
+        responses = []
+
+        def request():
+            client = APIClient()
+            client.force_authenticate(self.user)
+            barrier.wait()
+            responses.append(client.post(reverse("cache-single-coin", args=["chart", "bitcoin"]) + "?days=7"))
+
+        with patch("caches.views.app.send_task", side_effect=self.send_task), \
+                patch("caches.views.AsyncResult", side_effect=self.get_result):
+            threads = [threading.Thread(target=request) for _ in range(self.PARALLEL_REQUESTS)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        results = [response.data["result"] for response in responses]
+        self.assertEqual(self.mock_session.return_value.get.call_count, 1)
+        self.assertEqual(results.count("bitcoin chart cached successfully"), 1)
+        # late requests may already find the fresh cache instead of the running task
+        self.assertEqual(
+            results.count("bitcoin chart joined running refresh") + results.count("bitcoin chart skipped (cache < 1h old)"),
+            self.PARALLEL_REQUESTS - 1,
+        )
+        self.assertIsNone(cache.get(lock_key(chart_key("bitcoin", "7"))))
+        self.assertEqual(load_chart(cache.get(chart_key("bitcoin", "7"))["data"]), {"prices": [[1, 2]]})
+
+    def test_lock_that_expires_while_joining_is_taken_again(self):
+        """
+        Test that a lock expiring between SET NX and GET is acquired instead
+        of joining a task that was never dispatched.
+        """
+        with patch.object(cache, "add", side_effect=[False, True]) as mock_add, \
+                patch.object(cache, "get", return_value=None):
+            self.assertIsNone(acquire_refresh_lock(chart_key("bitcoin", "7"), "new-task"))
+        self.assertEqual(mock_add.call_count, 2)
+
+@override_settings(ROOT_URLCONF="config.asgi_urls")
+class ASGICacheViewTests(TestCase):
+    """
+    The async coin cache views, as served under ASGI.
+    """
+    def setUp(self):
+        cache.clear()
+        local_tokens.clear()
+        Coin.objects.create(name="Bitcoin", symbol="BTC")
+        Coin.objects.create(name="Ethereum", symbol="ETH")
+        user = get_user_model().objects.create_user(email="asgi@example.com", password="secret123")
+        self.async_client.cookies["auth_token"] = ExpiringToken.objects.create(user=user).key
+
+    async def test_snapshot_is_served_like_the_sync_view(self):
+        cache.set(coin_key("bitcoin"), make_envelope({"id": "bitcoin"}))
+
+        response = await self.async_client.get(reverse("coin-cache"), headers={"accept-encoding": "gzip"})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(json.loads(gzip.decompress(response.content))["bitcoin"]["data"], {"id": "bitcoin"})
+        not_modified = await self.async_client.get(reverse("coin-cache"), headers={"if-none-match": response["ETag"]})
+        self.assertEqual(not_modified.status_code, 304)
+
+    async def test_requests_without_token_are_rejected(self):
+        self.async_client.cookies.clear()
+
+        response = await self.async_client.get(reverse("coin-cache"))
+
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response["WWW-Authenticate"], "Token")
+
+    @override_settings(API_RATE_LIMITS={"user": (15, 60)})
+    async def test_refreshes_are_rate_limited_by_cost(self):
+        with patch("caches.views.app.send_task"), patch("caches.async_views.await_result", AsyncMock()):
+            first = await self.async_client.post(reverse("cache-single-coin", args=["data", "bitcoin"]))
+            second = await self.async_client.post(reverse("cache-single-coin", args=["data", "ethereum"]))
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 429)
+        self.assertGreaterEqual(int(second["Retry-After"]), 1)
+
+    async def test_refresh_waits_for_the_task(self):
+        with patch("caches.views.app.send_task") as mock_send_task, \
+                patch("caches.async_views.await_result", AsyncMock(return_value="ok")) as mock_await:
+            response = await self.async_client.post(reverse("cache-single-coin", args=["chart", "bitcoin"]) + "?days=7")
+            invalid = await self.async_client.post(reverse("cache-single-coin", args=["chart", "bitcoin"]) + "?days=2")
+
+        self.assertEqual(json.loads(response.content), {"result": "bitcoin chart cached successfully"})
+        task_id = mock_send_task.call_args.kwargs["task_id"]
+        mock_await.assert_awaited_once_with(task_id)
+        self.assertEqual(invalid.status_code, 400)
+
+    async def test_refresh_of_all_coins_waits_concurrently(self):
+        async def slow_result(task_id):
+            await asyncio.sleep(0.2)
+
+        with patch("caches.views.app.send_task") as mock_send_task, \
+                patch("caches.async_views.await_result", side_effect=slow_result):
+            start = time.perf_counter()
+            response = await self.async_client.post(reverse("coin-cache"))
+            elapsed = time.perf_counter() - start
+
+        # one bulk task and two chart tasks, waited for at the same time
+        self.assertEqual(mock_send_task.call_count, 3)
+        self.assertLess(elapsed, 0.5)
+        self.assertEqual(json.loads(response.content)["results"], [
+            "bitcoin data cached successfully",
+            "ethereum data cached successfully",
+            "bitcoin chart cached successfully",
+            "ethereum chart cached successfully",
+        ])
+
+    async def test_await_result_polls_the_result_backend(self):
+        def store(task_id, meta):
+            return get_async_redis().set(app.backend.get_key_for_task(task_id), app.backend.encode({**meta, "task_id": task_id}))
+
+        async def finish_later():
+            await asyncio.sleep(0.1)
+            await store("done", {"status": "SUCCESS", "result": "ok", "traceback": None, "children": []})
+
+        with patch("caches.async_views.get_result_redis", side_effect=get_async_redis):
+            await store("failed", {"status": "FAILURE", "traceback": None, "children": [], "result": {
+                "exc_type": "ValueError", "exc_message": ["boom"], "exc_module": "builtins",
+            }})
+            results = await asyncio.gather(await_result("done", timeout=5), finish_later())
+            self.assertEqual(results[0], "ok")
+            with self.assertRaisesRegex(ValueError, "boom"):
+                await await_result("failed")
+            with self.assertRaises(TimeoutError):
+                await await_result("missing", timeout=0.1)
+
+class CoinGeckoRateLimitTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.server = FakeCoinGeckoServer().start()
+        self.addCleanup(self.server.stop)
+        self.settings_override = override_settings(
+            COINGECKO_API_URL=self.server.url, COINGECKO_API_KEY=None,
+            COINGECKO_RATE_LIMIT=6000, COINGECKO_RATE_BURST=100,
+        )
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+    def test_429_is_retried_after_retry_after(self):
+        """
+        Test that a 429 is retried via Celery and the retry succeeds.
+        """
+        self.server.responses.append((429, {"Retry-After": "0"}))
+
+        result = cache_coin_data.apply(args=["bitcoin"]).get()
+
+        self.assertEqual(result, "coin:bitcoin cached successfully")
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(cache.get("coin:bitcoin")["data"]["id"], "bitcoin")
+
+    def test_persistent_server_errors_give_up_after_max_retries(self):
+        """
+        Test that 5xx responses back off until max_retries and then report the error.
+        """
+        self.server.responses.extend([(503, {})] * 10)
+
+        result = cache_coin_chart.apply(args=["bitcoin", "7"]).get()
+
+        self.assertIn("Error caching bitcoin chart 7d", result)
+        self.assertEqual(len(self.server.requests), cache_coin_chart.max_retries + 1)
+
+    def test_client_errors_are_not_retried(self):
+        self.server.responses.append((404, {}))
+        result = cache_coin_data.apply(args=["unknown"]).get()
+        self.assertIn("Error caching unknown", result)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_markets_retry_only_fetches_remaining_pages(self):
+        """
+        Test that a retried bulk task does not refetch pages that were already cached.
+        """
+        self.server.responses.extend([(200, {}), (429, {"Retry-After": "0"})])
+        coin_ids = [f"coin-{i}" for i in range(300)]
+
+        result = cache_coins_markets.apply(args=[coin_ids]).get()
+
+        self.assertEqual(result, "50 coins cached successfully")
+        self.assertEqual([len(params["ids"].split(",")) for _, params in self.server.requests], [250, 50, 50])
+        self.assertIsNotNone(cache.get("coin:coin-0"))
+
+    @override_settings(COINGECKO_RATE_LIMIT=60, COINGECKO_RATE_BURST=3)
+    def test_token_bucket_is_shared_and_limits_bursts(self):
+        """
+        Test that the bucket allows a burst and then reports the wait for the next token.
+        """
+        self.assertEqual([acquire_coingecko_token() for _ in range(3)], [0, 0, 0])
+        wait = acquire_coingecko_token()
+        self.assertGreater(wait, 0)
+        self.assertLessEqual(wait, 1)
+
+    @override_settings(COINGECKO_RATE_LIMIT=60, COINGECKO_RATE_BURST=2)
+    def test_waiters_past_burst_get_increasing_waits(self):
+        """
+        Test that every caller past the burst reserves its own token and
+        waits one refill interval longer than the caller before it.
+        """
+        waits = [acquire_coingecko_token(max_wait=10) for _ in range(6)]
+
+        self.assertEqual(waits[:2], [0, 0])
+        for previous, wait in zip(waits[1:], waits[2:]):
+            self.assertAlmostEqual(wait - previous, 1, delta=0.1)
+
+    @override_settings(COINGECKO_RATE_LIMIT=60, COINGECKO_RATE_BURST=1)
+    def test_waiters_during_pause_are_spread_after_it(self):
+        pause_coingecko_bucket(2)
+        waits = [acquire_coingecko_token(max_wait=10) for _ in range(3)]
+
+        self.assertAlmostEqual(waits[0], 2, delta=0.1)
+        self.assertAlmostEqual(waits[1] - waits[0], 1, delta=0.1)
+        self.assertAlmostEqual(waits[2] - waits[1], 1, delta=0.1)
+
+    @override_settings(COINGECKO_RATE_LIMIT=600, COINGECKO_RATE_BURST=2, COINGECKO_MAX_TOKEN_WAIT=5)
+    def test_concurrent_calls_never_exceed_burst_plus_rate(self):
+        """
+        Test that of concurrent callers, the upstream calls made within t
+        seconds never exceed burst + rate * t.
+        """
+        calls = []
+        session = get_session()
+
+        def get(*args, **kwargs):
+            calls.append(time.monotonic())
+            return session.get(*args, **kwargs)
+
+        barrier = threading.Barrier(8)
+
+        def call():
+            barrier.wait()
+            coingecko_get(cache_coin_data, f"{self.server.url}/coins/bitcoin", {}, [])
+
+        with patch("caches.tasks.get_session", return_value=MagicMock(get=get)):
+            threads = [threading.Thread(target=call) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        calls.sort()
+        self.assertEqual(len(calls), 8)
+        for count, called_at in enumerate(calls, start=1):
+            # 50ms of slack for thread scheduling and the Redis clock
+            self.assertLessEqual(count, 2 + 10 * (called_at - calls[0] + 0.05))
+
+    @override_settings(COINGECKO_RATE_LIMIT=60, COINGECKO_RATE_BURST=1, COINGECKO_MAX_TOKEN_WAIT=0)
+    @patch("celery.canvas.Signature.apply_async", autospec=True)
+    def test_task_is_rescheduled_when_bucket_is_empty(self, mock_apply_async):
+        """
+        Test that a task without a token is rescheduled instead of calling
+        CoinGecko, without using up its retries for upstream errors.
+        """
+        acquire_coingecko_token()
+        cache.set(lock_key(coin_key("bitcoin")), "refresh", timeout=1)
+        result = cache_coin_data.apply(args=["bitcoin"], task_id="refresh", retries=2, headers={TOKEN_WAITS_HEADER: 3})
+
+        self.assertEqual(result.state, "IGNORED")
+        # the lock lasts until the rescheduled run
+        self.assertGreater(cache.ttl(lock_key(coin_key("bitcoin"))), LOCK_LEASE)
+        self.assertEqual(self.server.requests, [])
+        signature = mock_apply_async.call_args.args[0]
+        self.assertEqual(signature.args, ("bitcoin",))
+        self.assertEqual(signature.options["task_id"], "refresh")
+        self.assertEqual(signature.options["retries"], 2)
+        self.assertEqual(signature.options["headers"], {TOKEN_WAITS_HEADER: 4})
+        self.assertGreater(signature.options["countdown"], 0)
+
+    @override_settings(COINGECKO_RATE_LIMIT=60, COINGECKO_RATE_BURST=1, COINGECKO_MAX_TOKEN_WAIT=0)
+    @patch("celery.canvas.Signature.apply_async")
+    def test_token_waits_are_limited(self, mock_apply_async):
+        acquire_coingecko_token()
+        result = cache_coin_data.apply(args=["bitcoin"], headers={TOKEN_WAITS_HEADER: MAX_TOKEN_WAITS}).get()
+
+        self.assertIn("Error caching bitcoin: No CoinGecko token", result)
+        mock_apply_async.assert_not_called()
+
+class PrewarmScheduleTests(TestCase):
+    def setUp(self):
+        Coin.objects.create(name="Bitcoin", symbol="BTC")
+        Coin.objects.create(name="Ethereum", symbol="ETH")
+        Coin.objects.create(name="Dogecoin", symbol="DOGE", is_active=False)
+
+    def test_beat_schedule_covers_data_and_all_chart_ranges(self):
+        schedule = app.conf.beat_schedule
+        chart_days = [entry["args"][0] for entry in schedule.values() if entry["task"] == "caches.tasks.prewarm_coin_charts"]
+        self.assertEqual(sorted(chart_days, key=int), [str(days) for days in ALLOWED_DAYS])
+        self.assertLess(schedule["prewarm-coin-chart-1d"]["schedule"], schedule["prewarm-coin-chart-365d"]["schedule"])
+        self.assertIn("prewarm-coin-data", schedule)
+
+    def test_charts_outlive_their_prewarm_interval(self):
+        """
+        Test that every chart range is kept clearly longer than a delayed
+        prewarm takes to refresh it.
+        """
+        for days, interval in CHART_PREWARM_INTERVALS.items():
+            self.assertGreaterEqual(get_hard_ttl(chart_key("bitcoin", days)), 2 * interval)
+            self.assertGreater(get_hard_ttl(chart_key("bitcoin", days)), interval + get_jitter(interval) + LOCK_LEASE)
+
+        store_coin_cache([("bitcoin", chart_key("bitcoin", 365), encode_chart({"prices": [[1, 2]]}))])
+        self.assertGreater(cache.ttl(chart_key("bitcoin", 365)), CHART_PREWARM_INTERVALS[365] * 1.5)
+
+    @patch("caches.tasks.cache_coin_chart.apply_async")
+    def test_prewarm_charts_spreads_active_coins_over_jitter(self, mock_apply_async):
+        """
+        Test that every active coin is scheduled once with a countdown inside the jitter window.
+        """
+        prewarm_coin_charts("30", 60)
+
+        self.assertEqual(
+            sorted(call.kwargs["args"][0] for call in mock_apply_async.call_args_list),
+            ["bitcoin", "ethereum"],
+        )
+        for call in mock_apply_async.call_args_list:
+            self.assertEqual(call.kwargs["args"][1], "30")
+            self.assertTrue(0 <= call.kwargs["countdown"] <= 60)
+
+    def test_charts_are_stale_after_their_prewarm_interval(self):
+        """
+        Test that a long chart range is not refreshed by reads after 1h,
+        while coin data is.
+        """
+        cache.clear()
+        store_coin_cache([("bitcoin", coin_key("bitcoin"), {"id": "bitcoin"})])
+        store_coin_cache([("bitcoin", chart_key("bitcoin", 365), encode_chart({"prices": [[1, 2]]}))])
+        in_one_hour = now_ms() + CACHE_TTL_MS + 1
+
+        self.assertTrue(is_stale(cache.get(coin_key("bitcoin")), at=in_one_hour))
+        self.assertFalse(is_stale(cache.get(chart_key("bitcoin", 365)), at=in_one_hour))
+        self.assertTrue(is_stale(cache.get(chart_key("bitcoin", 365)), at=in_one_hour + CHART_PREWARM_INTERVALS[365] * 1000))
+
+    @patch("caches.tasks.cache_coin_chart.apply_async", side_effect=ConnectionError("broker down"))
+    @patch("caches.tasks.cache_coins_markets.apply_async", side_effect=ConnectionError("broker down"))
+    def test_prewarm_releases_locks_if_dispatch_fails(self, mock_markets, mock_chart):
+        cache.clear()
+        with self.assertRaises(ConnectionError):
+            prewarm_coin_data(30)
+        with self.assertRaises(ConnectionError):
+            prewarm_coin_charts("30", 60)
+
+        self.assertIsNone(cache.get(lock_key(coin_key("bitcoin"))))
+        self.assertIsNone(cache.get(lock_key(coin_key("ethereum"))))
+        self.assertEqual(cache.keys(lock_key("chart:*")), [])
+
+    @patch("caches.tasks.cache_coins_markets.apply_async")
+    def test_prewarm_data_uses_one_bulk_task(self, mock_apply_async):
+        prewarm_coin_data(30)
+        mock_apply_async.assert_called_once()
+        self.assertEqual(sorted(mock_apply_async.call_args.kwargs["args"][0]), ["bitcoin", "ethereum"])
+
+class ChartCodecTests(TestCase):
+    def test_round_trip(self):
+        chart = make_market_chart(288, 5 * 60 * 1000)
+        self.assertEqual(chart_to_lists(decode_chart(encode_chart(chart))), chart)
+
+    def test_round_trip_with_partial_and_unaligned_series(self):
+        chart = {"prices": [[1, 2.5], [3, 4.5]], "total_volumes": [[2, 7.0]]}
+        self.assertEqual(chart_to_lists(decode_chart(encode_chart(chart))), chart)
+        self.assertEqual(chart_to_lists(decode_chart(encode_chart({}))), {})
+
+    def test_values_are_zero_copy_views(self):
+        timestamps, values = decode_chart(encode_chart(make_market_chart(10, 1000)))["prices"]
+        self.assertEqual((timestamps.dtype, values.dtype), (np.int64, np.float64))
+        self.assertFalse(values.flags.owndata)
+        self.assertFalse(values.flags.writeable)
+
+    def test_load_chart_accepts_legacy_values(self):
+        self.assertEqual(load_chart({"prices": [[1, 2]]}), {"prices": [[1, 2]]})
+
+    def test_smaller_than_pickle(self):
+        """
+        Test that charts of every range encode to less than half the size
+        of the pickled lists stored before.
+        """
+        for points, step_ms in ((288, 5 * 60 * 1000), (720, 60 * 60 * 1000), (366, 24 * 60 * 60 * 1000)):
+            chart = make_market_chart(points, step_ms)
+            encoded = encode_chart(chart)
+
+            self.assertLess(len(encoded), len(pickle.dumps(chart, pickle.HIGHEST_PROTOCOL)) / 2)
+
+class ChartDownsamplingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user(email="chart@example.com", password="secret123")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.chart = make_market_chart(2000, 60 * 60 * 1000)
+
+    def cache_chart(self):
+        with patch("caches.tasks.get_session") as mock_session:
+            mock_session.return_value.get.return_value = MagicMock(status_code=200, json=MagicMock(return_value=self.chart))
+            cache_coin_chart("bitcoin", "365")
+
+    def test_lttb_keeps_endpoints_and_extremes(self):
+        timestamps = np.arange(1000, dtype=np.int64)
+        values = np.sin(timestamps / 50.0)
+        values[500] = 10.0
+
+        indices = lttb_indices(timestamps, values, 50)
+
+        self.assertEqual(len(indices), 50)
+        self.assertEqual((indices[0], indices[-1]), (0, 999))
+        self.assertTrue(np.all(np.diff(indices) > 0))
+        self.assertIn(500, indices)
+
+    def test_downsample_slices_time_range(self):
+        chart = decode_chart(encode_chart({"prices": [[t, float(t)] for t in range(0, 100, 10)]}))
+        result = chart_to_lists(downsample_chart(chart, start=20, end=50))
+        self.assertEqual([t for t, _ in result["prices"]], [20, 30, 40, 50])
+
+    def test_refresh_precomputes_resolutions(self):
+        self.cache_chart()
+        for points in (100, 300, 1000):
+            envelope = cache.get(chart_resolution_key("bitcoin", "365", points))
+            self.assertEqual(len(decode_chart(envelope["data"])["prices"][1]), points)
+
+    def test_refresh_removes_resolutions_of_a_shorter_chart(self):
+        self.cache_chart()
+        self.chart = make_market_chart(500, 60 * 60 * 1000)
+        self.cache_chart()
+
+        self.assertIsNotNone(cache.get(chart_resolution_key("bitcoin", "365", 300)))
+        self.assertIsNone(cache.get(chart_resolution_key("bitcoin", "365", 1000)))
+        response = self.client.get(reverse("coin-chart", args=["bitcoin"]), {"days": 365, "max_points": 1000})
+        self.assertEqual(len(response.data["prices"]), 500)
+
+    def test_endpoint_serves_downsampled_series_from_precomputed_resolution(self):
+        self.cache_chart()
+        cache.delete(chart_key("bitcoin", "365"))
+
+        response = self.client.get(reverse("coin-chart", args=["bitcoin"]), {"days": 365, "max_points": 250})
+
+        self.assertEqual(response.status_code, 200)
+        for name in ("prices", "market_caps", "total_volumes"):
+            self.assertEqual(len(response.data[name]), 250)
+        self.assertEqual(response.data["prices"][0], self.chart["prices"][0])
+
+    def test_endpoint_slices_full_series(self):
+        self.cache_chart()
+        start, end = self.chart["prices"][100][0], self.chart["prices"][199][0]
+
+        response = self.client.get(reverse("coin-chart", args=["bitcoin"]), {"days": 365, "from": start, "to": end})
+
+        self.assertEqual(response.data["prices"], self.chart["prices"][100:200])
+
+    def test_endpoint_validates_params(self):
+        url = reverse("coin-chart", args=["bitcoin"])
+        self.assertEqual(self.client.get(url, {"days": 2}).status_code, 400)
+        self.assertEqual(self.client.get(url, {"max_points": 2}).status_code, 400)
+        self.assertEqual(self.client.get(url, {"from": "yesterday"}).status_code, 400)
+        self.assertEqual(self.client.get(url).status_code, 404)
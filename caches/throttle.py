@@ -0,0 +1,81 @@
+from django.conf import settings
+from django.core.cache import cache
+from django_redis import get_redis_connection
+
+BUCKET_KEY = "coingecko:bucket"
+PAUSE_KEY = "coingecko:paused"
+
+# Refills the bucket based on Redis server time and reserves the requested
+# tokens. The bucket may go negative: every caller is charged and gets the
+# milliseconds until its own token is due, so concurrent waiters are spread
+# out instead of all calling once the same wait ends. While a 429 pause is
+# active, ts is moved to the end of the pause and only one caller's tokens
+# are left for it, so calls resume one by one at the refill rate.
+# If the wait would exceed max_wait, nothing is reserved.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local max_wait = tonumber(ARGV[4])
+
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+if ts < now then
+    tokens = math.min(capacity, tokens + (now - ts) * rate)
+    ts = now
+end
+
+local paused = redis.call('PTTL', KEYS[2])
+if paused > 0 and ts < now + paused then
+    tokens = math.min(tokens, requested)
+    ts = now + paused
+end
+
+tokens = tokens - requested
+local wait = ts - now
+if tokens < 0 then
+    wait = wait + math.ceil(-tokens / rate)
+end
+if wait > max_wait then
+    return wait
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', ts)
+redis.call('PEXPIRE', KEYS[1], wait + math.ceil(capacity / rate) + 1000)
+return wait
+"""
+
+_script = None
+
+def get_script():
+    global _script
+    if _script is None:
+        _script = get_redis_connection("default").register_script(TOKEN_BUCKET_SCRIPT)
+    return _script
+
+def acquire_coingecko_token(tokens: int = 1, max_wait: float = None) -> float:
+    """
+    Reserves tokens from the CoinGecko bucket shared by all workers.
+    Returns the seconds until the reserved tokens are due (0 = call now).
+    A wait above max_wait (default COINGECKO_MAX_TOKEN_WAIT) reserves
+    nothing, the caller has to acquire again later.
+    """
+    if max_wait is None:
+        max_wait = settings.COINGECKO_MAX_TOKEN_WAIT
+    rate_per_ms = settings.COINGECKO_RATE_LIMIT / 60000
+    wait_ms = get_script()(
+        keys=[cache.make_key(BUCKET_KEY), cache.make_key(PAUSE_KEY)],
+        args=[rate_per_ms, settings.COINGECKO_RATE_BURST, tokens, int(max_wait * 1000)],
+    )
+    return int(wait_ms) / 1000
+
+def pause_coingecko_bucket(seconds: float):
+    """
+    Blocks the bucket for all workers, e.g. after a 429 with Retry-After.
+    """
+    if seconds > 0:
+        get_redis_connection("default").set(cache.make_key(PAUSE_KEY), 1, px=int(seconds * 1000))
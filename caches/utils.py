@@ -0,0 +1,240 @@
+import time
+import uuid
+from django.core.cache import cache
+
+from caches.charts import load_chart
+
+ALLOWED_DAYS = [1, 7, 30, 180, 365]
+LOCK_LEASE = 2 * 60  # 2min
+
+# Soft expiry of coin data: entries older than this are still served, but
+# refreshed in the background. Charts use the prewarm interval of their
+# range instead. The hard expiry is the Redis timeout of the entry.
+CACHE_TTL_MS = 60 * 60 * 1000  # 1h
+
+# Bumped whenever coin prices (or the charts of a range) are stored, so
+# values derived from them (portfolio valuations) can tell they are outdated
+PRICE_VERSION_KEY = "coin-prices:version"
+
+def coin_key(slug: str) -> str:
+    return f"coin:{slug}"
+
+def chart_key(slug: str, days) -> str:
+    return f"chart:{slug}:{days}"
+
+def chart_resolution_key(slug: str, days, points: int) -> str:
+    return f"chart:{slug}:{days}:{points}p"
+
+def stale_at_key(redis_key: str) -> str:
+    return f"stale-at:{redis_key}"
+
+def lock_key(redis_key: str) -> str:
+    return f"lock:{redis_key}"
+
+def chart_version_key(days) -> str:
+    return f"chart:version:{days}"
+
+def job_key(job_id: str) -> str:
+    return f"cache-job:{job_id}"
+
+def now_ms() -> int:
+    return int(time.time() * 1000)
+
+def get_soft_ttl_ms(redis_key: str) -> int:
+    """
+    Soft expiry of a key: CACHE_TTL_MS for coin data, the prewarm interval
+    of the range for charts, so reads do not refresh them more often than
+    the beat schedule does.
+    """
+    from config.celery import CHART_PREWARM_INTERVALS
+
+    kind, slug, *days = redis_key.split(":")
+    if kind == "chart":
+        return CHART_PREWARM_INTERVALS[int(days[0])] * 1000
+    return CACHE_TTL_MS
+
+def make_envelope(data, cached_at: int = None, redis_key: str = None) -> dict:
+    """
+    Wraps cached data with its cached_at timestamp and the soft expiry
+    of redis_key (CACHE_TTL_MS if not given).
+    """
+    cached_at = cached_at or now_ms()
+    soft_ttl = get_soft_ttl_ms(redis_key) if redis_key else CACHE_TTL_MS
+    return {"data": data, "cached_at": cached_at, "stale_at": cached_at + soft_ttl}
+
+def is_envelope(value) -> bool:
+    """
+    False for values cached before entries were wrapped in envelopes.
+    """
+    return isinstance(value, dict) and {"data", "cached_at", "stale_at"} <= value.keys()
+
+def is_stale(envelope: dict, at: int = None) -> bool:
+    return (at or now_ms()) >= envelope["stale_at"]
+
+def cache_envelopes(values: dict, timeout: int):
+    """
+    Stores envelopes together with their soft expiry under small side keys,
+    so freshness checks do not have to read the cached data.
+    """
+    side_keys = {stale_at_key(redis_key): envelope["stale_at"] for redis_key, envelope in values.items()}
+    cache.set_many({**values, **side_keys}, timeout=timeout)
+
+def get_fresh_keys(redis_keys) -> set:
+    """
+    Returns the keys that have not passed their soft expiry, reading only
+    their stale_at side keys with a single get_many call.
+    """
+    redis_keys = list(redis_keys)
+    stale_at = cache.get_many([stale_at_key(redis_key) for redis_key in redis_keys])
+    now = now_ms()
+    return {redis_key for redis_key in redis_keys if stale_at.get(stale_at_key(redis_key), 0) > now}
+
+def bump_version(version_key: str):
+    try:
+        cache.incr(version_key)
+    except ValueError:
+        cache.add(version_key, 1, timeout=None)
+
+def get_current_price(data: dict):
+    """
+    USD price of cached coin data (/coins/<id> shape).
+    """
+    return data.get("market_data", {}).get("current_price", {}).get("usd")
+
+def acquire_refresh_lock(redis_key: str, task_id: str, lease: float = LOCK_LEASE):
+    """
+    Single-flight lock (SET NX with a lease) for refreshing redis_key.
+    The lock holds the id of the refreshing task. Returns None if the
+    lock was acquired, otherwise the id of the task already in flight.
+    """
+    while True:
+        if cache.add(lock_key(redis_key), task_id, timeout=lease):
+            return None
+        running_id = cache.get(lock_key(redis_key))
+        if running_id:
+            return running_id
+        # the lock expired in between, try to take it again
+
+def renew_refresh_locks(redis_keys, task_id: str, lease: float):
+    """
+    Extends the locks of the given keys that are still held by task_id,
+    e.g. before the task is rescheduled.
+    """
+    if not task_id:
+        return
+    keys = [lock_key(redis_key) for redis_key in redis_keys]
+    owned = [key for key, value in cache.get_many(keys).items() if value == task_id]
+    if owned:
+        cache.set_many({key: task_id for key in owned}, timeout=lease)
+
+def release_refresh_locks(redis_keys, task_id: str):
+    """
+    Releases the locks of the given keys that are still held by task_id.
+    """
+    if not task_id:
+        return
+    keys = [lock_key(redis_key) for redis_key in redis_keys]
+    owned = [key for key, value in cache.get_many(keys).items() if value == task_id]
+    if owned:
+        cache.delete_many(owned)
+
+def refresh_in_background(redis_keys) -> int:
+    """
+    Dispatches refresh tasks for stale coin and chart keys without waiting.
+    Keys that are already being refreshed are skipped; all coin keys are
+    refreshed by one bulk task. Returns the number of dispatched tasks.
+    """
+    from config.celery import app
+
+    bulk_id = str(uuid.uuid4())
+    bulk_slugs = []
+    dispatched = 0
+
+    try:
+        for redis_key in redis_keys:
+            kind, slug, *days = redis_key.split(":")
+            if kind == "coin":
+                if not acquire_refresh_lock(redis_key, bulk_id):
+                    bulk_slugs.append(slug)
+            elif kind == "chart":
+                task_id = str(uuid.uuid4())
+                if not acquire_refresh_lock(redis_key, task_id):
+                    send_refresh_task(app, "caches.tasks.cache_coin_chart", [slug, days[0]], task_id, [redis_key])
+                    dispatched += 1
+    except Exception:
+        release_refresh_locks([coin_key(slug) for slug in bulk_slugs], bulk_id)
+        raise
+
+    if bulk_slugs:
+        send_refresh_task(app, "caches.tasks.cache_coins_markets", [bulk_slugs], bulk_id, [coin_key(slug) for slug in bulk_slugs])
+        dispatched += 1
+
+    return dispatched
+
+def send_refresh_task(app, task_name: str, args: list, task_id: str, redis_keys: list):
+    """
+    Dispatches a task that holds the refresh locks of redis_keys, which
+    are released right away if it cannot be dispatched.
+    """
+    try:
+        app.send_task(task_name, args=args, task_id=task_id)
+    except Exception:
+        release_refresh_locks(redis_keys, task_id)
+        raise
+
+def get_coin_cache_keys(slugs) -> list:
+    """
+    Returns every Redis key that belongs to the given coins:
+    coin data and all chart ranges.
+    """
+    keys = []
+    for slug in slugs:
+        keys.append(coin_key(slug))
+        for days in ALLOWED_DAYS:
+            keys.append(chart_key(slug, days))
+    return keys
+
+def get_coin_cache_entries(slugs) -> tuple:
+    """
+    Reads the cached data and charts of all given coins with a single
+    get_many call (one MGET round trip to Redis).
+    Coins without cached data are left out of the result. Values cached
+    before entries were wrapped in envelopes count as missing and are
+    refreshed in the background.
+    Returns the entries and the soft expiry (stale_at) of every key read.
+    """
+    slugs = list(slugs)
+    values = cache.get_many(get_coin_cache_keys(slugs))
+
+    legacy = [redis_key for redis_key, value in values.items() if not is_envelope(value)]
+    if legacy:
+        for redis_key in legacy:
+            del values[redis_key]
+        try:
+            refresh_in_background(legacy)
+        except Exception:
+            pass
+
+    results = {}
+    for slug in slugs:
+        cached_data = values.get(coin_key(slug))
+        if not cached_data:
+            continue
+
+        cached_charts = {}
+        for days in ALLOWED_DAYS:
+            chart_data = values.get(chart_key(slug, days))
+            if chart_data:
+                cached_charts[str(days)] = {
+                    "data": load_chart(chart_data["data"]),
+                    "cached_at": chart_data["cached_at"],
+                }
+
+        results[slug] = {
+            "data": cached_data["data"],
+            "charts": cached_charts,
+            "cached_at": cached_data["cached_at"],
+        }
+
+    stale_at = {redis_key: envelope["stale_at"] for redis_key, envelope in values.items()}
+    return results, stale_at
@@ -1,101 +1,291 @@
+import gzip
+import uuid
+from celery import group
+from celery.result import AsyncResult
+from celery.states import READY_STATES
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
+from django.http import HttpResponse
 from rest_framework.permissions import IsAuthenticated
 from django.core.cache import cache
-from django.utils.timezone import now
 
 from config.celery import app
+from config.metrics import RequestMetricsMixin, timed
 from coins.models import Coin
+from caches.snapshot import get_market_snapshot
+from caches.charts import RESOLUTIONS, chart_to_lists, downsample_chart, load_series
+from caches.utils import ALLOWED_DAYS, acquire_refresh_lock, chart_key, chart_resolution_key, coin_key, get_fresh_keys, is_envelope, is_stale, job_key, refresh_in_background, release_refresh_locks
 
-CACHE_TTL_MS = 60 * 60 * 1000  # 1h
+JOB_TTL = 60 * 60  # 1h
 
 TASKS = {
     "data": "caches.tasks.cache_coin_data",
     "chart": "caches.tasks.cache_coin_chart",
 }
 
-class CoinCacheBase(APIView):
+BULK_TASK = "caches.tasks.cache_coins_markets"
+
+def snapshot_response(request, snapshot: dict) -> HttpResponse:
     """
-    Helper function: Start task and return result
+    Serve the pre-encoded market snapshot as is.
     """
-    permission_classes = [IsAuthenticated]
+    if request.headers.get("If-None-Match") == snapshot["etag"]:
+        response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+        response["ETag"] = snapshot["etag"]
+        return response
 
-    def run_task(self, slug: str, kind: str, args: list):
+    body = snapshot["body"]
+    response = HttpResponse(content_type="application/json")
+    if snapshot["encoding"] == "gzip":
+        if "gzip" in request.headers.get("Accept-Encoding", ""):
+            response["Content-Encoding"] = "gzip"
+        else:
+            body = gzip.decompress(body)
+    response.content = body
+    response["ETag"] = snapshot["etag"]
+    response["Vary"] = "Accept-Encoding"
+    return response
+
+class CoinCacheRefreshMixin:
+    """
+    Starting refreshes, without waiting for them. Shared by the coin cache
+    views and their async variants (caches.async_views).
+    """
+    ALLOWED_DAYS = ALLOWED_DAYS
+    DEFAULT_DAYS = 1
+
+    def get_redis_key(self, slug: str, kind: str, args: list) -> str:
+        if kind == "chart" and len(args) > 1:
+            return chart_key(slug, args[1])
+        return coin_key(slug)
+
+    def is_fresh(self, redis_key: str) -> bool:
+        """
+        True if the cached entry has not passed its soft expiry (1 hour).
+        """
+        return redis_key in get_fresh_keys([redis_key])
+
+    def is_async(self, request) -> bool:
+        return request.GET.get("async", "").lower() in ("1", "true", "yes")
+
+    def get_task_args(self, request, kind: str, slug: str) -> tuple:
+        """
+        Task arguments of a single coin refresh and an error message,
+        one of them None.
+        """
+        if kind not in TASKS:
+            return None, "Invalid kind. Use 'data' or 'chart'."
+
+        args_list = [slug]
+        if kind == "chart":
+            days = request.GET.get("days", str(self.DEFAULT_DAYS))
+            try:
+                days = int(days)
+            except ValueError:
+                return None, "Invalid 'days' parameter"
+
+            if days not in self.ALLOWED_DAYS:
+                return None, f"Invalid 'days'. Allowed: {self.ALLOWED_DAYS}"
+            args_list.append(str(days))
+        return args_list, None
+
+    def start_task(self, slug: str, kind: str, args: list) -> tuple:
+        """
+        Start a Celery task, which stores the data in Redis wrapped with
+        its cached_at timestamp and soft expiry.
+        Skip execution if the cache is less than 1 hour old and join
+        the running task if the same key is already being refreshed.
+        Returns the result message and the id of the task to wait for.
+        """
+        redis_key = self.get_redis_key(slug, kind, args)
+        if self.is_fresh(redis_key):
+            return f"{slug} {kind} skipped (cache < 1h old)", None
+
+        task_id = str(uuid.uuid4())
+        running_id = acquire_refresh_lock(redis_key, task_id)
+        if running_id:
+            return f"{slug} {kind} joined running refresh", running_id
+
+        self.send_task(TASKS[kind], args, task_id, [redis_key])
+        return f"{slug} {kind} cached successfully", task_id
+
+    def send_task(self, task_name: str, args: list, task_id: str, redis_keys: list):
         """
-        Run a Celery task and store cached_at timestamp in Redis.
-        Skip execution if the cache is less than 1 hour old.
-        For chart data, the cached_at key follows the pattern:
-        "chart:<slug>:<days>:cached_at"
+        Dispatch a task that holds the refresh locks of redis_keys.
+        The task releases the locks when it is done; if it cannot be
+        dispatched they are released right away.
         """
         try:
-            if kind == "chart" and len(args) > 1:
-                days = args[1]
-                cached_at_key = f"chart:{slug}:{days}:cached_at"
+            return app.send_task(task_name, args=args, task_id=task_id)
+        except Exception:
+            release_refresh_locks(redis_keys, task_id)
+            raise
+
+    def lock_bulk_slugs(self, slugs: list, task_id: str):
+        """
+        Acquire the refresh locks of all coins for one bulk task.
+        Returns the locked slugs and the slugs already in flight,
+        grouped by the id of their running task.
+        """
+        locked, running = [], {}
+        for slug in slugs:
+            running_id = acquire_refresh_lock(coin_key(slug), task_id)
+            if running_id:
+                running.setdefault(running_id, []).append(slug)
             else:
-                cached_at_key = f"coin:{slug}:cached_at"
+                locked.append(slug)
+        return locked, running
+
+    def start_bulk_task(self, slugs: list) -> tuple:
+        """
+        Start the refresh of the data of many coins with a single bulk
+        task. Skip coins whose cache is less than 1 hour old and join
+        running refreshes of the others.
+        Returns the results so far and the tasks to wait for, as
+        (task id, slugs, result message once it is done).
+        """
+        fresh = get_fresh_keys(coin_key(slug) for slug in slugs)
+        stale = [slug for slug in slugs if coin_key(slug) not in fresh]
+        results = [f"{slug} data skipped (cache < 1h old)" for slug in slugs if slug not in stale]
+        pending = []
+
+        task_id = str(uuid.uuid4())
+        locked, running = self.lock_bulk_slugs(stale, task_id)
+
+        if locked:
+            try:
+                self.send_task(BULK_TASK, [locked], task_id, [coin_key(slug) for slug in locked])
+                pending.append((task_id, locked, "cached successfully"))
+            except Exception as e:
+                results += [f"{slug} data failed: {str(e)}" for slug in locked]
+
+        for running_id, running_slugs in running.items():
+            pending.append((running_id, running_slugs, "joined running refresh"))
+        return results, pending
+
+    def enqueue_tasks(self, jobs: list, bulk_slugs=None) -> dict:
+        """
+        Dispatch all (slug, kind, args) jobs as one Celery group without
+        waiting for them. The data of all bulk_slugs is fetched by a single
+        bulk task. Keys that are already being refreshed are reported with
+        the running task instead of being dispatched again.
+        Returns the job id for the status endpoint and the task counts.
+        """
+        job_id = str(uuid.uuid4())
+        tasks, skipped, signatures, locked_keys = [], [], [], []
+        bulk_slugs = bulk_slugs or []
+        fresh = get_fresh_keys(
+            [coin_key(slug) for slug in bulk_slugs] + [self.get_redis_key(slug, kind, args) for slug, kind, args in jobs]
+        )
+
+        if bulk_slugs:
+            stale = []
+            for slug in bulk_slugs:
+                if coin_key(slug) in fresh:
+                    skipped.append({"slug": slug, "kind": "data", "days": None})
+                else:
+                    stale.append(slug)
+
+            task_id = str(uuid.uuid4())
+            locked, running = self.lock_bulk_slugs(stale, task_id)
+            locked_keys += [coin_key(slug) for slug in locked]
+            if locked:
+                tasks.append({"slugs": locked, "kind": "data", "days": None, "task_id": task_id})
+                signatures.append(app.signature(BULK_TASK, args=[locked]).set(task_id=task_id))
+            for running_id, running_slugs in running.items():
+                tasks.append({"slugs": running_slugs, "kind": "data", "days": None, "task_id": running_id})
+
+        for slug, kind, args in jobs:
+            entry = {"slug": slug, "kind": kind, "days": args[1] if kind == "chart" else None}
+            redis_key = self.get_redis_key(slug, kind, args)
+            if redis_key in fresh:
+                skipped.append(entry)
+                continue
+
+            task_id = str(uuid.uuid4())
+            entry["task_id"] = acquire_refresh_lock(redis_key, task_id) or task_id
+            tasks.append(entry)
+            if entry["task_id"] == task_id:
+                locked_keys.append(redis_key)
+                signatures.append(app.signature(TASKS[kind], args=args).set(task_id=task_id))
+
+        if signatures:
+            try:
+                group(signatures).apply_async()
+            except Exception:
+                for signature in signatures:
+                    release_refresh_locks(locked_keys, signature.id)
+                raise
 
-            cached_at = cache.get(cached_at_key)
-            if cached_at:
-                now_ms = int(now().timestamp() * 1000)
-                if now_ms - cached_at < CACHE_TTL_MS:
-                    return f"{slug} {kind} skipped (cache < 1h old)"
+        cache.set(job_key(job_id), {"tasks": tasks, "skipped": skipped}, timeout=JOB_TTL)
 
-            task_name = TASKS[kind]
-            task = app.send_task(task_name, args=args)
-            task.get(timeout=30)
+        return {
+            "job_id": job_id,
+            "queued": len(signatures),
+            "joined": len(tasks) - len(signatures),
+            "skipped": len(skipped),
+        }
 
-            new_cached_at = int(now().timestamp() * 1000)
-            cache.set(cached_at_key, new_cached_at, None)
+class CoinCacheBase(RequestMetricsMixin, CoinCacheRefreshMixin, APIView):
+    """
+    Helper function: Start task and return result
+    """
+    permission_classes = [IsAuthenticated]
 
-            return f"{slug} {kind} cached successfully"
+    def run_task(self, slug: str, kind: str, args: list):
+        """
+        Run a Celery task (see start_task) and wait for it.
+        """
+        try:
+            message, task_id = self.start_task(slug, kind, args)
+            if task_id:
+                with timed("celery"):
+                    AsyncResult(task_id, app=app).get(timeout=30)
+            return message
         except Exception as e:
             return f"{slug} {kind} failed: {str(e)}"
 
+    def run_bulk_task(self, slugs: list) -> list:
+        """
+        Refresh the data of many coins with a single bulk task
+        (see start_bulk_task) and wait for it.
+        """
+        results, pending = self.start_bulk_task(slugs)
+        for task_id, task_slugs, message in pending:
+            try:
+                with timed("celery"):
+                    AsyncResult(task_id, app=app).get(timeout=30)
+                results += [f"{slug} data {message}" for slug in task_slugs]
+            except Exception as e:
+                results += [f"{slug} data failed: {str(e)}" for slug in task_slugs]
+        return results
+
 class CoinCacheView(CoinCacheBase):
     """
     GET: return cached coin data for all active coins
-    POST: refresh all active coins (data + chart 1d)
+    POST: refresh all active coins (data in bulk + chart 1d)
+    Optional query param: ?async=true to return a job id immediately
     """
     permission_classes = [IsAuthenticated]
+    # a refresh of all coins counts like 50 requests
+    throttle_costs = {"POST": 50}
 
     def get(self, request):
-        coins = Coin.objects.filter(is_active=True)
-        results = {}
-
-        chart_days = [1, 7, 30, 180, 365]
-
-        for coin in coins:
-            redis_key = f"coin:{coin.slug}"
-            cached_data = cache.get(redis_key)
-            if cached_data:
-                cached_at = cache.get(f"coin:{coin.slug}:cached_at")
-
-                cached_charts = {}
-                for days in chart_days:
-                    chart_key = f"chart:{coin.slug}:{days}"
-                    chart_data = cache.get(chart_key)
-                    if chart_data:
-                        chart_cached_at = cache.get(f"chart:{coin.slug}:{days}:cached_at")
-                        cached_charts[str(days)] = {
-                            "data": chart_data,
-                            "cached_at": chart_cached_at,
-                        }
-
-                results[coin.slug] = {
-                    "data": cached_data,
-                    "charts": cached_charts,
-                    "cached_at": cached_at,
-                }
-
-        return Response(results, status=status.HTTP_200_OK)
+        return snapshot_response(request, get_market_snapshot())
 
     def post(self, request):
         coins = Coin.objects.filter(is_active=True)
-        results = []
-        for coin in coins:
-            results.append(self.run_task(coin.slug, "data", [coin.slug]))
-            results.append(self.run_task(coin.slug, "chart", [coin.slug, "1"]))
+
+        slugs = [coin.slug for coin in coins]
+
+        if self.is_async(request):
+            jobs = [(slug, "chart", [slug, "1"]) for slug in slugs]
+            return Response(self.enqueue_tasks(jobs, bulk_slugs=slugs), status=status.HTTP_202_ACCEPTED)
+
+        results = self.run_bulk_task(slugs)
+        for slug in slugs:
+            results.append(self.run_task(slug, "chart", [slug, "1"]))
         return Response({"results": results}, status=status.HTTP_200_OK)
 
 class SingleCoinCacheView(CoinCacheBase):
@@ -104,34 +294,123 @@ class SingleCoinCacheView(CoinCacheBase):
     URL: /api/coins/cache/<kind>/<slug>
     Optional query param (for chart): ?days=7
     Allowed: 1, 7, 30, 180, 365
+    Optional query param: ?async=true to return a job id immediately
     """
-    ALLOWED_DAYS = [1, 7, 30, 180, 365]
-    DEFAULT_DAYS = 1
+    throttle_costs = {"POST": 10}
 
     def post(self, request, *args, **kwargs):
         kind = kwargs.get("kind")
         slug = kwargs.get("slug")
 
-        if kind not in TASKS:
-            return Response(
-                {"error": "Invalid kind. Use 'data' or 'chart'."},
-                status=status.HTTP_400_BAD_REQUEST,
-            )
+        args_list, error = self.get_task_args(request, kind, slug)
+        if error:
+            return Response({"error": error}, status=status.HTTP_400_BAD_REQUEST)
 
-        args_list = [slug]
-        if kind == "chart":
-            days = request.query_params.get("days", str(self.DEFAULT_DAYS))
+        if self.is_async(request):
+            return Response(self.enqueue_tasks([(slug, kind, args_list)]), status=status.HTTP_202_ACCEPTED)
+
+        result = self.run_task(slug, kind, args_list)
+        return Response({"result": result}, status=200)
+
+class CoinCacheJobView(RequestMetricsMixin, APIView):
+    """
+    Report the progress of an asynchronous cache refresh.
+    URL: /api/coins/cache/jobs/<job_id>
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, job_id):
+        job = cache.get(job_key(job_id))
+        if job is None:
+            return Response({"detail": "Job not found."}, status=status.HTTP_404_NOT_FOUND)
+
+        tasks = []
+        for entry in job["tasks"]:
+            result = AsyncResult(entry["task_id"], app=app)
+            state = result.state
+            tasks.append({
+                **entry,
+                "state": state,
+                "result": str(result.result) if state in READY_STATES else None,
+            })
+
+        completed = sum(1 for task in tasks if task["state"] in READY_STATES)
+
+        return Response({
+            "job_id": job_id,
+            "status": "finished" if completed == len(tasks) else "running",
+            "total": len(tasks),
+            "completed": completed,
+            "tasks": tasks,
+            "skipped": job["skipped"],
+        }, status=status.HTTP_200_OK)
+
+class CoinChartView(RequestMetricsMixin, APIView):
+    """
+    Return a coin's cached chart, sliced and downsampled on the server.
+    URL: /api/coins/chart/<slug>
+    Optional query params: ?days=7 (allowed: 1, 7, 30, 180, 365),
+    from / to (timestamps in ms), max_points (3 - 5000)
+    """
+    permission_classes = [IsAuthenticated]
+    DEFAULT_DAYS = 1
+    MAX_POINTS_LIMIT = 5000
+
+    def parse_int(self, request, name):
+        value = request.query_params.get(name)
+        if value in (None, ""):
+            return None
+        return int(value)
+
+    def get_redis_key(self, slug: str, days: int, max_points, ranged: bool) -> str:
+        """
+        Use the smallest precomputed resolution that still has enough points.
+        Time ranges are always cut from the full series.
+        """
+        if max_points is not None and not ranged:
+            for points in RESOLUTIONS:
+                if points >= max_points:
+                    return chart_resolution_key(slug, days, points)
+        return chart_key(slug, days)
+
+    def get(self, request, slug):
+        try:
+            days = self.parse_int(request, "days") or self.DEFAULT_DAYS
+            start = self.parse_int(request, "from")
+            end = self.parse_int(request, "to")
+            max_points = self.parse_int(request, "max_points")
+        except ValueError:
+            return Response({"error": "Invalid 'days', 'from', 'to' or 'max_points' parameter"}, status=400)
+
+        if days not in ALLOWED_DAYS:
+            return Response({"error": f"Invalid 'days'. Allowed: {ALLOWED_DAYS}"}, status=400)
+        if max_points is not None and not 3 <= max_points <= self.MAX_POINTS_LIMIT:
+            return Response({"error": f"Invalid 'max_points'. Allowed: 3 - {self.MAX_POINTS_LIMIT}"}, status=400)
+
+        redis_key = self.get_redis_key(slug, days, max_points, start is not None or end is not None)
+        envelope = cache.get(redis_key)
+        if not is_envelope(envelope) and redis_key != chart_key(slug, days):
+            envelope = cache.get(chart_key(slug, days))
+        if not is_envelope(envelope):
+            if envelope is not None:
+                # cached before entries were wrapped in envelopes
+                try:
+                    refresh_in_background([chart_key(slug, days)])
+                except Exception:
+                    pass
+            return Response({"detail": "Chart not cached."}, status=status.HTTP_404_NOT_FOUND)
+
+        if is_stale(envelope):
             try:
-                days = int(days)
-            except ValueError:
-                return Response({"error": "Invalid 'days' parameter"}, status=400)
+                refresh_in_background([chart_key(slug, days)])
+            except Exception:
+                pass
 
-            if days not in self.ALLOWED_DAYS:
-                return Response(
-                    {"error": f"Invalid 'days'. Allowed: {self.ALLOWED_DAYS}"},
-                    status=400,
-                )
-            args_list.append(str(days))
+        chart = downsample_chart(load_series(envelope["data"]), max_points, start, end)
 
-        result = self.run_task(slug, kind, args_list)
-        return Response({"result": result}, status=200)
\ No newline at end of file
+        return Response({
+            "slug": slug,
+            "days": days,
+            "cached_at": envelope["cached_at"],
+            **chart_to_lists(chart),
+        }, status=status.HTTP_200_OK)
\ No newline at end of file
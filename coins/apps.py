@@ -8,6 +8,7 @@ class CoinsConfig(AppConfig):
     name = 'coins'
     
     def ready(self):
+        import coins.signals
         from coins.models import Coin
 
         def import_coins(sender, **kwargs):
@@ -0,0 +1,216 @@
+import codecs
+import csv
+import json
+from decimal import Decimal, InvalidOperation
+from django.core.exceptions import ValidationError
+from django.core.validators import DecimalValidator
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from coins.models import Coin, CoinHolding, CoinTransaction
+
+FORMATS = ("csv", "json", "ndjson")
+COLUMNS = ("coin", "transaction_type", "amount", "price_per_coin", "created_at")
+MAX_IMPORT_ROWS = 100_000
+BATCH_SIZE = 1000
+
+def get_format(name: str = "", content_type: str = "") -> str:
+    """
+    Guesses the import format from a file name or content type.
+    """
+    if name.endswith(".csv") or "csv" in content_type:
+        return "csv"
+    if name.endswith((".ndjson", ".jsonl")) or "ndjson" in content_type:
+        return "ndjson"
+    if name.endswith(".json") or "json" in content_type:
+        return "json"
+    return None
+
+def read_rows(stream, fmt: str):
+    """
+    Yields the rows of a binary CSV, JSON array or NDJSON stream as dicts.
+    CSV and NDJSON are read line by line.
+    """
+    text = codecs.getreader("utf-8")(stream)
+    if fmt == "csv":
+        yield from csv.DictReader(text)
+    elif fmt == "ndjson":
+        for line in text:
+            if line.strip():
+                yield json.loads(line)
+    elif fmt == "json":
+        rows = json.load(text)
+        if not isinstance(rows, list):
+            raise ValidationError("Expected a JSON array of transactions.")
+        yield from rows
+    else:
+        raise ValidationError(f"Unsupported format, expected one of {', '.join(FORMATS)}.")
+
+def load_columns(rows) -> dict:
+    """
+    Reads the rows into one list per column.
+    """
+    columns = {name: [] for name in COLUMNS}
+    try:
+        for number, row in enumerate(rows, start=1):
+            if number > MAX_IMPORT_ROWS:
+                raise ValidationError(f"Too many rows, at most {MAX_IMPORT_ROWS} per import.")
+            if not isinstance(row, dict):
+                raise ValidationError(f"Row {number}: expected an object.")
+            for name in COLUMNS:
+                value = row.get(name)
+                columns[name].append(value.strip() if isinstance(value, str) else value)
+    except (UnicodeDecodeError, csv.Error, json.JSONDecodeError) as e:
+        raise ValidationError(f"Could not read import: {e}")
+    return columns
+
+def parse_decimals(values, name: str, errors: list) -> list:
+    validator = DecimalValidator(max_digits=20, decimal_places=8)
+    parsed = []
+    for number, value in enumerate(values, start=1):
+        try:
+            decimal = Decimal(str(value))
+            validator(decimal)
+            if not decimal > 0:
+                raise ValidationError("must be greater than zero")
+        except (InvalidOperation, ValidationError):
+            errors.append(f"Row {number}: invalid {name} {value!r}.")
+            decimal = Decimal("0")
+        parsed.append(decimal)
+    return parsed
+
+def parse_timestamps(values, errors: list) -> list:
+    now = timezone.now()
+    parsed = []
+    for number, value in enumerate(values, start=1):
+        try:
+            timestamp = parse_datetime(str(value)) if value else now
+        except ValueError:
+            # well-formed, but not a real date or time
+            timestamp = None
+        if timestamp and timezone.is_naive(timestamp):
+            timestamp = timezone.make_aware(timestamp)
+        if timestamp is None or timestamp > now:
+            errors.append(f"Row {number}: invalid created_at {value!r}.")
+            timestamp = now
+        parsed.append(timestamp)
+    return parsed
+
+def validate_columns(columns: dict) -> dict:
+    """
+    Validates and converts all rows column by column. Coins are resolved
+    by slug or symbol from one query. Raises ValidationError with one
+    message per invalid row.
+    """
+    errors = []
+    coins = {}
+    for coin in Coin.objects.filter(is_active=True):
+        coins[coin.symbol.upper()] = coin
+        if coin.slug:
+            coins[coin.slug.lower()] = coin
+
+    resolved = []
+    for number, value in enumerate(columns["coin"], start=1):
+        key = str(value or "")
+        coin = coins.get(key.lower()) or coins.get(key.upper())
+        if coin is None:
+            errors.append(f"Row {number}: unknown coin {value!r}.")
+        resolved.append(coin)
+
+    types = [str(value or "").lower() for value in columns["transaction_type"]]
+    valid_types = dict(CoinTransaction.TRANSACTION_TYPES)
+    errors += [
+        f"Row {number}: invalid transaction_type {value!r}."
+        for number, value in enumerate(types, start=1) if value not in valid_types
+    ]
+
+    records = {
+        "coin": resolved,
+        "transaction_type": types,
+        "amount": parse_decimals(columns["amount"], "amount", errors),
+        "price_per_coin": parse_decimals(columns["price_per_coin"], "price_per_coin", errors),
+        "created_at": parse_timestamps(columns["created_at"], errors),
+    }
+    if errors:
+        raise ValidationError(errors)
+    return records
+
+def check_sufficiency(user, records: dict):
+    """
+    Replays the imported rows together with the user's existing transactions
+    in chronological order and rejects the import if any sell exceeds the
+    holding at its time. Keeps one exact running sum (Decimal) per coin.
+    """
+    errors = []
+    coins = {coin.pk: coin for coin in records["coin"]}
+    existing = CoinTransaction.objects.filter(user=user, coin__in=coins).values_list(
+        "coin_id", "transaction_type", "amount", "created_at",
+    )
+
+    events = {coin_id: [] for coin_id in coins}
+    for coin_id, transaction_type, amount, created_at in existing:
+        events[coin_id].append((created_at, -1, transaction_type, amount))
+    for index, (coin, transaction_type, amount, created_at) in enumerate(zip(
+        records["coin"], records["transaction_type"], records["amount"], records["created_at"],
+    )):
+        events[coin.pk].append((created_at, index, transaction_type, amount))
+
+    for coin_id, coin_events in events.items():
+        # existing transactions sort before imported ones at the same time
+        coin_events.sort(key=lambda event: (event[0], event[1]))
+        balance = Decimal("0")
+        for created_at, index, transaction_type, amount in coin_events:
+            balance += amount if transaction_type == "buy" else -amount
+            if balance >= 0:
+                continue
+            if index < 0:
+                errors.append(f"{coins[coin_id].symbol}: the existing sell at {created_at.isoformat()} would exceed the holding.")
+            else:
+                errors.append(
+                    f"Row {index + 1}: Not enough stock: You only have {balance + amount:.8f} "
+                    f"{coins[coin_id].symbol}, but would like to sell {amount:.8f}."
+                )
+            break
+
+    if errors:
+        raise ValidationError(errors)
+
+def import_transactions(user, rows) -> dict:
+    """
+    Imports coin transactions for a user from an iterable of row dicts with
+    the keys coin, transaction_type, amount, price_per_coin and optional
+    created_at (ISO 8601). Either all rows are imported or, if any row is
+    invalid, none (ValidationError). Rows are inserted in batches and every
+    affected holding is rebuilt once. The wallet is not changed.
+    """
+    records = validate_columns(load_columns(rows))
+    count = len(records["coin"])
+    if not count:
+        raise ValidationError("The import contains no transactions.")
+
+    coins = {coin.pk: coin for coin in records["coin"]}
+    with transaction.atomic():
+        # holds off live trades of this user in the imported coins
+        for coin in coins.values():
+            CoinHolding.objects.select_for_update().get_or_create(user=user, coin=coin)
+
+        check_sufficiency(user, records)
+        CoinTransaction.objects.bulk_create(
+            (
+                CoinTransaction(
+                    user=user,
+                    coin=coin,
+                    transaction_type=transaction_type,
+                    amount=amount,
+                    price_per_coin=price_per_coin,
+                    created_at=created_at,
+                )
+                for coin, transaction_type, amount, price_per_coin, created_at in zip(*records.values())
+            ),
+            batch_size=BATCH_SIZE,
+        )
+        for coin in coins.values():
+            CoinTransaction.update_user_holding(user, coin)
+
+    return {"imported": count, "coins": sorted(coin.slug for coin in coins.values())}
@@ -0,0 +1,33 @@
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from coins.imports import FORMATS, get_format, import_transactions, read_rows
+
+
+class Command(BaseCommand):
+    help = "Imports coin transactions for a user from a CSV, JSON or NDJSON file."
+
+    def add_arguments(self, parser):
+        parser.add_argument('email', help="Email of the user the transactions belong to.")
+        parser.add_argument('path', help="File with the columns coin, transaction_type, amount, price_per_coin, created_at.")
+        parser.add_argument('--format', choices=FORMATS, help="File format, guessed from the extension by default.")
+
+    def handle(self, *args, **options):
+        try:
+            user = get_user_model().objects.get(email=options['email'])
+        except get_user_model().DoesNotExist:
+            raise CommandError(f"User {options['email']} not found.")
+
+        fmt = options['format'] or get_format(options['path'])
+        try:
+            with open(options['path'], 'rb') as stream:
+                result = import_transactions(user, read_rows(stream, fmt))
+        except OSError as e:
+            raise CommandError(str(e))
+        except ValidationError as e:
+            raise CommandError("Import failed:\n" + "\n".join(e.messages))
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {result['imported']} transaction(s) for {', '.join(result['coins'])}."
+        ))
@@ -0,0 +1,29 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from coins.models import Coin, CoinHolding, CoinTransaction
+
+
+class Command(BaseCommand):
+    help = "Rebuilds coin holdings from the full transaction history."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--coin', help="Only rebuild holdings of the coin with this slug.")
+
+    def handle(self, *args, **options):
+        transactions = CoinTransaction.objects.all()
+        holdings = CoinHolding.objects.all()
+        if options['coin']:
+            transactions = transactions.filter(coin__slug=options['coin'])
+            holdings = holdings.filter(coin__slug=options['coin'])
+
+        # holdings without transactions are reset as well
+        pairs = set(transactions.values_list('user', 'coin').distinct())
+        pairs |= set(holdings.values_list('user', 'coin'))
+
+        users = get_user_model().objects.in_bulk({user_id for user_id, _ in pairs})
+        coins = Coin.objects.in_bulk({coin_id for _, coin_id in pairs})
+        for user_id, coin_id in pairs:
+            CoinTransaction.update_user_holding(users[user_id], coins[coin_id])
+
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {len(pairs)} holding(s)."))
@@ -1,11 +1,14 @@
 import uuid
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ValidationError
-from django.db.models import Sum, F, DecimalField
+from django.db.models import Sum, F, Q, DecimalField
+from django.utils import timezone
 from django.utils.text import slugify
 from decimal import Decimal
 
+from wallets.models import Wallet, WalletTransaction
+
 User = get_user_model()
 
 class Coin(models.Model):
@@ -29,6 +32,9 @@ class CoinHolding(models.Model):
     coin = models.ForeignKey(Coin, on_delete=models.CASCADE)
     amount = models.DecimalField(max_digits=20, decimal_places=8, default=0)
     average_buy_price = models.DecimalField(max_digits=20, decimal_places=8, default=0)
+    # Running totals of all buys, so a trade only applies its own delta
+    total_bought_amount = models.DecimalField(max_digits=20, decimal_places=8, default=0)
+    total_bought_cost = models.DecimalField(max_digits=36, decimal_places=16, default=0)
 
     class Meta:
         verbose_name = "Holding"
@@ -36,10 +42,32 @@ class CoinHolding(models.Model):
         constraints = [
             models.UniqueConstraint(fields=['user', 'coin'], name='unique_user_coin')
         ]
+        indexes = [
+            # open positions only; most users hold few of the coins they ever traded
+            models.Index(fields=['user', 'coin'], condition=Q(amount__gt=0), name='holding_user_open_idx'),
+        ]
 
     def __str__(self):
         return f"{str(self.user)} - {self.coin.symbol}: {self.amount}"
 
+    def apply_transaction(self, transaction_type, amount, price_per_coin):
+        """
+        Adds a single new transaction to the running totals.
+        """
+        if transaction_type == 'buy':
+            self.amount += amount
+            self.total_bought_amount += amount
+            self.total_bought_cost += amount * price_per_coin
+        else:
+            self.amount -= amount
+        self.update_average_buy_price()
+
+    def update_average_buy_price(self):
+        if self.amount > 0 and self.total_bought_amount > 0:
+            self.average_buy_price = self.total_bought_cost / self.total_bought_amount
+        else:
+            self.average_buy_price = Decimal('0')
+
 class CoinTransaction(models.Model):
     TRANSACTION_TYPES = (
         ('buy', 'Buy'),
@@ -52,43 +80,86 @@ class CoinTransaction(models.Model):
     transaction_type = models.CharField(max_length=4, choices=TRANSACTION_TYPES)
     amount = models.DecimalField(max_digits=20, decimal_places=8)
     price_per_coin = models.DecimalField(max_digits=20, decimal_places=8)
-    created_at = models.DateTimeField(auto_now_add=True)
+    # not auto_now_add, so imports can keep the original trade time
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
 
     class Meta:
         verbose_name = "Transaction"
         verbose_name_plural = "Transactions"
-        
+        indexes = [
+            # keyset pagination of a user's history, overall and per coin
+            models.Index(fields=['user', '-created_at', '-id'], name='coin_tx_user_created_idx'),
+            models.Index(fields=['user', 'coin', '-created_at', '-id'], name='coin_tx_user_coin_created_idx'),
+            # buys or sells of one coin, newest first
+            models.Index(fields=['user', 'coin', 'transaction_type', '-created_at'], name='coin_tx_user_coin_type_idx'),
+        ]
+
     def __str__(self):
         type_display = dict(self.TRANSACTION_TYPES).get(self.transaction_type, self.transaction_type)
         return f"{self.user} {type_display} {self.amount} {self.coin.symbol}"
 
+    @property
+    def signed_amount(self):
+        return -self.amount if self.transaction_type == 'sell' else self.amount
+
+    @classmethod
+    def execute_trade(cls, user, coin, transaction_type, amount, price_per_coin):
+        """
+        Executes a trade: the coin transaction and the wallet debit (buy) or
+        credit (sell) are checked and committed together. The wallet row and
+        then the holding row are locked, so concurrent trades and withdrawals
+        of the same user run one after the other, while other users' trades
+        do not wait. Raises ValidationError if funds or coins are insufficient.
+        """
+        total = (amount * price_per_coin).quantize(Decimal('0.01'))
+
+        with transaction.atomic():
+            wallet = Wallet.objects.select_for_update().get(user=user)
+            trade = cls.objects.create(
+                user=user,
+                coin=coin,
+                transaction_type=transaction_type,
+                amount=amount,
+                price_per_coin=price_per_coin,
+            )
+            WalletTransaction.objects.create(
+                wallet=wallet,
+                transaction_type='withdrawal' if transaction_type == 'buy' else 'deposit',
+                transaction_source='coin',
+                amount=total,
+            )
+        return trade, wallet
+
     @staticmethod
     def update_user_holding(user, coin):
-        transactions = CoinTransaction.objects.filter(user=user, coin=coin)
-
-        total_bought_amount = transactions.filter(transaction_type='buy').aggregate(
-            total=Sum('amount')
-        )['total'] or Decimal('0')
-
-        total_sold_amount = transactions.filter(transaction_type='sell').aggregate(
-            total=Sum('amount')
-        )['total'] or Decimal('0')
-
-        total_bought_cost = transactions.filter(transaction_type='buy').aggregate(
-            total=Sum(F('amount') * F('price_per_coin'), output_field=DecimalField())
-        )['total'] or Decimal('0')
-
-        total_amount = total_bought_amount - total_sold_amount
-
-        if total_amount > 0:
-            average_buy_price = total_bought_cost / total_bought_amount
-        else:
-            average_buy_price = Decimal('0')
-
-        holding, _ = CoinHolding.objects.get_or_create(user=user, coin=coin)
-        holding.amount = total_amount
-        holding.average_buy_price = average_buy_price
-        holding.save()
+        """
+        Rebuilds a holding from the user's full transaction history for the
+        coin. Only needed after edits and deletes, and for repairs.
+        The holding row is locked before the transactions are summed, so a
+        concurrent trade is either included or waits for the rebuild.
+        """
+        buys = Q(transaction_type='buy')
+
+        with transaction.atomic():
+            holding, _ = CoinHolding.objects.select_for_update().get_or_create(user=user, coin=coin)
+            totals = CoinTransaction.objects.filter(user=user, coin=coin).aggregate(
+                bought_amount=Sum('amount', filter=buys),
+                sold_amount=Sum('amount', filter=Q(transaction_type='sell')),
+                bought_cost=Sum(F('amount') * F('price_per_coin'), filter=buys, output_field=DecimalField()),
+            )
+            holding.total_bought_amount = totals['bought_amount'] or Decimal('0')
+            holding.total_bought_cost = totals['bought_cost'] or Decimal('0')
+            holding.amount = holding.total_bought_amount - (totals['sold_amount'] or Decimal('0'))
+            holding.update_average_buy_price()
+            holding.save()
+
+    def get_stored(self):
+        """
+        Returns the saved version of this transaction, or None if it is new.
+        """
+        if self._state.adding:
+            return None
+        return CoinTransaction.objects.filter(pk=self.pk).only('user', 'coin', 'transaction_type', 'amount').first()
 
     def clean(self):
         if self.amount <= 0:
@@ -97,13 +168,12 @@ class CoinTransaction(models.Model):
             raise ValidationError({'price_per_coin': "Price per coin must be greater than zero."})
 
         if self.transaction_type == 'sell':
-            transactions = CoinTransaction.objects.filter(user=self.user, coin=self.coin)
-            if self.pk:
-                transactions = transactions.exclude(pk=self.pk)
+            holding = CoinHolding.objects.filter(user_id=self.user_id, coin_id=self.coin_id)
+            current_amount = holding.values_list('amount', flat=True).first() or Decimal('0')
 
-            total_bought = transactions.filter(transaction_type='buy').aggregate(Sum('amount'))['amount__sum'] or Decimal('0')
-            total_sold = transactions.filter(transaction_type='sell').aggregate(Sum('amount'))['amount__sum'] or Decimal('0')
-            current_amount = total_bought - total_sold
+            stored = self.get_stored()
+            if stored and (stored.user_id, stored.coin_id) == (self.user_id, self.coin_id):
+                current_amount -= stored.signed_amount
 
             if self.amount > current_amount:
                 raise ValidationError({
@@ -112,11 +182,27 @@ class CoinTransaction(models.Model):
                 })
 
     def save(self, *args, **kwargs):
-        self.full_clean()
-        super().save(*args, **kwargs)
-        self.update_user_holding(self.user, self.coin)
+        adding = self._state.adding
+        with transaction.atomic():
+            # the holding row lock serializes all trades of a user in a coin
+            holding, _ = CoinHolding.objects.select_for_update().get_or_create(user=self.user, coin=self.coin)
+            stored = self.get_stored()
+            self.full_clean()
+            super().save(*args, **kwargs)
+
+            if adding:
+                holding.apply_transaction(self.transaction_type, self.amount, self.price_per_coin)
+                holding.save()
+            else:
+                self.update_user_holding(self.user, self.coin)
+                if (stored.user_id, stored.coin_id) != (self.user_id, self.coin_id):
+                    self.update_user_holding(stored.user, stored.coin)
 
     def delete(self, *args, **kwargs):
         user, coin = self.user, self.coin
-        super().delete(*args, **kwargs)
-        self.update_user_holding(user, coin)
\ No newline at end of file
+        with transaction.atomic():
+            # lock the holding first, like trades do, so none lands mid-rebuild
+            CoinHolding.objects.select_for_update().filter(user=user, coin=coin).first()
+            result = super().delete(*args, **kwargs)
+            self.update_user_holding(user, coin)
+        return result
@@ -0,0 +1,215 @@
+from datetime import datetime, timezone
+from decimal import Decimal
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+import numpy as np
+
+from caches.charts import load_series
+from caches.utils import ALLOWED_DAYS, PRICE_VERSION_KEY, chart_key, chart_version_key, coin_key, get_current_price, is_envelope
+from coins.models import CoinHolding, CoinTransaction
+
+CENT = Decimal("0.01")
+HUNDRED = Decimal("100")
+
+def portfolio_key(user_id) -> str:
+    return f"portfolio:{user_id}"
+
+def portfolio_history_key(user_id, days) -> str:
+    return f"portfolio:{user_id}:history:{days}"
+
+def get_prices(slugs: list) -> tuple:
+    """
+    Reads the cached prices of all coins and the price version with a
+    single get_many call. Coins without a cached price map to None.
+    """
+    values = cache.get_many([coin_key(slug) for slug in slugs] + [PRICE_VERSION_KEY])
+    prices = {}
+    for slug in slugs:
+        envelope = values.get(coin_key(slug))
+        price = get_current_price(envelope["data"]) if is_envelope(envelope) else None
+        prices[slug] = Decimal(str(price)) if price is not None else None
+    return prices, values.get(PRICE_VERSION_KEY)
+
+def percent(part, whole):
+    return str((part / whole * HUNDRED).quantize(CENT)) if whole else None
+
+def money(value):
+    return str(value.quantize(CENT)) if value is not None else None
+
+def get_holdings(user) -> list:
+    """
+    (name, symbol, slug, amount, average_buy_price) of the open holdings.
+    """
+    return list(
+        CoinHolding.objects.filter(user=user, amount__gt=0)
+        .order_by('coin__name')
+        .values_list('coin__name', 'coin__symbol', 'coin__slug', 'amount', 'average_buy_price')
+    )
+
+def value_portfolio(holdings: list, prices: dict) -> dict:
+    """
+    Values holdings at the given prices: market value, cost basis,
+    unrealized P&L and allocation per coin, plus totals. The math runs
+    on Decimal object arrays, one operation per column. Coins without a
+    price are listed, but left out of the totals.
+    """
+    names, symbols, slugs, amounts, buy_prices = (list(column) for column in zip(*holdings)) if holdings else ([],) * 5
+
+    amounts = np.array(amounts, dtype=object)
+    priced = np.array([prices.get(slug) is not None for slug in slugs], dtype=bool)
+    current = np.array([prices.get(slug) or Decimal("0") for slug in slugs], dtype=object)
+
+    cost = amounts * np.array(buy_prices, dtype=object)
+    value = amounts * current
+    pnl = value - cost
+
+    total_cost = cost[priced].sum() if priced.any() else Decimal("0")
+    total_value = value[priced].sum() if priced.any() else Decimal("0")
+    total_pnl = total_value - total_cost
+
+    rows = []
+    for index, slug in enumerate(slugs):
+        is_priced = bool(priced[index])
+        rows.append({
+            "coin": {"name": names[index], "symbol": symbols[index], "slug": slug},
+            "amount": str(amounts[index]),
+            "average_buy_price": str(buy_prices[index]),
+            "price": str(current[index]) if is_priced else None,
+            "cost_basis": money(cost[index]),
+            "market_value": money(value[index]) if is_priced else None,
+            "unrealized_pnl": money(pnl[index]) if is_priced else None,
+            "unrealized_pnl_percent": percent(pnl[index], cost[index]) if is_priced else None,
+            "allocation_percent": percent(value[index], total_value) if is_priced else None,
+        })
+
+    return {
+        "holdings": rows,
+        "totals": {
+            "cost_basis": money(total_cost),
+            "market_value": money(total_value),
+            "unrealized_pnl": money(total_pnl),
+            "unrealized_pnl_percent": percent(total_pnl, total_cost),
+        },
+        "missing_prices": [slug for slug, is_priced in zip(slugs, priced) if not is_priced],
+    }
+
+def compute_portfolio(user) -> tuple:
+    """
+    Values the holdings of a user at the cached prices.
+    Returns the portfolio and the price version it was valued at.
+    """
+    holdings = get_holdings(user)
+    prices, version = get_prices([slug for _, _, slug, _, _ in holdings])
+    return value_portfolio(holdings, prices), version
+
+def get_portfolio(user) -> dict:
+    """
+    Returns the portfolio of a user from the cache. It is valued again
+    once prices were stored since (price version) or a trade dropped the
+    entry (see coins.signals).
+    """
+    if not settings.PORTFOLIO_CACHE_TTL:
+        return compute_portfolio(user)[0]
+
+    values = cache.get_many([portfolio_key(user.pk), PRICE_VERSION_KEY])
+    entry = values.get(portfolio_key(user.pk))
+    if entry is not None and entry["price_version"] == values.get(PRICE_VERSION_KEY):
+        return entry["portfolio"]
+
+    portfolio, version = compute_portfolio(user)
+    cache.set(portfolio_key(user.pk), {"price_version": version, "portfolio": portfolio}, timeout=settings.PORTFOLIO_CACHE_TTL)
+    return portfolio
+
+def get_price_grid(slugs: list, days) -> tuple:
+    """
+    Reads the cached price charts of a range for all coins with a single
+    get_many call and aligns them on one time grid: the timestamps of the
+    longest chart, other charts interpolated onto it.
+    Returns the grid, a (coins x points) price matrix for the coins with a
+    chart, their slugs and the chart version of the range.
+    """
+    values = cache.get_many([chart_key(slug, days) for slug in slugs] + [chart_version_key(days)])
+    series = {}
+    for slug in slugs:
+        envelope = values.get(chart_key(slug, days))
+        if is_envelope(envelope):
+            timestamps, prices = load_series(envelope["data"]).get("prices", ((), ()))
+            if len(prices):
+                series[slug] = (timestamps, prices)
+
+    if not series:
+        return np.empty(0, dtype=np.int64), np.empty((0, 0)), [], values.get(chart_version_key(days))
+
+    grid = max(series.values(), key=lambda chart: len(chart[0]))[0]
+    matrix = np.vstack([np.interp(grid, timestamps, prices) for timestamps, prices in series.values()])
+    return grid, matrix, list(series), values.get(chart_version_key(days))
+
+def compute_portfolio_history(user, days) -> tuple:
+    """
+    Portfolio value over a chart range. The amount of every coin is a step
+    function over the grid: the trades after the first point are added to
+    the point they fall on and summed up cumulatively, starting from today's
+    holding minus all of them. The value series is the sum of
+    amounts x aligned prices.
+    Returns ({timestamps, values, missing_charts}, chart version).
+    """
+    holdings = dict(CoinHolding.objects.filter(user=user).values_list('coin__slug', 'amount'))
+    grid, prices, slugs, version = get_price_grid(list(holdings), days)
+    if not len(grid):
+        missing = sorted(slug for slug, amount in holdings.items() if amount > 0)
+        return {"timestamps": grid, "values": np.empty(0), "missing_charts": missing}, version
+
+    since = datetime.fromtimestamp(grid[0] / 1000, tz=timezone.utc)
+    trades = list(
+        CoinTransaction.objects.filter(user=user, created_at__gt=since)
+        .values_list('coin__slug', 'transaction_type', 'amount', 'created_at')
+    )
+    rows = {slug: index for index, slug in enumerate(slugs)}
+    charted = [trade for trade in trades if trade[0] in rows]
+
+    coin_rows = np.array([rows[slug] for slug, _, _, _ in charted], dtype=np.intp)
+    deltas = np.array([float(amount) if kind == 'buy' else -float(amount) for _, kind, amount, _ in charted])
+    times = np.array([int(created_at.timestamp() * 1000) for _, _, _, created_at in charted], dtype=np.int64)
+
+    # a trade counts from the first point at or after it; later trades
+    # land in the extra last column
+    steps = np.zeros((len(slugs), len(grid) + 1))
+    np.add.at(steps, (coin_rows, np.searchsorted(grid, times, side='left')), deltas)
+    start = np.array([float(holdings[slug]) for slug in slugs]) - steps.sum(axis=1)
+    amounts = start[:, None] + np.cumsum(steps, axis=1)[:, :-1]
+
+    values = np.round((amounts * prices).sum(axis=0), 2)
+    traded = {slug for slug, _, _, _ in trades}
+    missing = sorted(
+        slug for slug, amount in holdings.items()
+        if slug not in rows and (amount > 0 or slug in traded)
+    )
+    return {"timestamps": grid, "values": values, "missing_charts": missing}, version
+
+def get_portfolio_history(user, days) -> dict:
+    """
+    Returns the portfolio value series of a range, memoized per user and
+    range until a trade drops it or the charts of the range are refreshed.
+    """
+    if not settings.PORTFOLIO_CACHE_TTL:
+        return compute_portfolio_history(user, days)[0]
+
+    key = portfolio_history_key(user.pk, days)
+    values = cache.get_many([key, chart_version_key(days)])
+    entry = values.get(key)
+    if entry is not None and entry["chart_version"] == values.get(chart_version_key(days)):
+        return entry["history"]
+
+    history, version = compute_portfolio_history(user, days)
+    cache.set(key, {"chart_version": version, "history": history}, timeout=settings.PORTFOLIO_CACHE_TTL)
+    return history
+
+def invalidate_portfolio(user_id):
+    """
+    Drops the cached portfolio and its value series now and again after
+    the surrounding transaction commits, like invalidate_user_stats.
+    """
+    keys = [portfolio_key(user_id)] + [portfolio_history_key(user_id, days) for days in ALLOWED_DAYS]
+    cache.delete_many(keys)
+    transaction.on_commit(lambda: cache.delete_many(keys))
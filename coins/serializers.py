@@ -40,6 +40,11 @@ class CoinTransactionSerializer(serializers.ModelSerializer):
         transaction = CoinTransaction.objects.create(user=user, coin=coin, **validated_data)
         return transaction
     
+class CoinTradeSerializer(serializers.Serializer):
+    transaction_type = serializers.ChoiceField(choices=CoinTransaction.TRANSACTION_TYPES)
+    amount = serializers.DecimalField(max_digits=20, decimal_places=8)
+    price_per_coin = serializers.DecimalField(max_digits=20, decimal_places=8)
+
 class CoinHoldingSerializer(serializers.ModelSerializer):
     coin = BaseCoinSerializer(read_only=True)
     not_holding = serializers.SerializerMethodField()
@@ -0,0 +1,12 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from coins.models import CoinHolding
+from coins.portfolio import invalidate_portfolio
+
+@receiver([post_save, post_delete], sender=CoinHolding)
+def invalidate_cached_portfolio(sender, instance, **kwargs):
+    """
+    Every trade, import and rebuild saves the holding.
+    """
+    invalidate_portfolio(instance.user_id)
@@ -1,3 +1,526 @@
-from django.test import TestCase
+import json
+import tempfile
+import threading
+from datetime import datetime, timezone
+from decimal import Decimal
+from io import BytesIO, StringIO
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils.dateparse import parse_datetime
+from rest_framework.test import APIClient
+from unittest.mock import patch
 
-# Create your tests here.
+from caches.charts import encode_chart
+from caches.tasks import store_coin_cache
+from caches.utils import chart_key, coin_key, make_envelope
+from config.testing import QueryPlanAssertionsMixin
+from coins.imports import import_transactions, read_rows
+from coins.models import Coin, CoinHolding, CoinTransaction
+from wallets.models import Wallet, WalletTransaction
+
+
+class CoinHoldingTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(email="trader@example.com", password="secret123")
+        self.coin = Coin.objects.create(name="Bitcoin", symbol="BTC", slug="bitcoin")
+
+    def trade(self, transaction_type, amount, price):
+        return CoinTransaction.objects.create(
+            user=self.user, coin=self.coin, transaction_type=transaction_type,
+            amount=Decimal(amount), price_per_coin=Decimal(price),
+        )
+
+    def holding(self):
+        return CoinHolding.objects.get(user=self.user, coin=self.coin)
+
+    def assertMatchesRebuild(self):
+        holding = self.holding()
+        CoinTransaction.update_user_holding(self.user, self.coin)
+        rebuilt = self.holding()
+        for field in ('amount', 'average_buy_price', 'total_bought_amount', 'total_bought_cost'):
+            self.assertEqual(getattr(holding, field), getattr(rebuilt, field), field)
+
+    def test_trades_update_holding_incrementally(self):
+        self.trade('buy', '2', '100')
+        self.trade('buy', '1', '130')
+        self.trade('sell', '0.5', '150')
+
+        holding = self.holding()
+        self.assertEqual(holding.amount, Decimal('2.5'))
+        self.assertEqual(holding.average_buy_price, Decimal('110'))
+        self.assertMatchesRebuild()
+
+    def test_trade_does_not_aggregate_history(self):
+        for _ in range(10):
+            self.trade('buy', '1', '100')
+
+        with CaptureQueriesContext(connection) as queries:
+            self.trade('sell', '1', '100')
+        self.assertFalse([q for q in queries.captured_queries if 'SUM(' in q['sql'].upper()])
+        self.assertEqual(self.holding().amount, Decimal('9'))
+
+    def test_sell_above_holding_is_rejected(self):
+        self.trade('buy', '1', '100')
+        with self.assertRaises(ValidationError):
+            self.trade('sell', '1.1', '100')
+        self.assertEqual(self.holding().amount, Decimal('1'))
+
+    def test_edit_and_delete_rebuild_holding(self):
+        buy = self.trade('buy', '2', '100')
+        sell = self.trade('sell', '1', '100')
+
+        sell.amount = Decimal('2')
+        sell.save()
+        self.assertEqual(self.holding().amount, Decimal('0'))
+        self.assertEqual(self.holding().average_buy_price, Decimal('0'))
+
+        sell.delete()
+        self.assertEqual(self.holding().amount, Decimal('2'))
+        self.assertMatchesRebuild()
+
+        buy.delete()
+        self.assertEqual(self.holding().total_bought_amount, Decimal('0'))
+
+    def test_rebuild_command_repairs_holdings(self):
+        self.trade('buy', '3', '10')
+        CoinHolding.objects.update(amount=0, total_bought_amount=0, total_bought_cost=0)
+
+        call_command('rebuild_coin_holdings', stdout=StringIO())
+
+        holding = self.holding()
+        self.assertEqual((holding.amount, holding.average_buy_price), (Decimal('3'), Decimal('10')))
+
+
+class TradeExecutionTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(email="trader@example.com", password="secret123")
+        self.coin = Coin.objects.create(name="Bitcoin", symbol="BTC", slug="bitcoin")
+        self.wallet = Wallet.objects.get(user=self.user)
+        self.wallet.apply_transaction('deposit', Decimal('1000'), 'fiat')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_buy_and_sell_settle_wallet(self):
+        CoinTransaction.execute_trade(self.user, self.coin, 'buy', Decimal('2'), Decimal('300'))
+        trade, wallet = CoinTransaction.execute_trade(self.user, self.coin, 'sell', Decimal('0.5'), Decimal('400'))
+
+        self.assertEqual(wallet.balance, Decimal('600.00'))
+        self.assertEqual(Wallet.objects.get(pk=self.wallet.pk).balance, Decimal('600.00'))
+        self.assertEqual(CoinHolding.objects.get(user=self.user, coin=self.coin).amount, Decimal('1.5'))
+        self.assertEqual(self.wallet.transactions.filter(transaction_source='coin').count(), 2)
+
+    def test_failed_trade_writes_nothing(self):
+        with self.assertRaises(ValidationError):
+            CoinTransaction.execute_trade(self.user, self.coin, 'buy', Decimal('4'), Decimal('300'))
+        with self.assertRaises(ValidationError):
+            CoinTransaction.execute_trade(self.user, self.coin, 'sell', Decimal('1'), Decimal('300'))
+
+        self.assertFalse(CoinTransaction.objects.exists())
+        self.assertEqual(Wallet.objects.get(pk=self.wallet.pk).balance, Decimal('1000.00'))
+        self.assertEqual(CoinHolding.objects.filter(user=self.user, amount__gt=0).count(), 0)
+
+    def test_trade_endpoint(self):
+        url = reverse('my-coin-trade', args=['bitcoin'])
+
+        response = self.client.post(url, {'transaction_type': 'buy', 'amount': '1.5', 'price_per_coin': '100'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['balance'], Decimal('850.00'))
+
+        response = self.client.post(url, {'transaction_type': 'buy', 'amount': '100', 'price_per_coin': '100'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('amount', response.data)
+
+class WalletBusyTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(email="busy@example.com", password="secret123")
+        Coin.objects.create(name="Bitcoin", symbol="BTC", slug="bitcoin")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_lock_timeouts_return_503(self):
+        locked = OperationalError("database is locked")
+        with patch.object(CoinTransaction, "execute_trade", side_effect=locked), \
+                patch.object(Wallet, "apply_transaction", side_effect=locked):
+            responses = [
+                self.client.post(reverse('my-coin-trade', args=['bitcoin']), {'transaction_type': 'buy', 'amount': '1', 'price_per_coin': '1'}),
+                self.client.post(reverse('my-wallet-deposit'), {'amount': '10', 'transaction_source': 'fiat'}),
+                self.client.post(reverse('my-wallet-withdraw'), {'amount': '10', 'transaction_source': 'fiat'}),
+            ]
+        for response in responses:
+            self.assertEqual((response.status_code, response['Retry-After']), (503, '1'))
+
+class ConcurrentTradeTests(TransactionTestCase):
+    """
+    Stress test: many threads sell and withdraw against the same holding and
+    wallet at once. Row locks (or SQLite's IMMEDIATE transactions) make every
+    request wait for the one before, so each is checked against committed
+    state and none fails with a database error.
+    """
+    THREADS = 8
+    ROUNDS = 5
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(email="stress@example.com", password="secret123")
+        self.coin = Coin.objects.create(name="Bitcoin", symbol="BTC", slug="bitcoin")
+        self.wallet = Wallet.objects.get(user=self.user)
+        self.wallet.apply_transaction('deposit', Decimal('100'), 'fiat')
+        CoinTransaction.execute_trade(self.user, self.coin, 'buy', Decimal('10'), Decimal('5'))
+
+    def test_concurrent_sells_and_withdrawals_never_go_negative(self):
+        barrier = threading.Barrier(self.THREADS)
+        outcomes = []
+
+        def worker(index):
+            barrier.wait()
+            try:
+                for _ in range(self.ROUNDS):
+                    try:
+                        if index % 2:
+                            CoinTransaction.execute_trade(self.user, self.coin, 'sell', Decimal('1'), Decimal('1'))
+                        else:
+                            Wallet.objects.get(pk=self.wallet.pk).apply_transaction('withdrawal', Decimal('10'), 'fiat')
+                        outcomes.append('ok')
+                    except (ValidationError, ValueError):
+                        outcomes.append('rejected')
+                    except OperationalError as e:
+                        outcomes.append(f'error: {e}')
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker, args=(index,)) for index in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        wallet = Wallet.objects.get(pk=self.wallet.pk)
+        holding = CoinHolding.objects.get(user=self.user, coin=self.coin)
+        self.assertEqual(len(outcomes), self.THREADS * self.ROUNDS)
+        self.assertGreaterEqual(wallet.balance, 0)
+        self.assertGreaterEqual(holding.amount, 0)
+        self.assertEqual(wallet.balance, wallet.get_ledger_balance())
+
+        self.assertEqual([outcome for outcome in outcomes if outcome.startswith('error')], [])
+        sold = CoinTransaction.objects.filter(transaction_type='sell').count()
+        withdrawn = WalletTransaction.objects.filter(transaction_type='withdrawal', transaction_source='fiat').count()
+        # all 10 coins are sold; 50 + 10 from the sales fund 5 or 6 withdrawals, depending on the order
+        self.assertEqual(sold, 10)
+        self.assertIn(withdrawn, (5, 6))
+        self.assertEqual(outcomes.count('ok'), sold + withdrawn)
+        self.assertEqual(holding.amount, Decimal('0'))
+        self.assertEqual(wallet.balance, Decimal('60') - 10 * withdrawn)
+
+    def test_edits_and_deletes_during_concurrent_trades_keep_holding_in_sync(self):
+        """
+        Test that rebuilding a holding after an edit or delete never drops a
+        trade committed by another thread at the same time.
+        """
+        edited = CoinTransaction.objects.get(user=self.user, coin=self.coin)
+        deleted = [
+            CoinTransaction.execute_trade(self.user, self.coin, 'buy', Decimal('1'), Decimal('1'))[0]
+            for _ in range(self.ROUNDS)
+        ]
+        barrier = threading.Barrier(self.THREADS)
+        errors = []
+
+        def worker(index):
+            barrier.wait()
+            try:
+                for step in range(self.ROUNDS):
+                    if index == 0:
+                        edited.amount = Decimal('10') + step
+                        edited.save()
+                    elif index == 1:
+                        deleted[step].delete()
+                    else:
+                        CoinTransaction.execute_trade(self.user, self.coin, 'buy', Decimal('0.1'), Decimal('1'))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker, args=(index,)) for index in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        holding = CoinHolding.objects.get(user=self.user, coin=self.coin)
+        bought = Decimal('10') + self.ROUNDS - 1 + (self.THREADS - 2) * self.ROUNDS * Decimal('0.1')
+        self.assertEqual(holding.amount, bought)
+        self.assertEqual(holding.total_bought_amount, bought)
+
+class TransactionImportTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(email="import@example.com", password="secret123")
+        self.bitcoin = Coin.objects.create(name="Bitcoin", symbol="BTC", slug="bitcoin")
+        self.ethereum = Coin.objects.create(name="Ethereum", symbol="ETH", slug="ethereum")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def make_csv(self, rows):
+        lines = ["coin,transaction_type,amount,price_per_coin,created_at"]
+        lines += [",".join(row) for row in rows]
+        return "\n".join(lines).encode()
+
+    def holding(self, coin):
+        return CoinHolding.objects.get(user=self.user, coin=coin)
+
+    def test_import_bulk_inserts_and_rebuilds_holdings_once(self):
+        rows = [("bitcoin", "buy", "0.1", "20000", f"2024-01-{day:02d}T12:00:00Z") for day in range(1, 29)]
+        rows += [("ETH", "buy", "2", "1000", "2024-02-01T00:00:00Z"), ("eth", "sell", "1.5", "1200", "2024-02-02T00:00:00Z")]
+
+        with CaptureQueriesContext(connection) as queries:
+            result = import_transactions(self.user, read_rows(BytesIO(self.make_csv(rows)), "csv"))
+
+        self.assertEqual(result, {"imported": 30, "coins": ["bitcoin", "ethereum"]})
+        self.assertLess(len(queries), 30)
+        self.assertEqual(self.holding(self.bitcoin).amount, Decimal("2.8"))
+        self.assertEqual(self.holding(self.ethereum).amount, Decimal("0.5"))
+        first = CoinTransaction.objects.filter(coin=self.bitcoin).order_by("created_at").first()
+        self.assertEqual(first.created_at.isoformat(), "2024-01-01T12:00:00+00:00")
+
+    def test_sells_are_checked_in_chronological_order(self):
+        CoinTransaction.objects.create(
+            user=self.user, coin=self.bitcoin, transaction_type="buy",
+            amount=Decimal("1"), price_per_coin=Decimal("100"),
+            created_at=parse_datetime("2023-06-01T00:00:00Z"),
+        )
+        # the sell is listed first, but happens after the buy
+        rows = [
+            {"coin": "bitcoin", "transaction_type": "sell", "amount": "1.5", "price_per_coin": "1", "created_at": "2024-01-02T00:00:00Z"},
+            {"coin": "bitcoin", "transaction_type": "buy", "amount": "1", "price_per_coin": "1", "created_at": "2024-01-01T00:00:00Z"},
+        ]
+        result = import_transactions(self.user, read_rows(BytesIO(json.dumps(rows).encode()), "json"))
+        self.assertEqual(result["imported"], 2)
+        self.assertEqual(self.holding(self.bitcoin).amount, Decimal("0.5"))
+
+        oversell = [{"coin": "bitcoin", "transaction_type": "sell", "amount": "1.5", "price_per_coin": "1", "created_at": "2023-12-31T00:00:00Z"}]
+        with self.assertRaisesMessage(ValidationError, "Row 1: Not enough stock"):
+            import_transactions(self.user, read_rows(BytesIO(json.dumps(oversell).encode()), "json"))
+
+    def test_invalid_rows_import_nothing(self):
+        rows = [
+            ("bitcoin", "buy", "1", "100", ""),
+            ("dogecoin", "buy", "1", "100", ""),
+            ("bitcoin", "hold", "-1", "abc", "yesterday"),
+        ]
+        with self.assertRaises(ValidationError) as context:
+            import_transactions(self.user, read_rows(BytesIO(self.make_csv(rows)), "csv"))
+
+        self.assertEqual(len(context.exception.messages), 5)
+        self.assertFalse(CoinTransaction.objects.exists())
+
+    def test_import_endpoint_accepts_upload_and_raw_body(self):
+        url = reverse("my-coin-transactions-import")
+        upload = SimpleUploadedFile("trades.csv", self.make_csv([("bitcoin", "buy", "1", "100", "")]))
+        response = self.client.post(url, {"file": upload}, format="multipart")
+        self.assertEqual(response.status_code, 201)
+
+        body = "\n".join(json.dumps(row) for row in [
+            {"coin": "bitcoin", "transaction_type": "sell", "amount": "0.25", "price_per_coin": "120"},
+            {"coin": "bitcoin", "transaction_type": "sell", "amount": "5", "price_per_coin": "120"},
+        ])
+        response = self.client.generic("POST", url, body, content_type="application/x-ndjson")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("Row 2", response.data["errors"][0])
+        self.assertEqual(self.holding(self.bitcoin).amount, Decimal("1"))
+
+    def test_import_endpoint_rejects_impossible_dates(self):
+        url = reverse("my-coin-transactions-import")
+        rows = [("bitcoin", "buy", "1", "100", "2024-02-30T10:00:00"), ("bitcoin", "buy", "0", "100", "")]
+        upload = SimpleUploadedFile("trades.csv", self.make_csv(rows))
+
+        response = self.client.post(url, {"file": upload}, format="multipart")
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("Row 1: invalid created_at '2024-02-30T10:00:00'.", response.data["errors"])
+        self.assertIn("Row 2: invalid amount '0'.", response.data["errors"])
+        self.assertFalse(CoinTransaction.objects.exists())
+
+    def test_import_command(self):
+        with tempfile.NamedTemporaryFile(suffix=".csv") as file:
+            file.write(self.make_csv([("BTC", "buy", "3", "100", "2024-01-01T00:00:00")]))
+            file.flush()
+            call_command("import_coin_transactions", "import@example.com", file.name, stdout=StringIO())
+            with self.assertRaises(CommandError):
+                call_command("import_coin_transactions", "missing@example.com", file.name, stdout=StringIO())
+
+        self.assertEqual(self.holding(self.bitcoin).amount, Decimal("3"))
+
+class CoinTransactionHistoryTests(TestCase):
+    def test_coin_history_pages(self):
+        user = get_user_model().objects.create_user(email="pages@example.com", password="secret123")
+        coin = Coin.objects.create(name="Bitcoin", symbol="BTC", slug="bitcoin")
+        for _ in range(5):
+            CoinTransaction.objects.create(user=user, coin=coin, transaction_type="buy", amount=Decimal("1"), price_per_coin=Decimal("1"))
+        client = APIClient()
+        client.force_authenticate(user)
+
+        first = client.get(reverse("my-coin-transaction", args=["bitcoin"]), {"page_size": 4}).data
+        second = client.get(first["next"]).data
+
+        ids = [row["id"] for row in first["results"] + second["results"]]
+        self.assertEqual(len(set(ids)), 5)
+        self.assertIsNone(second["next"])
+        self.assertEqual(first["results"][0]["coin"]["slug"], "bitcoin")
+
+class PortfolioTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user(email="portfolio@example.com", password="secret123")
+        self.bitcoin = Coin.objects.create(name="Bitcoin", symbol="BTC", slug="bitcoin")
+        self.ethereum = Coin.objects.create(name="Ethereum", symbol="ETH", slug="ethereum")
+        self.dogecoin = Coin.objects.create(name="Dogecoin", symbol="DOGE", slug="dogecoin")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = reverse("my-coin-portfolio")
+
+    def trade(self, coin, transaction_type, amount, price):
+        CoinTransaction.objects.create(
+            user=self.user, coin=coin, transaction_type=transaction_type,
+            amount=Decimal(amount), price_per_coin=Decimal(price),
+        )
+
+    def set_prices(self):
+        cache.set(coin_key("bitcoin"), make_envelope({"id": "bitcoin", "market_data": {"current_price": {"usd": 150.0}}}))
+        cache.set(coin_key("ethereum"), make_envelope({"id": "ethereum", "market_data": {"current_price": {"usd": 15}}}))
+
+    def test_portfolio_values_holdings_at_cached_prices(self):
+        self.trade(self.bitcoin, "buy", "2", "100")
+        self.trade(self.bitcoin, "buy", "1", "130")
+        self.trade(self.ethereum, "buy", "10", "20")
+        self.trade(self.dogecoin, "buy", "100", "0.1")
+        coin = Coin.objects.create(name="Sold", symbol="SOLD", slug="sold")
+        self.trade(coin, "buy", "1", "10")
+        self.trade(coin, "sell", "1", "12")
+        self.set_prices()
+
+        data = self.client.get(self.url).data
+
+        rows = {row["coin"]["slug"]: row for row in data["holdings"]}
+        self.assertEqual(list(rows), ["bitcoin", "dogecoin", "ethereum"])
+        self.assertEqual(
+            {key: rows["bitcoin"][key] for key in ("price", "cost_basis", "market_value", "unrealized_pnl", "unrealized_pnl_percent", "allocation_percent")},
+            {"price": "150.0", "cost_basis": "330.00", "market_value": "450.00", "unrealized_pnl": "120.00", "unrealized_pnl_percent": "36.36", "allocation_percent": "75.00"},
+        )
+        self.assertEqual((rows["ethereum"]["unrealized_pnl"], rows["ethereum"]["allocation_percent"]), ("-50.00", "25.00"))
+        self.assertIsNone(rows["dogecoin"]["market_value"])
+        self.assertEqual(data["missing_prices"], ["dogecoin"])
+        self.assertEqual(data["totals"], {"cost_basis": "530.00", "market_value": "600.00", "unrealized_pnl": "70.00", "unrealized_pnl_percent": "13.21"})
+
+    def test_empty_portfolio(self):
+        data = self.client.get(self.url).data
+
+        self.assertEqual(data["holdings"], [])
+        self.assertEqual(data["totals"]["market_value"], "0.00")
+        self.assertIsNone(data["totals"]["unrealized_pnl_percent"])
+
+    def test_portfolio_is_cached_until_a_trade_or_price_refresh(self):
+        self.trade(self.bitcoin, "buy", "2", "100")
+        self.set_prices()
+        self.client.get(self.url)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(self.url).data["totals"]["market_value"], "300.00")
+
+        self.trade(self.bitcoin, "sell", "1", "150")
+        self.assertEqual(self.client.get(self.url).data["totals"]["market_value"], "150.00")
+
+        store_coin_cache([("bitcoin", coin_key("bitcoin"), {"id": "bitcoin", "market_data": {"current_price": {"usd": 200.0}}})])
+        self.assertEqual(self.client.get(self.url).data["totals"]["market_value"], "200.00")
+
+class PortfolioHistoryTests(TestCase):
+    T0 = 1_700_000_000_000
+    HOUR = 60 * 60 * 1000
+
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user(email="history@example.com", password="secret123")
+        self.coins = {
+            slug: Coin.objects.create(name=slug.title(), symbol=slug[:3].upper(), slug=slug)
+            for slug in ("bitcoin", "ethereum", "dogecoin")
+        }
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = reverse("my-coin-portfolio-history")
+
+        self.trade("bitcoin", "buy", "2", self.T0 - self.HOUR)
+        self.trade("bitcoin", "buy", "1", self.T0 + self.HOUR + 1)
+        self.trade("bitcoin", "sell", "0.5", self.T0 + 3 * self.HOUR)
+        self.trade("ethereum", "buy", "1", self.T0 - self.HOUR // 2)
+        self.trade("dogecoin", "buy", "100", self.T0)
+
+        self.set_chart("bitcoin", [(self.T0 + index * self.HOUR, 100 + 10 * index) for index in range(4)])
+        # fewer points, half an hour later: interpolated onto the bitcoin grid
+        self.set_chart("ethereum", [(self.T0 + index * self.HOUR + self.HOUR // 2, 10 * (index + 1)) for index in range(3)])
+
+    def trade(self, slug, transaction_type, amount, timestamp_ms):
+        CoinTransaction.objects.create(
+            user=self.user, coin=self.coins[slug], transaction_type=transaction_type, amount=Decimal(amount),
+            price_per_coin=Decimal("1"), created_at=datetime.fromtimestamp(timestamp_ms / 1000, tz=timezone.utc),
+        )
+
+    def set_chart(self, slug, points):
+        cache.set(chart_key(slug, 7), make_envelope(encode_chart({"prices": [list(point) for point in points]})))
+
+    def test_history_replays_trades_against_aligned_prices(self):
+        data = self.client.get(self.url, {"days": 7}).data
+
+        # bitcoin 2, 2, 3, 2.5 at 100-130; ethereum 1 at 10, 15, 25, 30
+        self.assertEqual(data["values"], [[self.T0 + index * self.HOUR, value] for index, value in enumerate([210, 235, 385, 355])])
+        self.assertEqual(data["missing_charts"], ["dogecoin"])
+
+    def test_history_is_memoized_until_a_trade_or_chart_refresh(self):
+        self.client.get(self.url, {"days": 7})
+        with self.assertNumQueries(0):
+            self.client.get(self.url, {"days": 7})
+
+        self.trade("ethereum", "buy", "1", self.T0 + 2 * self.HOUR)
+        self.assertEqual([value for _, value in self.client.get(self.url, {"days": 7}).data["values"]], [210, 235, 410, 385])
+
+        chart = encode_chart({"prices": [[self.T0 + index * self.HOUR, 100.0] for index in range(4)]})
+        store_coin_cache([("bitcoin", chart_key("bitcoin", 7), chart)])
+        self.assertEqual([value for _, value in self.client.get(self.url, {"days": 7}).data["values"]], [210, 215, 350, 310])
+
+    def test_history_parameters(self):
+        data = self.client.get(self.url, {"days": 7, "max_points": 3}).data
+        self.assertEqual([timestamp for timestamp, _ in data["values"]], [self.T0, self.T0 + 2 * self.HOUR, self.T0 + 3 * self.HOUR])
+
+        self.assertEqual(self.client.get(self.url).data["values"], [])
+        self.assertEqual(self.client.get(self.url, {"days": 2}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {"max_points": "many"}).status_code, 400)
+
+class CoinQueryPlanTests(QueryPlanAssertionsMixin, TestCase):
+    """
+    Regression tests for the indexes of the hot per-user coin queries.
+    """
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(email="plans@example.com", password="secret123")
+        self.coin = Coin.objects.create(name="Bitcoin", symbol="BTC", slug="bitcoin")
+
+    def test_history_uses_user_created_index(self):
+        queryset = CoinTransaction.objects.filter(user=self.user).order_by("-created_at", "-id")
+        self.assertUsesIndex(queryset, "coin_tx_user_created_idx")
+
+    def test_coin_history_uses_user_coin_created_index(self):
+        queryset = CoinTransaction.objects.filter(user=self.user, coin=self.coin).order_by("-created_at", "-id")
+        self.assertUsesIndex(queryset, "coin_tx_user_coin_created_idx")
+
+    def test_typed_history_uses_user_coin_type_index(self):
+        queryset = CoinTransaction.objects.filter(user=self.user, coin=self.coin, transaction_type="sell").order_by("-created_at")
+        self.assertUsesIndex(queryset, "coin_tx_user_coin_type_idx")
+
+    def test_open_holdings_use_partial_index(self):
+        if not connection.features.supports_partial_indexes:
+            self.skipTest("partial indexes not supported")
+        queryset = CoinHolding.objects.filter(user=self.user, amount__gt=0)
+        self.assertUsesIndex(queryset, "holding_user_open_idx")
@@ -1,12 +1,23 @@
+import io
 from rest_framework.views import APIView
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework import status
+from django.core.exceptions import ValidationError
+from django.db import OperationalError
 
-from coins.serializers import CoinHoldingSerializer, CoinTransactionSerializer
+from config.pagination import TransactionHistoryMixin
+from config.metrics import RequestMetricsMixin
+from coins.imports import get_format, import_transactions, read_rows
+from caches.charts import chart_to_lists, downsample_chart
+from caches.utils import ALLOWED_DAYS
+from coins.portfolio import get_portfolio, get_portfolio_history
+from coins.serializers import CoinHoldingSerializer, CoinTradeSerializer, CoinTransactionSerializer
+from wallets.models import Wallet
+from wallets.views import wallet_busy_response
 from .models import Coin, CoinHolding, CoinTransaction
 
-class CoinView(APIView):
+class CoinView(RequestMetricsMixin, APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request, *args, **kwargs):
@@ -14,7 +25,7 @@ class CoinView(APIView):
         data = [{"name": coin.name, "symbol": coin.symbol} for coin in coins]
         return Response(data, status=status.HTTP_200_OK)
 
-class MyCoinHoldingsView(APIView):
+class MyCoinHoldingsView(RequestMetricsMixin, APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
@@ -22,7 +33,49 @@ class MyCoinHoldingsView(APIView):
         serializer = CoinHoldingSerializer(holdings, many=True)
         return Response(serializer.data)
     
-class MyCoinHoldingView(APIView):
+class MyCoinPortfolioView(RequestMetricsMixin, APIView):
+    """
+    GET: market value, unrealized P&L and allocation of all open holdings
+    at the cached coin prices
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        return Response(get_portfolio(request.user))
+
+class MyCoinPortfolioHistoryView(RequestMetricsMixin, APIView):
+    """
+    GET: value of the user's holdings over a chart range, from the cached
+    coin charts
+    Optional query params: ?days=30 (allowed: 1, 7, 30, 180, 365),
+    max_points (3 - 5000)
+    """
+    permission_classes = [IsAuthenticated]
+    DEFAULT_DAYS = 30
+    MAX_POINTS_LIMIT = 5000
+
+    def get(self, request):
+        try:
+            days = int(request.query_params.get("days") or self.DEFAULT_DAYS)
+            max_points = request.query_params.get("max_points")
+            max_points = int(max_points) if max_points else None
+        except ValueError:
+            return Response({"error": "Invalid 'days' or 'max_points' parameter"}, status=400)
+
+        if days not in ALLOWED_DAYS:
+            return Response({"error": f"Invalid 'days'. Allowed: {ALLOWED_DAYS}"}, status=400)
+        if max_points is not None and not 3 <= max_points <= self.MAX_POINTS_LIMIT:
+            return Response({"error": f"Invalid 'max_points'. Allowed: 3 - {self.MAX_POINTS_LIMIT}"}, status=400)
+
+        history = get_portfolio_history(request.user, days)
+        chart = downsample_chart({"values": (history["timestamps"], history["values"])}, max_points)
+        return Response({
+            "days": days,
+            **chart_to_lists(chart),
+            "missing_charts": history["missing_charts"],
+        })
+
+class MyCoinHoldingView(RequestMetricsMixin, APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request, coin_id):
@@ -46,15 +99,14 @@ class MyCoinHoldingView(APIView):
         serializer = CoinHoldingSerializer(holding)
         return Response(serializer.data)
     
-class MyCoinTransactionsView(APIView):
+class MyCoinTransactionsView(RequestMetricsMixin, TransactionHistoryMixin, APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
-        transactions = CoinTransaction.objects.filter(user=request.user).order_by('-created_at')
-        serializer = CoinTransactionSerializer(transactions, many=True)
-        return Response(serializer.data)
+        transactions = CoinTransaction.objects.filter(user=request.user).select_related('coin')
+        return self.list_response(request, transactions, CoinTransactionSerializer)
 
-class MyCoinTransactionView(APIView):
+class MyCoinTransactionView(RequestMetricsMixin, TransactionHistoryMixin, APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request, coin_id):
@@ -63,9 +115,8 @@ class MyCoinTransactionView(APIView):
         except Coin.DoesNotExist:
             return Response({'detail': 'Coin not found.'}, status=status.HTTP_404_NOT_FOUND)
 
-        transactions = CoinTransaction.objects.filter(user=request.user, coin=coin).order_by('-created_at')
-        serializer = CoinTransactionSerializer(transactions, many=True)
-        return Response(serializer.data)
+        transactions = CoinTransaction.objects.filter(user=request.user, coin=coin).select_related('coin')
+        return self.list_response(request, transactions, CoinTransactionSerializer)
 
     def post(self, request, coin_id):
         try:
@@ -78,3 +129,54 @@ class MyCoinTransactionView(APIView):
         transaction = serializer.save()
         response_serializer = CoinTransactionSerializer(transaction, context={'request': request})
         return Response(response_serializer.data, status=status.HTTP_201_CREATED)
+
+class MyCoinTransactionImportView(RequestMetricsMixin, APIView):
+    """
+    Imports transactions from an uploaded file (multipart field "file") or
+    from the raw request body, as CSV, JSON array or NDJSON. The format is
+    taken from ?format=, the file name or the content type.
+    """
+    permission_classes = [IsAuthenticated]
+    throttle_costs = {"POST": 20}
+
+    def post(self, request):
+        upload = request.FILES.get('file') if request.content_type.startswith('multipart/') else None
+        if upload is not None:
+            stream, name = upload, upload.name
+        else:
+            # the body is read as a stream, not parsed upfront
+            stream, name = request.stream or io.BytesIO(), ''
+
+        fmt = request.query_params.get('format') or get_format(name, request.content_type)
+        try:
+            result = import_transactions(request.user, read_rows(stream, fmt))
+        except ValidationError as e:
+            return Response({'detail': 'Import failed.', 'errors': e.messages}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(result, status=status.HTTP_201_CREATED)
+
+class MyCoinTradeView(RequestMetricsMixin, APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, coin_id):
+        try:
+            coin = Coin.objects.get(name__iexact=coin_id, is_active=True)
+        except Coin.DoesNotExist:
+            return Response({'detail': 'Coin not found.'}, status=status.HTTP_404_NOT_FOUND)
+
+        serializer = CoinTradeSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        try:
+            trade, wallet = CoinTransaction.execute_trade(request.user, coin, **serializer.validated_data)
+        except Wallet.DoesNotExist:
+            return Response({'detail': 'Wallet not found.'}, status=status.HTTP_404_NOT_FOUND)
+        except ValidationError as e:
+            return Response(e.message_dict, status=status.HTTP_400_BAD_REQUEST)
+        except OperationalError:
+            return wallet_busy_response()
+
+        return Response({
+            'transaction': CoinTransactionSerializer(trade).data,
+            'balance': wallet.current_balance,
+        }, status=status.HTTP_201_CREATED)
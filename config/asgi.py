@@ -9,8 +9,19 @@ https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
+from django.core.handlers.asgi import ASGIHandler
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
-application = get_asgi_application()
+class AsyncViewsASGIHandler(ASGIHandler):
+    """
+    Resolves requests with config.asgi_urls, which serves the coin cache
+    endpoints with their async views.
+    """
+    async def get_response_async(self, request):
+        request.urlconf = 'config.asgi_urls'
+        return await super().get_response_async(request)
+
+django.setup(set_prefix=False)
+application = AsyncViewsASGIHandler()
@@ -0,0 +1,20 @@
+"""
+URLs of the ASGI application (config.asgi): the coin cache read and refresh
+endpoints are served by their async views, all other routes by the same
+views as under WSGI.
+"""
+from django.urls import path
+
+from caches.async_views import AsyncCoinCacheView, AsyncSingleCoinCacheView
+from config.urls import urlpatterns as wsgi_urlpatterns
+
+ASYNC_VIEWS = {
+    "coin-cache": AsyncCoinCacheView.as_view(),
+    "cache-single-coin": AsyncSingleCoinCacheView.as_view(),
+}
+
+urlpatterns = [
+    path(str(pattern.pattern), ASYNC_VIEWS[pattern.name], name=pattern.name)
+    if getattr(pattern, "name", None) in ASYNC_VIEWS else pattern
+    for pattern in wsgi_urlpatterns
+]
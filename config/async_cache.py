@@ -0,0 +1,54 @@
+import asyncio
+import os
+from django.conf import settings
+from django.core.cache import cache
+from redis.asyncio import ConnectionPool
+
+from config.metrics import InstrumentedAsyncRedis
+
+_clients = {}
+
+def get_cache_url() -> tuple:
+    """
+    URL and connection options of the default cache. Extra options for the
+    async pool can be set as ASYNC_CONNECTION_POOL_KWARGS in its OPTIONS.
+    """
+    config = settings.CACHES["default"]
+    options = config.get("OPTIONS", {})
+    kwargs = dict(options.get("ASYNC_CONNECTION_POOL_KWARGS", {}))
+    if options.get("PASSWORD"):
+        kwargs["password"] = options["PASSWORD"]
+    return config["LOCATION"], kwargs
+
+def get_async_redis(url: str = None, **kwargs):
+    """
+    Returns the async Redis client of the running event loop, by default
+    for the cache. Clients are bound to the loop they were created on, so
+    a new one is made after a fork or for a new loop.
+    """
+    if url is None:
+        url, kwargs = get_cache_url()
+    key = (os.getpid(), asyncio.get_running_loop())
+    entry = _clients.get(url)
+    if entry is None or entry[0] != key:
+        entry = (key, InstrumentedAsyncRedis(connection_pool=ConnectionPool.from_url(url, **kwargs)))
+        _clients[url] = entry
+    return entry[1]
+
+# The helpers below read and write cache entries in the format of the
+# django-redis cache (same keys, serializer and compressor), so sync and
+# async code share them.
+
+async def aget(key: str, default=None):
+    value = await get_async_redis().get(cache.make_key(key))
+    return default if value is None else cache.client.decode(value)
+
+async def aset(key: str, value, timeout: float):
+    await get_async_redis().set(cache.make_key(key), cache.client.encode(value), px=int(timeout * 1000))
+
+async def aadd(key: str, value, timeout: float) -> bool:
+    added = await get_async_redis().set(cache.make_key(key), cache.client.encode(value), px=int(timeout * 1000), nx=True)
+    return bool(added)
+
+async def adelete(key: str):
+    await get_async_redis().delete(cache.make_key(key))
@@ -8,4 +8,44 @@ app = Celery('config')
 
 app.config_from_object('django.conf:settings', namespace='CELERY')
 
-app.autodiscover_tasks()
\ No newline at end of file
+app.autodiscover_tasks()
+
+# Prewarm intervals in seconds: coin data and every chart range
+# (ALLOWED_DAYS) get their own cadence, short ranges change more often.
+# Each run spreads its tasks over up to 10% of the interval (max. 5min).
+# Charts are kept for at least twice their interval (caches.tasks.get_hard_ttl).
+DATA_PREWARM_INTERVAL = 5 * 60
+CHART_PREWARM_INTERVALS = {
+    1: 10 * 60,
+    7: 60 * 60,
+    30: 3 * 60 * 60,
+    180: 12 * 60 * 60,
+    365: 24 * 60 * 60,
+}
+
+# Mail send run independent of new mail: picks up messages of interrupted
+# runs and of runs that ran out of retries
+MAIL_SWEEP_INTERVAL = 5 * 60
+
+def get_jitter(interval: int) -> int:
+    return min(interval // 10, 5 * 60)
+
+app.conf.beat_schedule = {
+    "prewarm-coin-data": {
+        "task": "caches.tasks.prewarm_coin_data",
+        "schedule": DATA_PREWARM_INTERVAL,
+        "args": (get_jitter(DATA_PREWARM_INTERVAL),),
+    },
+    **{
+        f"prewarm-coin-chart-{days}d": {
+            "task": "caches.tasks.prewarm_coin_charts",
+            "schedule": interval,
+            "args": (str(days), get_jitter(interval)),
+        }
+        for days, interval in CHART_PREWARM_INTERVALS.items()
+    },
+    "send-queued-emails": {
+        "task": "users.tasks.send_queued_emails",
+        "schedule": MAIL_SWEEP_INTERVAL,
+    },
+}
\ No newline at end of file
@@ -0,0 +1,287 @@
+import bisect
+import hmac
+import ipaddress
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.http import Http404, HttpResponse
+from redis.asyncio import Redis as AsyncRedis
+from redis.client import Pipeline, Redis
+
+# Histogram buckets: seconds for timings, counts for queries and commands
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+_current = ContextVar("request_metrics", default=None)
+
+# Server-Timing descriptions of the counted kinds of work
+UNITS = {"db": "queries", "redis": "commands"}
+
+class RequestMetrics:
+    """
+    Counts and seconds spent per kind of work (db, redis, celery, and the
+    phases added by views) during one request.
+    """
+    def __init__(self):
+        self.counts = {}
+        self.seconds = {}
+
+    def add(self, name: str, seconds: float, count: int = 1):
+        self.counts[name] = self.counts.get(name, 0) + count
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    def server_timing(self, total: float) -> str:
+        """
+        Server-Timing header value, durations in milliseconds.
+        """
+        entries = [f"total;dur={total * 1000:.2f}"]
+        for name, seconds in self.seconds.items():
+            entry = f"{name};dur={seconds * 1000:.2f}"
+            if name in UNITS:
+                entry += f';desc="{self.counts[name]} {UNITS[name]}"'
+            entries.append(entry)
+        return ", ".join(entries)
+
+def current_metrics():
+    """
+    Metrics of the request being handled, None if metrics are disabled.
+    """
+    return _current.get()
+
+@contextmanager
+def timed(name: str, count: int = 1):
+    """
+    Adds the time spent in the block to the current request, if any.
+    """
+    metrics = _current.get()
+    if metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add(name, time.perf_counter() - start, count)
+
+class InstrumentedPipeline(Pipeline):
+    def execute(self, raise_on_error: bool = True):
+        with timed("redis", len(self.command_stack)):
+            return super().execute(raise_on_error)
+
+class InstrumentedRedis(Redis):
+    """
+    Redis client (django-redis REDIS_CLIENT_CLASS) that adds every command
+    to the metrics of the current request.
+    """
+    def execute_command(self, *args, **options):
+        with timed("redis"):
+            return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+class InstrumentedAsyncRedis(AsyncRedis):
+    """
+    Async counterpart of InstrumentedRedis, used by config.async_cache.
+    """
+    async def execute_command(self, *args, **options):
+        with timed("redis"):
+            return await super().execute_command(*args, **options)
+
+class Histogram:
+    """
+    Cumulative Prometheus histogram with one series per label values.
+    """
+    def __init__(self, name: str, help_text: str, buckets: tuple):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, labels: tuple, value: float):
+        counts, total = self.series.get(labels, (None, 0.0))
+        if counts is None:
+            counts = [0] * (len(self.buckets) + 1)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.series[labels] = (counts, total + value)
+
+    def render(self, label_names: tuple) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in sorted(self.series.items()):
+            selector = ",".join(f'{name}="{value}"' for name, value in zip(label_names, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{selector},le="{bound}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{selector}}} {total:.6f}")
+            lines.append(f"{self.name}_count{{{selector}}} {cumulative}")
+        return lines
+
+class MetricsRegistry:
+    """
+    Request metrics aggregated per route and method. The registry lives
+    in the process, so each worker process exposes its own histograms.
+    """
+    LABELS = ("route", "method")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.histograms = {
+            "total": Histogram("bittrade_request_duration_seconds", "Request latency.", TIME_BUCKETS),
+            "db": Histogram("bittrade_request_db_queries", "SQL queries per request.", COUNT_BUCKETS),
+            "db_seconds": Histogram("bittrade_request_db_seconds", "SQL time per request.", TIME_BUCKETS),
+            "redis": Histogram("bittrade_request_redis_commands", "Redis commands per request.", COUNT_BUCKETS),
+            "redis_seconds": Histogram("bittrade_request_redis_seconds", "Redis time per request.", TIME_BUCKETS),
+            "celery_seconds": Histogram("bittrade_request_celery_wait_seconds", "Time waiting for Celery results per request.", TIME_BUCKETS),
+        }
+        self.responses = {}
+
+    def observe(self, route: str, method: str, status_code: int, metrics: RequestMetrics, total: float):
+        labels = (route, method)
+        with self.lock:
+            self.histograms["total"].observe(labels, total)
+            for name in ("db", "redis"):
+                self.histograms[name].observe(labels, metrics.counts.get(name, 0))
+            for name in ("db", "redis", "celery"):
+                self.histograms[f"{name}_seconds"].observe(labels, metrics.seconds.get(name, 0.0))
+            key = labels + (str(status_code),)
+            self.responses[key] = self.responses.get(key, 0) + 1
+
+    def render(self) -> str:
+        with self.lock:
+            lines = ["# HELP bittrade_responses_total Responses by status code.", "# TYPE bittrade_responses_total counter"]
+            for (route, method, status_code), count in sorted(self.responses.items()):
+                lines.append(f'bittrade_responses_total{{route="{route}",method="{method}",status="{status_code}"}} {count}')
+            for histogram in self.histograms.values():
+                lines += histogram.render(self.LABELS)
+        return "\n".join(lines) + "\n"
+
+registry = MetricsRegistry()
+
+def get_route(request) -> str:
+    # URL names keep the label set small, unmatched paths share one label
+    match = getattr(request, "resolver_match", None)
+    return (match.view_name if match else None) or "unmatched"
+
+def record_query(execute, sql, params, many, context):
+    with timed("db"):
+        return execute(sql, params, many, context)
+
+def install_query_recorder(connection, **kwargs):
+    # stays installed; queries outside a measured request are not recorded
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+class RequestMetricsMiddleware:
+    """
+    Records SQL queries, Redis commands, Celery waits and total latency of
+    every request. Adds them as a Server-Timing header and to the
+    histograms of the metrics endpoint. Only loaded with REQUEST_METRICS,
+    otherwise Django drops it from the middleware chain.
+    Runs sync under WSGI and async under ASGI; queries that async views
+    run in threads are recorded too, the metrics follow the context.
+    For streaming responses only the time until the response is returned
+    is measured.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.REQUEST_METRICS:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+        connection_created.connect(install_query_recorder)
+        for connection in connections.all(initialized_only=True):
+            install_query_recorder(connection)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, metrics, time.perf_counter() - start)
+
+    async def __acall__(self, request):
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, metrics, time.perf_counter() - start)
+
+    def finish(self, request, response, metrics: RequestMetrics, total: float):
+        response["Server-Timing"] = metrics.server_timing(total)
+        registry.observe(get_route(request), request.method, response.status_code, metrics, total)
+        return response
+
+class RequestMetricsMixin:
+    """
+    DRF view mixin that splits the time of a view into authentication
+    (with permission and throttle checks) and the handler itself.
+    """
+    def initial(self, request, *args, **kwargs):
+        with timed("auth"):
+            super().initial(request, *args, **kwargs)
+
+    def dispatch(self, request, *args, **kwargs):
+        metrics = _current.get()
+        if metrics is None:
+            return super().dispatch(request, *args, **kwargs)
+        start = time.perf_counter()
+        response = super().dispatch(request, *args, **kwargs)
+        metrics.add("view", time.perf_counter() - start - metrics.seconds.get("auth", 0.0))
+        return response
+
+def is_local_request(request) -> bool:
+    """
+    Direct request from a loopback address. Requests through a proxy are
+    never local, even if the proxy runs on the same host.
+    """
+    if settings.REST_FRAMEWORK.get("NUM_PROXIES") or "HTTP_X_FORWARDED_FOR" in request.META:
+        return False
+    try:
+        return ipaddress.ip_address(request.META.get("REMOTE_ADDR", "")).is_loopback
+    except ValueError:
+        return False
+
+def is_staff_request(request) -> bool:
+    # imported here, users.authentication depends on this module
+    from users.authentication import CookieTokenAuthentication
+    credentials = CookieTokenAuthentication().authenticate(request)
+    return credentials is not None and credentials[0].is_staff
+
+def metrics_view(request):
+    """
+    Prometheus text exposition of the request metrics of this process.
+    Requires the REQUEST_METRICS_TOKEN as bearer token if one is set,
+    otherwise only staff users and local requests are served.
+    """
+    if not settings.REQUEST_METRICS:
+        raise Http404
+    token = settings.REQUEST_METRICS_TOKEN
+    if token:
+        # constant time, so the response time does not tell how much matched
+        if not hmac.compare_digest(request.headers.get("Authorization", "").encode(), f"Bearer {token}".encode()):
+            return HttpResponse(status=401)
+    elif not (is_local_request(request) or is_staff_request(request)):
+        return HttpResponse(status=403)
+    return HttpResponse(registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
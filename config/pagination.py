@@ -0,0 +1,110 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from itertools import islice
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db.models import Q
+from django.http import StreamingHttpResponse
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework.utils.urls import replace_query_param
+
+EXPORT_CHUNK_SIZE = 2000
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination on (created_at, id), newest first. Each page continues
+    after the last row of the previous one with an index range scan, so the
+    cost per page does not grow with the history length (unlike OFFSET).
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    page_size = 100
+    max_page_size = 1000
+    ordering = ('-created_at', '-id')
+
+    def get_page_size(self, request):
+        value = request.query_params.get(self.page_size_query_param)
+        if value is None:
+            return self.page_size
+        try:
+            page_size = int(value)
+        except ValueError:
+            raise ValidationError({'page_size': 'Must be a positive integer.'})
+        if page_size < 1:
+            raise ValidationError({'page_size': 'Must be a positive integer.'})
+        return min(page_size, self.max_page_size)
+
+    def encode_cursor(self, obj):
+        position = f"{obj.created_at.isoformat()}|{obj.pk}"
+        return urlsafe_b64encode(position.encode()).decode().rstrip('=')
+
+    def decode_cursor(self, cursor, model):
+        try:
+            created_at, pk = urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode().split('|')
+            created_at = parse_datetime(created_at)
+            pk = model._meta.pk.to_python(pk)
+        except (ValueError, UnicodeDecodeError, DjangoValidationError):
+            created_at = None
+        if created_at is None:
+            raise ValidationError({'cursor': 'Invalid cursor.'})
+        return created_at, pk
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        page_size = self.get_page_size(request)
+        queryset = queryset.order_by(*self.ordering)
+
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            created_at, pk = self.decode_cursor(cursor, queryset.model)
+            queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, pk__lt=pk))
+
+        rows = list(queryset[:page_size + 1])
+        page = rows[:page_size]
+        self.next_cursor = self.encode_cursor(page[-1]) if len(rows) > page_size else None
+        return page
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, self.next_cursor)
+
+    def get_paginated_response(self, data):
+        return Response({'next': self.get_next_link(), 'results': data})
+
+class TransactionHistoryMixin:
+    """
+    Lists a transaction history as cursor pages (default page size 100) or
+    as streamed NDJSON export (?export=ndjson). The old single list of the
+    whole history is deprecated and only returned with ?paginate=false.
+    """
+    pagination_class = KeysetPagination
+    unpaginated_query_param = 'paginate'
+
+    def list_response(self, request, queryset, serializer_class):
+        if request.query_params.get('export') == 'ndjson':
+            return self.export_ndjson(queryset, serializer_class)
+
+        paginator = self.pagination_class()
+        if request.query_params.get(self.unpaginated_query_param) == 'false':
+            queryset = queryset.order_by(*paginator.ordering)
+            return Response(serializer_class(queryset, many=True).data)
+
+        page = paginator.paginate_queryset(queryset, request, view=self)
+        return paginator.get_paginated_response(serializer_class(page, many=True).data)
+
+    def export_ndjson(self, queryset, serializer_class):
+        queryset = queryset.order_by(*self.pagination_class.ordering)
+
+        def lines():
+            rows = queryset.iterator(chunk_size=EXPORT_CHUNK_SIZE)
+            while chunk := list(islice(rows, EXPORT_CHUNK_SIZE)):
+                data = serializer_class(chunk, many=True).data
+                yield ''.join(json.dumps(row, cls=JSONEncoder) + '\n' for row in data)
+
+        response = StreamingHttpResponse(lines(), content_type='application/x-ndjson')
+        response['Content-Disposition'] = 'attachment; filename="transactions.ndjson"'
+        return response
@@ -56,6 +56,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'config.metrics.RequestMetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -93,6 +94,18 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # writers take the database lock when their transaction starts and
+        # wait up to 20s for it, instead of failing with "database is
+        # locked" when two transactions try to upgrade to a write at once
+        'OPTIONS': {
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        },
+        # a file, as the in-memory test database locks whole tables and
+        # fails concurrent writers instead of letting them wait
+        'TEST': {
+            'NAME': BASE_DIR / 'test_db.sqlite3',
+        },
     }
 }
 
@@ -104,7 +117,8 @@ CACHES = {
         'LOCATION': "redis://127.0.0.1:6379/1",
         'OPTIONS': {
             'PASSWORD': 'foobared',
-            'CLIENT_CLASS': "django_redis.client.DefaultClient"
+            'CLIENT_CLASS': "django_redis.client.DefaultClient",
+            'REDIS_CLIENT_CLASS': "config.metrics.InstrumentedRedis",
             },
         'KEY_PREFIX': "bittrade",
         'TIMEOUT': 24 * 60 * 60,
@@ -172,6 +186,9 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
     ],
+    'DEFAULT_THROTTLE_CLASSES': [
+        'config.throttling.SlidingWindowThrottle',
+    ],
 }
 
 # Token
@@ -180,6 +197,11 @@ AUTH_TOKEN_MODEL = 'users.ExpiringToken'
 
 TOKEN_EXPIRATION_TIME = timedelta(hours=24)
 
+# Authenticated tokens are cached in Redis and, briefly, in every process
+AUTH_TOKEN_CACHE_TTL = 5 * 60  # 5min
+AUTH_TOKEN_LOCAL_CACHE_TTL = 10
+AUTH_TOKEN_LOCAL_CACHE_SIZE = 1024
+
 # Authentication
 
 AUTH_USER_MODEL = 'users.User'
@@ -204,6 +226,39 @@ SECRET_KEY = env('SECRET_KEY')
 COINGECKO_API_URL = env("COINGECKO_API_URL")
 COINGECKO_API_KEY = env("COINGECKO_API_KEY", default=None)
 
+# Calls per minute shared by all workers, burst size and the longest
+# a task sleeps for a token before it is rescheduled instead
+COINGECKO_RATE_LIMIT = env.int("COINGECKO_RATE_LIMIT", default=30)
+COINGECKO_RATE_BURST = env.int("COINGECKO_RATE_BURST", default=5)
+COINGECKO_MAX_TOKEN_WAIT = env.int("COINGECKO_MAX_TOKEN_WAIT", default=5)
+
+# Store the market snapshot served by the coin cache endpoint gzip compressed
+MARKET_SNAPSHOT_COMPRESS = env.bool("MARKET_SNAPSHOT_COMPRESS", default=True)
+
+# Seconds the /auth/me/ stats of a user are cached, 0 disables the cache
+USER_STATS_CACHE_TTL = env.int("USER_STATS_CACHE_TTL", default=300)
+
+# Seconds a valued portfolio is cached, 0 disables the cache. Trades and
+# price refreshes invalidate it earlier.
+PORTFOLIO_CACHE_TTL = env.int("PORTFOLIO_CACHE_TTL", default=60 * 60)
+
+# Per-request SQL, Redis and Celery metrics as Server-Timing headers and on
+# /metrics/ (bearer token protected if a token is set, else only for staff
+# users and direct requests from localhost)
+REQUEST_METRICS = env.bool("REQUEST_METRICS", default=False)
+REQUEST_METRICS_TOKEN = env("REQUEST_METRICS_TOKEN", default=None)
+
+# Sliding-window limits of all API routes as (cost, seconds), per user and
+# per client IP. Expensive routes cost more than 1 (throttle_costs on the
+# view). Leaving out an identity, or {}, disables its limit.
+API_RATE_LIMITS = {
+    "user": (env.int("API_RATE_LIMIT_USER", default=600), 60),
+    "ip": (env.int("API_RATE_LIMIT_IP", default=1200), 60),
+}
+# Reverse proxies in front of the app: the client IP of the rate limit is
+# taken from X-Forwarded-For only behind this many proxies, else REMOTE_ADDR
+REST_FRAMEWORK['NUM_PROXIES'] = env.int("NUM_PROXIES", default=0)
+
 # Mail
 
 EMAIL_USE_TLS = True
@@ -213,3 +268,11 @@ EMAIL_HOST_USER = env('EMAIL_HOST_USER', default='')
 EMAIL_HOST_PASSWORD = env('EMAIL_HOST_PASSWORD', default='')
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 DEFAULT_FROM_EMAIL = 'noreply@bittrade.andre-kempf.com'
+EMAIL_TIMEOUT = 10
+
+# Mail is queued in Redis and sent by a Celery task over one reused SMTP
+# connection per worker: up to EMAIL_BATCH_SIZE messages per run, messages
+# queued within EMAIL_BATCH_DELAY seconds share a run. Messages that keep
+# failing end up in the mail:dead list (see users.tasks). Needs Redis 6.2+
+EMAIL_BATCH_SIZE = env.int("EMAIL_BATCH_SIZE", default=50)
+EMAIL_BATCH_DELAY = env.int("EMAIL_BATCH_DELAY", default=2)
@@ -0,0 +1,20 @@
+from django.db import connection, transaction
+
+
+class QueryPlanAssertionsMixin:
+    """
+    Test helpers that check the database plan of a query with EXPLAIN.
+    Sequential scans are disabled on PostgreSQL, so the planner does not
+    prefer them for the small tables of a test database.
+    """
+
+    def get_query_plan(self, queryset) -> str:
+        with transaction.atomic():
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute('SET LOCAL enable_seqscan = off')
+            return queryset.explain()
+
+    def assertUsesIndex(self, queryset, index_name):
+        plan = self.get_query_plan(queryset)
+        self.assertIn(index_name, plan, f"{index_name} not used:\n{plan}")
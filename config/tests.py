@@ -0,0 +1,235 @@
+import re
+import time
+from unittest import mock
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
+from django.test import AsyncClient, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django_redis import get_redis_connection
+from redis import Redis
+from redis.exceptions import ConnectionError
+from rest_framework.permissions import AllowAny
+from rest_framework.response import Response
+from rest_framework.test import APIClient, APIRequestFactory, force_authenticate
+from rest_framework.views import APIView
+
+from config.metrics import InstrumentedRedis, RequestMetrics, _current, registry, timed
+from config.throttling import SlidingWindowThrottle
+from users.authentication import local_tokens
+
+def instrumented_caches():
+    default = settings.CACHES["default"]
+    options = {**default["OPTIONS"], "REDIS_CLIENT_CLASS": "config.metrics.InstrumentedRedis"}
+    return {"default": {**default, "OPTIONS": options}}
+
+def parse_server_timing(header: str) -> dict:
+    entries = {}
+    for entry in header.split(", "):
+        name, *params = entry.split(";")
+        entries[name] = dict(param.split("=", 1) for param in params)
+    return entries
+
+class RequestMetricsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        local_tokens.clear()
+        registry.reset()
+        get_user_model().objects.create_user(email="metrics@example.com", password="secret123")
+        response = APIClient().post(reverse('login'), {'email': 'metrics@example.com', 'password': 'secret123'})
+        self.cookies = response.cookies
+
+    def get(self, path, **extra):
+        # a new client, its handler loads the middleware with the current settings
+        client = APIClient()
+        client.cookies = self.cookies
+        return client.get(path, **extra)
+
+    def test_disabled_metrics_add_nothing(self):
+        response = self.get(reverse('me'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("Server-Timing", response)
+        self.assertEqual(self.get(reverse('metrics')).status_code, 404)
+
+    @override_settings(REQUEST_METRICS=True)
+    def test_server_timing_counts_queries_and_redis_commands(self):
+        with override_settings(CACHES=instrumented_caches()):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.get(reverse('me'))
+
+        self.assertEqual(response.status_code, 200)
+        timing = parse_server_timing(response["Server-Timing"])
+        self.assertEqual(timing["db"]["desc"], f'"{len(queries)} queries"')
+        self.assertRegex(timing["redis"]["desc"], r'^"[1-9]\d* commands"$')
+        self.assertEqual({"total", "db", "redis", "auth", "view"} - timing.keys(), set())
+        self.assertGreaterEqual(float(timing["total"]["dur"]), float(timing["view"]["dur"]))
+
+    @override_settings(REQUEST_METRICS=True)
+    def test_metrics_endpoint_renders_histograms(self):
+        self.get(reverse('me'))
+        self.get(reverse('me'))
+        self.get("/missing/")
+
+        body = self.get(reverse('metrics')).content.decode()
+
+        self.assertIn('bittrade_responses_total{route="me",method="GET",status="200"} 2', body)
+        self.assertIn('bittrade_responses_total{route="unmatched",method="GET",status="404"} 1', body)
+        self.assertIn('bittrade_request_duration_seconds_count{route="me",method="GET"} 2', body)
+        self.assertIn('bittrade_request_db_queries_bucket{route="me",method="GET",le="+Inf"} 2', body)
+        buckets = re.findall(r'bittrade_request_duration_seconds_bucket\{route="me",method="GET",le="[^"]+"\} (\d+)', body)
+        self.assertEqual([int(count) for count in buckets], sorted(int(count) for count in buckets))
+
+    @override_settings(REQUEST_METRICS=True, REQUEST_METRICS_TOKEN="scrape-token")
+    def test_metrics_endpoint_requires_token(self):
+        self.assertEqual(self.get(reverse('metrics')).status_code, 401)
+        response = self.get(reverse('metrics'), HTTP_AUTHORIZATION="Bearer scrape-token")
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(REQUEST_METRICS=True)
+    def test_metrics_endpoint_without_token_is_local_or_staff_only(self):
+        remote = {"REMOTE_ADDR": "203.0.113.5"}
+        self.assertEqual(self.get(reverse('metrics'), **remote).status_code, 403)
+        self.assertEqual(self.get(reverse('metrics'), HTTP_X_FORWARDED_FOR="203.0.113.5").status_code, 403)
+        self.assertEqual(APIClient().get(reverse('metrics')).status_code, 200)
+
+        get_user_model().objects.filter(email="metrics@example.com").update(is_staff=True)
+        cache.clear()
+        local_tokens.clear()
+        self.assertEqual(self.get(reverse('metrics'), **remote).status_code, 200)
+
+    @override_settings(REQUEST_METRICS=True, ROOT_URLCONF="config.asgi_urls")
+    async def test_async_views_are_measured(self):
+        client = AsyncClient()
+        client.cookies = self.cookies
+        response = await client.get(reverse('coin-cache'))
+
+        self.assertEqual(response.status_code, 200)
+        timing = parse_server_timing(response["Server-Timing"])
+        self.assertRegex(timing["redis"]["desc"], r'^"[1-9]\d* commands"$')
+        self.assertEqual({"total", "auth", "view"} - timing.keys(), set())
+        self.assertIn('bittrade_request_duration_seconds_count{route="coin-cache",method="GET"} 1', registry.render())
+
+class MetricsRecordingTests(TestCase):
+    def test_timed_outside_a_request_is_a_no_op(self):
+        with timed("celery"):
+            pass
+        self.assertIsNone(_current.get())
+
+    def test_redis_commands_and_pipelines_are_counted(self):
+        with override_settings(CACHES=instrumented_caches()):
+            client = get_redis_connection("default")
+            self.assertIsInstance(client, InstrumentedRedis)
+
+            metrics = RequestMetrics()
+            token = _current.set(metrics)
+            try:
+                client.set("metrics-test", 1)
+                with timed("celery"):
+                    client.get("metrics-test")
+                pipeline = client.pipeline()
+                pipeline.incr("metrics-test").incr("metrics-test").delete("metrics-test")
+                pipeline.execute()
+            finally:
+                _current.reset(token)
+
+        self.assertEqual(metrics.counts, {"redis": 5, "celery": 1})
+        self.assertGreater(metrics.seconds["celery"], 0)
+
+class ThrottledView(APIView):
+    permission_classes = [AllowAny]
+    throttle_classes = [SlidingWindowThrottle]
+    throttle_costs = {"POST": 5}
+
+    def get(self, request):
+        return Response({})
+
+    def post(self, request):
+        return Response({})
+
+@override_settings(API_RATE_LIMITS={"user": (10, 60), "ip": (20, 60)})
+class SlidingWindowThrottleTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.factory = APIRequestFactory()
+        self.view = ThrottledView.as_view()
+        self.user = get_user_model().objects.create_user(email="throttle@example.com", password="secret123")
+
+    def request(self, method="get", user=None, ip="10.0.0.1", **extra):
+        request = getattr(self.factory, method)("/throttled/", REMOTE_ADDR=ip, **extra)
+        if user is not None:
+            force_authenticate(request, user=user)
+        return self.view(request)
+
+    def test_routes_are_weighted_by_cost(self):
+        self.assertEqual(self.request("post", self.user).status_code, 200)
+        self.assertEqual(self.request("post", self.user).status_code, 200)
+
+        response = self.request("get", self.user)
+
+        self.assertEqual(response.status_code, 429)
+        self.assertGreaterEqual(int(response["Retry-After"]), 1)
+        # the counted cost slides out evenly over the next window
+        self.assertLessEqual(int(response["Retry-After"]), 2 * 60)
+
+    def test_ip_limit_is_shared_by_all_users_of_an_ip(self):
+        other = get_user_model().objects.create_user(email="other@example.com", password="secret123")
+        for user in (self.user, self.user, other, other):
+            self.assertEqual(self.request("post", user).status_code, 200)
+
+        self.assertEqual(self.request("get").status_code, 429)
+        self.assertEqual(self.request("get", ip="10.0.0.2").status_code, 200)
+
+    def test_forwarded_for_header_does_not_change_the_ip(self):
+        for index in range(4):
+            self.assertEqual(self.request("post", HTTP_X_FORWARDED_FOR=f"192.0.2.{index}").status_code, 200)
+        self.assertEqual(self.request("get", HTTP_X_FORWARDED_FOR="192.0.2.99").status_code, 429)
+
+    @override_settings(REST_FRAMEWORK={**settings.REST_FRAMEWORK, "NUM_PROXIES": 1})
+    def test_client_ip_is_taken_from_the_proxy_header(self):
+        # the proxy appends the address it saw; earlier entries are up to the client
+        for index in range(4):
+            self.request("post", HTTP_X_FORWARDED_FOR=f"198.51.100.{index}, 192.0.2.1")
+        self.assertEqual(self.request("get", HTTP_X_FORWARDED_FOR="198.51.100.9, 192.0.2.1").status_code, 429)
+        self.assertEqual(self.request("get", HTTP_X_FORWARDED_FOR="192.0.2.2").status_code, 200)
+
+    def test_blocked_requests_are_not_counted(self):
+        for _ in range(10):
+            self.request("get", self.user)
+        self.assertEqual(self.request("get", self.user).status_code, 429)
+
+        # only the 10 allowed requests count against the IP
+        for _ in range(10):
+            self.assertEqual(self.request("get", ip="10.0.0.1").status_code, 200)
+
+    @override_settings(API_RATE_LIMITS={"ip": (2, 0.2)})
+    def test_window_slides(self):
+        self.request()
+        self.request()
+        throttle = SlidingWindowThrottle()
+        request = self.factory.get("/throttled/", REMOTE_ADDR="10.0.0.1")
+        self.assertFalse(throttle.allow_request(ThrottledView().initialize_request(request), None))
+
+        time.sleep(throttle.wait())
+
+        self.assertEqual(self.request().status_code, 200)
+
+    @override_settings(API_RATE_LIMITS={})
+    def test_empty_limits_skip_redis(self):
+        with mock.patch("config.throttling.get_script") as get_script:
+            for _ in range(30):
+                self.assertEqual(self.request("post", self.user).status_code, 200)
+        get_script.assert_not_called()
+
+    def test_unavailable_redis_lets_requests_through(self):
+        with mock.patch("config.throttling.get_script", side_effect=ConnectionError):
+            for _ in range(30):
+                self.assertEqual(self.request("post", self.user).status_code, 200)
+
+    def test_check_is_a_single_round_trip(self):
+        self.request("get", self.user)
+        with mock.patch.object(Redis, "execute_command", autospec=True, side_effect=Redis.execute_command) as execute:
+            self.request("get", self.user)
+        self.assertEqual(execute.call_count, 1)
@@ -0,0 +1,146 @@
+from django.conf import settings
+from django.core.cache import cache
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+from rest_framework.throttling import BaseThrottle
+
+from config.async_cache import get_async_redis
+
+# Sliding window counter per identity (user, client IP): a hash with the
+# index of the current window and the cost spent in it and in the window
+# before. The previous window counts with the share it still overlaps the
+# sliding window. A request is only counted if every identity allows it.
+# ARGV: cost, then limit and window (ms) per key. Returns 0 if allowed,
+# otherwise the milliseconds until the cost fits into every window.
+SLIDING_WINDOW_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+
+local wait = 0
+local updates = {}
+for i, key in ipairs(KEYS) do
+    local limit = tonumber(ARGV[i * 2])
+    local window = tonumber(ARGV[i * 2 + 1])
+    local cost = math.min(tonumber(ARGV[1]), limit)
+    local index = math.floor(now / window)
+    local elapsed = now - index * window
+
+    local state = redis.call('HMGET', key, 'index', 'current', 'previous')
+    local stored = tonumber(state[1]) or index
+    local current = tonumber(state[2]) or 0
+    local previous = tonumber(state[3]) or 0
+    if stored == index - 1 then
+        previous, current = current, 0
+    elseif stored ~= index then
+        previous, current = 0, 0
+    end
+
+    if previous * (window - elapsed) / window + current + cost > limit then
+        local key_wait
+        if current + cost <= limit then
+            -- fits once enough of the previous window slid out
+            key_wait = window - elapsed - (limit - current - cost) * window / previous
+        else
+            -- fits in the next window, once enough of this one slid out
+            key_wait = 2 * window - elapsed - (limit - cost) * window / current
+        end
+        wait = math.max(wait, key_wait)
+    end
+    updates[i] = {index, current + cost, previous, window}
+end
+
+if wait > 0 then
+    return math.max(1, math.ceil(wait))
+end
+for i, key in ipairs(KEYS) do
+    local update = updates[i]
+    redis.call('HSET', key, 'index', update[1], 'current', update[2], 'previous', update[3])
+    redis.call('PEXPIRE', key, update[4] * 2)
+end
+return 0
+"""
+
+_script = None
+_async_script = None
+
+def get_script():
+    global _script
+    if _script is None:
+        _script = get_redis_connection("default").register_script(SLIDING_WINDOW_SCRIPT)
+    return _script
+
+def get_async_script():
+    global _async_script
+    client = get_async_redis()
+    if _async_script is None or _async_script.registered_client is not client:
+        _async_script = client.register_script(SLIDING_WINDOW_SCRIPT)
+    return _async_script
+
+class SlidingWindowThrottle(BaseThrottle):
+    """
+    Rate limit of all API routes (API_RATE_LIMITS), per user and per client
+    IP, checked and counted with one Lua script call. Views weight their
+    expensive methods with throttle_costs = {"POST": 10}; everything else
+    costs 1. If Redis is unavailable, requests are let through.
+    """
+    def __init__(self):
+        self.wait_seconds = None
+
+    def get_cost(self, request, view) -> int:
+        return getattr(view, "throttle_costs", {}).get(request.method, 1)
+
+    def get_limits(self, request) -> list:
+        """
+        (redis key, limit, window in seconds) of every identity of the request.
+        """
+        limits = settings.API_RATE_LIMITS
+        keys = []
+        if "user" in limits and request.user and request.user.is_authenticated:
+            keys.append((f"ratelimit:user:{request.user.pk}", *limits["user"]))
+        if "ip" in limits:
+            keys.append((f"ratelimit:ip:{self.get_ident(request)}", *limits["ip"]))
+        return keys
+
+    def get_script_args(self, request, view):
+        """
+        Keys and arguments of the script call, None if no limit applies.
+        """
+        limits = self.get_limits(request)
+        if not limits:
+            return None
+        args = [self.get_cost(request, view)]
+        for _, limit, window in limits:
+            args += [limit, int(window * 1000)]
+        return [cache.make_key(key) for key, _, _ in limits], args
+
+    def allow_request(self, request, view) -> bool:
+        call = self.get_script_args(request, view)
+        if call is None:
+            return True
+        try:
+            wait_ms = get_script()(*call)
+        except RedisError:
+            return True
+        return self.check_wait(wait_ms)
+
+    async def aallow_request(self, request, view) -> bool:
+        """
+        allow_request for async views, with the async Redis client.
+        """
+        call = self.get_script_args(request, view)
+        if call is None:
+            return True
+        try:
+            wait_ms = await get_async_script()(*call)
+        except RedisError:
+            return True
+        return self.check_wait(wait_ms)
+
+    def check_wait(self, wait_ms) -> bool:
+        if wait_ms:
+            self.wait_seconds = int(wait_ms) / 1000
+            return False
+        return True
+
+    def wait(self):
+        return self.wait_seconds
@@ -6,8 +6,9 @@ from django.views.generic import RedirectView
 
 from users.views import LoginView, LogoutView, MeView, MeUpdateView, PasswordResetConfirmView, RegisterView, PasswordResetRequestView, ConfirmEmailView
 from wallets.views import MyWalletView, DepositWalletView, WithdrawWalletView, WalletTransactionsView
-from coins.views import CoinView, MyCoinTransactionView, MyCoinTransactionsView, MyCoinHoldingView, MyCoinHoldingsView
-from caches.views import CoinCacheView, SingleCoinCacheView
+from coins.views import CoinView, MyCoinTradeView, MyCoinTransactionImportView, MyCoinTransactionView, MyCoinTransactionsView, MyCoinHoldingView, MyCoinHoldingsView, MyCoinPortfolioHistoryView, MyCoinPortfolioView
+from caches.views import CoinCacheJobView, CoinCacheView, CoinChartView, SingleCoinCacheView
+from config.metrics import metrics_view
 
 urlpatterns = [
     # Admin
@@ -27,9 +28,13 @@ urlpatterns = [
     
     # user coins
     path('api/me/coin/transactions/', MyCoinTransactionsView.as_view(), name='my-coin-transactions'),
+    path('api/me/coin/transactions/import/', MyCoinTransactionImportView.as_view(), name='my-coin-transactions-import'),
     path('api/me/coin/transaction/<str:coin_id>/', MyCoinTransactionView.as_view(), name='my-coin-transaction'),
+    path('api/me/coin/trade/<str:coin_id>/', MyCoinTradeView.as_view(), name='my-coin-trade'),
     path('api/me/coin/holdings/', MyCoinHoldingsView.as_view(), name='my-coin-holdings'),
     path('api/me/coin/holding/<str:coin_id>/', MyCoinHoldingView.as_view(), name='my-coin-holding'),
+    path('api/me/coin/portfolio/', MyCoinPortfolioView.as_view(), name='my-coin-portfolio'),
+    path('api/me/coin/portfolio/history/', MyCoinPortfolioHistoryView.as_view(), name='my-coin-portfolio-history'),
     
     #user wallet
     path('api/me/wallet/', MyWalletView.as_view(), name='my-wallet'),
@@ -43,7 +48,12 @@ urlpatterns = [
 
     # coins cache
     path("api/coins/cache/", CoinCacheView.as_view(), name="coin-cache"),
+    path("api/coins/cache/jobs/<str:job_id>/", CoinCacheJobView.as_view(), name="coin-cache-job"),
     path("api/coins/cache/<str:kind>/<str:slug>/", SingleCoinCacheView.as_view(), name="cache-single-coin"),
+    path("api/coins/chart/<str:slug>/", CoinChartView.as_view(), name="coin-chart"),
+
+    # Metrics
+    path('metrics/', metrics_view, name='metrics'),
 
     # Favicon
     path('favicon.ico', RedirectView.as_view(url='/static/favicon.ico', permanent=True)),
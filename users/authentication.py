@@ -1,8 +1,106 @@
+import hashlib
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
 from rest_framework.authentication import TokenAuthentication
+
+from config.async_cache import aget, aset
 from .models import ExpiringToken
 
+class LocalTokenCache:
+    """
+    Small thread-safe LRU of tokens for the current process. Entries live
+    for a few seconds only, which bounds how long another process can still
+    accept a token that was invalidated elsewhere. Entries are kept pickled,
+    so requests never share (and mutate) the same user instance.
+    """
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+        return pickle.loads(value)
+
+    def set(self, key, value):
+        value = pickle.dumps(value)
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+# never cached with the user
+USER_CREDENTIAL_FIELDS = ('password',)
+
+local_tokens = LocalTokenCache(settings.AUTH_TOKEN_LOCAL_CACHE_SIZE, settings.AUTH_TOKEN_LOCAL_CACHE_TTL)
+
+def token_hash(key: str) -> str:
+    return hashlib.sha256(key.encode()).hexdigest()
+
+def token_cache_key(key: str) -> str:
+    # hashed, so raw tokens never show up in Redis
+    return f"auth-token:{token_hash(key)}"
+
+def user_cache_key(user_id) -> str:
+    return f"auth-user:{user_id}"
+
+def token_entry(token) -> dict:
+    """
+    What is cached of a token: neither the key nor the user.
+    """
+    return {'user_id': token.user_id, 'expires_at': token.expires_at, 'is_active': token.user.is_active}
+
+def detached_user(token):
+    """
+    The token's user without the reverse relation back to the token that
+    select_related sets, so the key is not cached along with the user.
+    """
+    user = token.user
+    user._state.fields_cache.clear()
+    return user
+
+def invalidate_user(user_id):
+    cache.delete(user_cache_key(user_id))
+
+def invalidate_token(key: str):
+    """
+    Removes a token from this process and from Redis.
+    """
+    local_tokens.delete(token_hash(key))
+    cache.delete(token_cache_key(key))
+
 class CookieTokenAuthentication(TokenAuthentication):
-    model = ExpiringToken 
+    """
+    Token auth from the auth_token cookie. Tokens are looked up in a
+    per-process LRU, then in Redis, then in the database. Redis holds a small
+    entry per token hash (user_id, expires_at, is_active) and, separately,
+    the user without its password. Token renewal, logout and user changes
+    invalidate the cached entries (see users.signals).
+    """
+    model = ExpiringToken
 
     def authenticate(self, request):
         token = request.COOKIES.get('auth_token')
@@ -10,13 +108,75 @@ class CookieTokenAuthentication(TokenAuthentication):
             return None
         return self.authenticate_credentials(token)
 
-    def authenticate_credentials(self, key):
-        try:
-            token = self.model.objects.select_related('user').get(key=key)
-        except self.model.DoesNotExist:
+    def get_queryset(self):
+        return self.model.objects.select_related('user').defer(*(f'user__{field}' for field in USER_CREDENTIAL_FIELDS))
+
+    def get_token(self, key):
+        hashed = token_hash(key)
+        cached = local_tokens.get(hashed)
+        if cached is not None:
+            return self.build_token(key, *cached)
+
+        entry = cache.get(token_cache_key(key))
+        user = cache.get(user_cache_key(entry['user_id'])) if entry else None
+        if user is None:
+            token = self.get_queryset().filter(key=key).first()
+            if token is None or token.is_expired():
+                return None
+            entry, user = token_entry(token), detached_user(token)
+            cache.set(token_cache_key(key), entry, timeout=self.get_cache_timeout(token))
+            cache.set(user_cache_key(user.pk), user, timeout=settings.AUTH_TOKEN_CACHE_TTL)
+        local_tokens.set(hashed, (entry, user))
+        return self.build_token(key, entry, user)
+
+    async def aget_token(self, key):
+        """
+        get_token for async views: Redis is read with the async client, only
+        a token missing from both caches is loaded in a thread.
+        """
+        hashed = token_hash(key)
+        cached = local_tokens.get(hashed)
+        if cached is not None:
+            return self.build_token(key, *cached)
+
+        entry = await aget(token_cache_key(key))
+        user = await aget(user_cache_key(entry['user_id'])) if entry else None
+        if user is None:
+            token = await self.get_queryset().filter(key=key).afirst()
+            if token is None or token.is_expired():
+                return None
+            entry, user = token_entry(token), detached_user(token)
+            await aset(token_cache_key(key), entry, timeout=self.get_cache_timeout(token))
+            await aset(user_cache_key(user.pk), user, timeout=settings.AUTH_TOKEN_CACHE_TTL)
+        local_tokens.set(hashed, (entry, user))
+        return self.build_token(key, entry, user)
+
+    def build_token(self, key, entry, user):
+        """
+        Unsaved token for request.auth, rebuilt from the cached entry.
+        """
+        if not entry['is_active']:
+            return None
+        return self.model(key=key, user=user, expires_at=entry['expires_at'])
+
+    def get_cache_timeout(self, token) -> int:
+        ttl = min(settings.AUTH_TOKEN_CACHE_TTL, (token.expires_at - timezone.now()).total_seconds())
+        return max(1, int(ttl))
+
+    def get_credentials(self, token):
+        if token is None:
             return None
 
         if token.is_expired() or not token.user.is_active:
             return None
 
-        return (token.user, token)
\ No newline at end of file
+        return (token.user, token)
+
+    def authenticate_credentials(self, key):
+        return self.get_credentials(self.get_token(key))
+
+    async def aauthenticate(self, request):
+        token = request.COOKIES.get('auth_token')
+        if not token:
+            return None
+        return self.get_credentials(await self.aget_token(token))
@@ -4,11 +4,12 @@ from rest_framework.exceptions import AuthenticationFailed
 from rest_framework.validators import UniqueValidator
 from django.contrib.auth import get_user_model, authenticate
 from django.contrib.auth.tokens import default_token_generator
-from django.core.mail import send_mail
 from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode
 from django.utils.encoding import force_bytes
 from django.contrib.auth.hashers import make_password
 
+from users.tasks import queue_email
+
 User = get_user_model()
 
 class UserLoginSerializer(serializers.Serializer):
@@ -69,7 +70,7 @@ class PasswordResetRequestSerializer(serializers.Serializer):
         token = default_token_generator.make_token(user)
         reset_link = f"http://localhost:4200/auth/reset-password?uid={uid}&token={token}"
 
-        send_mail(
+        queue_email(
             subject="Password Reset Request",
             message=f"Click the link to reset your password: {reset_link}",
             from_email="noreply@your-domain.com",
@@ -153,7 +154,7 @@ class UserUpdateSerializer(serializers.ModelSerializer):
         uid = urlsafe_base64_encode(force_bytes(user.pk))
         verify_url = f"http://localhost:4200/auth/verify-email/?uid={uid}&token={token}"
 
-        send_mail(
+        queue_email(
             subject="Confirm your new email",
             message=f"Click the link to confirm your new email address: {verify_url}",
             from_email="noreply@your-domain.com",
@@ -0,0 +1,47 @@
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from coins.models import CoinHolding, CoinTransaction
+from users.authentication import invalidate_token, invalidate_user
+from users.models import ExpiringToken
+from users.utils import invalidate_user_stats
+from wallets.models import Wallet, WalletTransaction
+
+User = get_user_model()
+
+@receiver([post_save, post_delete], sender=ExpiringToken)
+def invalidate_cached_token(sender, instance, **kwargs):
+    """
+    Renewal (new expires_at), logout and expiry cleanup.
+    """
+    invalidate_token(instance.key)
+
+@receiver(post_save, sender=User)
+def invalidate_cached_user_token(sender, instance, created, **kwargs):
+    """
+    Deactivation and profile changes must not be served from the cached
+    user or token entries.
+    """
+    if not created:
+        invalidate_user(instance.pk)
+        for key in ExpiringToken.objects.filter(user=instance).values_list('key', flat=True):
+            invalidate_token(key)
+
+@receiver([post_save, post_delete], sender=CoinTransaction)
+@receiver([post_save, post_delete], sender=CoinHolding)
+def invalidate_coin_stats(sender, instance, **kwargs):
+    invalidate_user_stats(instance.user_id)
+
+@receiver([post_save, post_delete], sender=WalletTransaction)
+def invalidate_wallet_stats(sender, instance, **kwargs):
+    """
+    Uses the wallet the transaction was saved with (see WalletTransaction.save)
+    and only queries the owner if it is not loaded, e.g. for queryset deletes.
+    """
+    wallet = instance._state.fields_cache.get('wallet')
+    if wallet is not None and 'user_id' not in wallet.get_deferred_fields():
+        user_id = wallet.user_id
+    else:
+        user_id = Wallet.objects.filter(pk=instance.wallet_id).values_list('user_id', flat=True).first()
+    invalidate_user_stats(user_id)
@@ -0,0 +1,226 @@
+import json
+import os
+import smtplib
+from celery import shared_task
+from celery.utils.log import get_task_logger
+from django.conf import settings
+from django.core.cache import cache
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django_redis import get_redis_connection
+
+QUEUE_KEY = "mail:queue"
+# Messages taken by the running send run until they are sent or requeued
+PROCESSING_KEY = "mail:processing"
+# Messages that failed transiently MAX_ATTEMPTS times, kept for inspection
+DEAD_LETTER_KEY = "mail:dead"
+# Set while a send run is scheduled, so a burst of messages shares one run
+SCHEDULED_KEY = "mail:scheduled"
+# Held by the running send run, only one run at a time owns PROCESSING_KEY
+SENDING_KEY = "mail:sending"
+SENDING_TIMEOUT = 10 * 60  # 10min
+MAX_RETRIES = 5
+MAX_ATTEMPTS = 5
+MAX_BACKOFF = 5 * 60  # 5min
+
+logger = get_task_logger(__name__)
+
+_connection = None
+_connection_key = None
+
+def get_mail_connection():
+    """
+    Returns an open mail connection for the current worker process, reused
+    by all send runs. A new connection is opened after a fork or when the
+    mail settings change.
+    """
+    global _connection, _connection_key
+    key = (os.getpid(), settings.EMAIL_BACKEND, settings.EMAIL_HOST, settings.EMAIL_PORT)
+    if _connection is None or _connection_key != key:
+        close_mail_connection()
+        _connection, _connection_key = get_connection(fail_silently=False), key
+    _connection.open()
+    return _connection
+
+def close_mail_connection():
+    global _connection
+    if _connection is not None:
+        try:
+            _connection.close()
+        except Exception:
+            pass
+        _connection = None
+
+def queue_email(subject: str, message: str, from_email: str, recipient_list: list):
+    """
+    Queues a message in Redis once the surrounding transaction commits and
+    schedules a send run unless one is already scheduled. Messages queued
+    within EMAIL_BATCH_DELAY are sent together.
+    """
+    data = {"subject": subject, "body": message, "from_email": from_email, "to": list(recipient_list)}
+
+    def push():
+        get_redis_connection("default").rpush(cache.make_key(QUEUE_KEY), json.dumps(data))
+        schedule_send()
+
+    # nothing is queued for a rolled back transaction
+    transaction.on_commit(push)
+
+def schedule_send(countdown: float = None):
+    # the flag outlives the delay, so a lost run is rescheduled eventually
+    if countdown is None:
+        countdown = settings.EMAIL_BATCH_DELAY
+    if cache.add(SCHEDULED_KEY, 1, timeout=countdown + 60):
+        try:
+            send_queued_emails.apply_async(countdown=countdown)
+        except Exception:
+            # the messages stay queued for the next run
+            pass
+
+def pop_emails(count: int) -> list:
+    """
+    Moves up to count messages from the front of the queue to the processing
+    list (LMOVE) and returns them as (raw, data) pairs. They stay there until
+    they are acknowledged or requeued, so a crashed run loses nothing.
+    """
+    pipeline = get_redis_connection("default").pipeline()
+    for _ in range(count):
+        pipeline.lmove(cache.make_key(QUEUE_KEY), cache.make_key(PROCESSING_KEY), "LEFT", "RIGHT")
+    return [(item, json.loads(item)) for item in pipeline.execute() if item is not None]
+
+def recover_emails() -> int:
+    """
+    Moves the messages an interrupted run left in the processing list back
+    to the front of the queue, in order.
+    """
+    redis, recovered = get_redis_connection("default"), 0
+    while redis.lmove(cache.make_key(PROCESSING_KEY), cache.make_key(QUEUE_KEY), "RIGHT", "LEFT") is not None:
+        recovered += 1
+    return recovered
+
+def ack_email(raw):
+    get_redis_connection("default").lrem(cache.make_key(PROCESSING_KEY), 1, raw)
+
+def requeue_emails(messages: list):
+    """
+    Puts unsent (raw, data) messages back at the front of the queue, in
+    order, with their current data.
+    """
+    if messages:
+        pipeline = get_redis_connection("default").pipeline()
+        pipeline.lpush(cache.make_key(QUEUE_KEY), *[json.dumps(data) for _, data in reversed(messages)])
+        for raw, _ in messages:
+            pipeline.lrem(cache.make_key(PROCESSING_KEY), 1, raw)
+        pipeline.execute()
+
+def dead_letter_email(raw, data: dict, error: Exception):
+    pipeline = get_redis_connection("default").pipeline()
+    pipeline.rpush(cache.make_key(DEAD_LETTER_KEY), json.dumps({**data, "error": str(error)}))
+    pipeline.lrem(cache.make_key(PROCESSING_KEY), 1, raw)
+    pipeline.execute()
+
+def queued_emails() -> int:
+    return get_redis_connection("default").llen(cache.make_key(QUEUE_KEY))
+
+def is_connection_error(error: Exception) -> bool:
+    """
+    Failures of the connection rather than of one message: the server is
+    unreachable, drops the connection or refuses the greeting or login
+    (e.g. 535). Every message of the batch would fail the same way.
+    """
+    if isinstance(error, (
+        smtplib.SMTPConnectError, smtplib.SMTPHeloError, smtplib.SMTPAuthenticationError,
+        smtplib.SMTPNotSupportedError, smtplib.SMTPServerDisconnected,
+    )):
+        return True
+    # SMTPException is an OSError too
+    return isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException)
+
+def is_transient(error: Exception) -> bool:
+    """
+    4xx replies to a message are worth a retry, 5xx replies (unknown
+    recipient, rejected content) are not.
+    """
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    return isinstance(error, smtplib.SMTPException)
+
+def send_email(data: dict):
+    message = EmailMessage(data["subject"], data["body"], data["from_email"], data["to"])
+    try:
+        get_mail_connection().send_messages([message])
+    except smtplib.SMTPServerDisconnected:
+        # the reused connection was closed by the server while idle
+        close_mail_connection()
+        get_mail_connection().send_messages([message])
+
+def requeue_after_failure(messages: list, error: Exception) -> int:
+    """
+    Requeues the failed message and the rest of the batch, returns how many
+    were requeued. A connection error is not the message's fault; otherwise
+    the message counts an attempt and is dead-lettered after MAX_ATTEMPTS.
+    """
+    if not is_connection_error(error):
+        (raw, data), messages = messages[0], messages[1:]
+        data = {**data, "attempts": data.get("attempts", 0) + 1}
+        if data["attempts"] >= MAX_ATTEMPTS:
+            logger.error("Email %r to %s failed %d times, dead-lettered: %s", data["subject"], data["to"], data["attempts"], error)
+            dead_letter_email(raw, data, error)
+        else:
+            messages = [(raw, data), *messages]
+    requeue_emails(messages)
+    return len(messages)
+
+@shared_task(bind=True, max_retries=MAX_RETRIES)
+def send_queued_emails(self):
+    """
+    Sends up to EMAIL_BATCH_SIZE queued messages over the reused connection.
+    Messages are moved to a processing list while they are sent and only
+    removed once sent, a run that died midway is recovered by the next one.
+    On a connection error or a transient failure the unsent messages go back
+    to the front of the queue and the run is retried with exponential
+    backoff, after the last retry a new run is scheduled. Messages that fail
+    permanently are dropped, those that keep failing are dead-lettered. A
+    run that leaves mail queued schedules the next one.
+    """
+    cache.delete(SCHEDULED_KEY)
+    if not cache.add(SENDING_KEY, 1, timeout=SENDING_TIMEOUT):
+        # the running run schedules the next one if mail is left
+        return "another run is sending"
+
+    sent, dropped, requeued, failure = 0, 0, 0, None
+    try:
+        recovered = recover_emails()
+        if recovered:
+            logger.warning("Recovered %d emails of an interrupted send run", recovered)
+        batch = pop_emails(settings.EMAIL_BATCH_SIZE)
+        for index, (raw, data) in enumerate(batch):
+            try:
+                send_email(data)
+            except Exception as e:
+                if is_connection_error(e) or is_transient(e):
+                    close_mail_connection()
+                    requeued, failure = requeue_after_failure(batch[index:], e), e
+                    break
+                logger.warning("Email %r to %s dropped: %s", data["subject"], data["to"], e)
+                dropped += 1
+            else:
+                sent += 1
+            ack_email(raw)
+    finally:
+        cache.delete(SENDING_KEY)
+
+    if failure is not None:
+        if self.request.retries >= self.max_retries:
+            # out of retries: a new run sends them later, even if no more mail is queued
+            schedule_send(countdown=MAX_BACKOFF)
+        elif cache.add(SCHEDULED_KEY, 1, timeout=MAX_BACKOFF + 60):
+            raise self.retry(exc=failure, countdown=min(MAX_BACKOFF, 2 ** self.request.retries))
+        # otherwise another run is already scheduled and sends them
+        return f"{sent} emails sent, {dropped} dropped, {requeued} requeued: {str(failure)}"
+
+    if queued_emails():
+        schedule_send(countdown=0)
+    return f"{sent} emails sent, {dropped} dropped"
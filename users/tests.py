@@ -1,3 +1,360 @@
-from django.test import TestCase
+import hashlib
+import json
+import smtplib
+import socketserver
+import threading
+from decimal import Decimal
+from email import message_from_bytes
+from unittest.mock import patch
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django_redis import get_redis_connection
+from rest_framework.test import APIClient
 
-# Create your tests here.
+from coins.models import Coin, CoinTransaction
+from users.authentication import CookieTokenAuthentication, local_tokens
+from users.models import ExpiringToken
+from users.tasks import (
+    DEAD_LETTER_KEY, MAX_ATTEMPTS, MAX_BACKOFF, PROCESSING_KEY, QUEUE_KEY, SENDING_KEY, close_mail_connection,
+    pop_emails, queue_email, queued_emails, send_queued_emails,
+)
+from users.utils import create_token_response
+from wallets.models import Wallet, WalletTransaction
+
+
+class MeViewStatsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user(email="me@example.com", password="secret123")
+        self.coin = Coin.objects.create(name="Bitcoin", symbol="BTC", slug="bitcoin")
+        self.wallet = Wallet.objects.get(user=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+        self.wallet.apply_transaction('deposit', Decimal('500'), 'fiat')
+        self.wallet.apply_transaction('withdrawal', Decimal('50'), 'fiat')
+        CoinTransaction.execute_trade(self.user, self.coin, 'buy', Decimal('2'), Decimal('100'))
+        CoinTransaction.execute_trade(self.user, self.coin, 'sell', Decimal('1'), Decimal('150'))
+
+    def get_me(self):
+        response = self.client.get(reverse('me'))
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_stats_use_one_query_per_table_and_then_the_cache(self):
+        with self.assertNumQueries(3):
+            data = self.get_me()
+
+        self.assertEqual((data['coin_purchases'], data['coin_sales'], data['held_coins']), (1, 1, 1))
+        self.assertEqual(data['wallet_fiat_deposits'], 500.0)
+        self.assertEqual(data['wallet_fiat_withdrawals'], 50.0)
+        self.assertEqual(data['wallet_total_balance'], 400.0)
+
+        with self.assertNumQueries(0):
+            self.get_me()
+
+    def test_writes_invalidate_cached_stats(self):
+        self.get_me()
+
+        CoinTransaction.execute_trade(self.user, self.coin, 'sell', Decimal('1'), Decimal('200'))
+        data = self.get_me()
+        self.assertEqual((data['coin_sales'], data['held_coins']), (2, 0))
+        self.assertEqual(data['wallet_total_balance'], 600.0)
+
+        self.wallet.transactions.filter(transaction_source='fiat', transaction_type='withdrawal').get().delete()
+        self.assertEqual(self.get_me()['wallet_total_balance'], 650.0)
+
+    def test_wallet_writes_do_not_load_the_wallet_for_invalidation(self):
+        transaction = WalletTransaction(wallet_id=self.wallet.pk, transaction_type='deposit', transaction_source='fiat', amount=Decimal('10'))
+        with CaptureQueriesContext(connection) as captured:
+            transaction.save()
+        wallet_reads = [query for query in captured if query['sql'].startswith('SELECT') and 'FROM "wallets_wallet"' in query['sql']]
+        # the row lock, the foreign key validation and the balance check in clean()
+        self.assertEqual(len(wallet_reads), 3)
+
+    def test_cache_can_be_disabled(self):
+        with self.settings(USER_STATS_CACHE_TTL=0):
+            self.get_me()
+            with self.assertNumQueries(3):
+                self.get_me()
+
+class CookieTokenCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        local_tokens.clear()
+        self.user = get_user_model().objects.create_user(email="token@example.com", password="secret123")
+        self.client = APIClient()
+        response = self.client.post(reverse('login'), {'email': 'token@example.com', 'password': 'secret123'})
+        self.assertEqual(response.status_code, 200)
+        self.key = response.cookies['auth_token'].value
+        self.auth = CookieTokenAuthentication()
+
+    def test_cached_authentication_needs_no_queries(self):
+        with self.assertNumQueries(1):
+            user, _ = self.auth.authenticate_credentials(self.key)
+        self.assertEqual(user, self.user)
+
+        with self.assertNumQueries(0):
+            self.auth.authenticate_credentials(self.key)
+
+        # another process: only Redis is warm
+        local_tokens.clear()
+        with self.assertNumQueries(0):
+            user, token = self.auth.authenticate_credentials(self.key)
+        self.assertEqual((user.email, token.key), (self.user.email, self.key))
+
+    def test_redis_holds_only_the_token_hash(self):
+        self.auth.authenticate_credentials(self.key)
+        self.assertIsNotNone(cache.get(f"auth-token:{hashlib.sha256(self.key.encode()).hexdigest()}"))
+        self.assertIsNone(cache.get(f"auth-token:{self.key}"))
+
+    def test_cached_values_hold_no_credentials(self):
+        self.auth.authenticate_credentials(self.key)
+
+        redis = get_redis_connection("default")
+        entry = redis.get(cache.make_key(f"auth-token:{hashlib.sha256(self.key.encode()).hexdigest()}"))
+        user = redis.get(cache.make_key(f"auth-user:{self.user.pk}"))
+        self.assertEqual(cache.client.decode(entry).keys(), {'user_id', 'expires_at', 'is_active'})
+        for value in (entry, user):
+            self.assertNotIn(self.key.encode(), value)
+            self.assertNotIn(self.user.password.encode(), value)
+
+        user, token = self.auth.authenticate_credentials(self.key)
+        self.assertEqual(token.key, self.key)
+        self.assertTrue(user.check_password('secret123'))
+
+    def test_deactivation_invalidates_cached_token(self):
+        self.auth.authenticate_credentials(self.key)
+
+        self.user.is_active = False
+        self.user.save()
+
+        self.assertIsNone(self.auth.authenticate_credentials(self.key))
+
+    def test_logout_revokes_token(self):
+        self.assertEqual(self.client.get(reverse('me')).status_code, 200)
+
+        self.client.post(reverse('logout'))
+
+        self.client.cookies['auth_token'] = self.key
+        self.assertEqual(self.client.get(reverse('me')).status_code, 401)
+
+    def test_renewal_invalidates_cached_expiry(self):
+        cached = self.auth.authenticate_credentials(self.key)[1]
+
+        create_token_response(self.user)
+
+        renewed = self.auth.authenticate_credentials(self.key)[1]
+        self.assertEqual(renewed.expires_at, ExpiringToken.objects.get(key=self.key).expires_at)
+        self.assertGreater(renewed.expires_at, cached.expires_at)
+
+class SMTPSink:
+    """
+    Local SMTP server that accepts every message. Queued replies answer the
+    next DATA commands instead of 250; with close_after_data the server
+    drops the connection after each message, like an idle timeout.
+    """
+    def __init__(self):
+        self.messages = []
+        self.replies = []
+        self.connections = 0
+        self.close_after_data = False
+        sink = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, text):
+                self.wfile.write(f"{text}\r\n".encode())
+
+            def handle(self):
+                sink.connections += 1
+                self.reply("220 sink ESMTP")
+                for line in self.rfile:
+                    command = line.decode().strip().upper()
+                    if command.startswith(("EHLO", "HELO")):
+                        self.reply("250 sink")
+                    elif command == "DATA":
+                        self.reply("354 End data with <CR><LF>.<CR><LF>")
+                        data = b"".join(iter(self.rfile.readline, b".\r\n"))
+                        reply = sink.replies.pop(0) if sink.replies else "250 OK"
+                        if reply.startswith("250"):
+                            sink.messages.append(message_from_bytes(data))
+                        self.reply(reply)
+                        if sink.close_after_data:
+                            return
+                    elif command == "QUIT":
+                        self.reply("221 Bye")
+                        return
+                    else:
+                        self.reply("250 OK")
+
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def subjects(self):
+        return [message["Subject"] for message in self.messages]
+
+class QueuedEmailTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.sink = SMTPSink().start()
+        self.settings = override_settings(
+            EMAIL_BACKEND="django.core.mail.backends.smtp.EmailBackend",
+            EMAIL_HOST="127.0.0.1",
+            EMAIL_PORT=self.sink.port,
+            EMAIL_USE_TLS=False,
+            EMAIL_HOST_USER="",
+            EMAIL_BATCH_SIZE=2,
+        )
+        self.settings.enable()
+
+    def tearDown(self):
+        close_mail_connection()
+        self.settings.disable()
+        self.sink.stop()
+
+    def queue(self, *subjects):
+        with patch("users.tasks.schedule_send"), self.captureOnCommitCallbacks(execute=True):
+            for subject in subjects:
+                queue_email(subject, "Hello", "noreply@example.com", ["user@example.com"])
+
+    def redis_list(self, key):
+        return [json.loads(item) for item in get_redis_connection("default").lrange(cache.make_key(key), 0, -1)]
+
+    @patch("users.tasks.schedule_send")
+    def test_messages_are_queued_on_commit(self, schedule_send):
+        with self.captureOnCommitCallbacks() as callbacks:
+            queue_email("one", "Hello", "noreply@example.com", ["user@example.com"])
+        self.assertEqual(queued_emails(), 0)
+
+        callbacks[0]()
+        self.assertEqual(queued_emails(), 1)
+        schedule_send.assert_called_once_with()
+
+    @patch("users.tasks.schedule_send")
+    def test_password_reset_is_queued_not_sent(self, schedule_send):
+        get_user_model().objects.create_user(email="reset@example.com", password="secret123")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('request-password-reset'), {'email': 'reset@example.com'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((self.sink.messages, queued_emails()), ([], 1))
+        schedule_send.assert_called_once_with()
+
+        send_queued_emails.apply()
+        self.assertEqual(self.sink.subjects(), ["Password Reset Request"])
+        self.assertIn("reset-password?uid=", self.sink.messages[0].get_payload())
+        self.assertEqual(self.sink.messages[0]["To"], "reset@example.com")
+
+    @patch("users.tasks.schedule_send")
+    def test_batches_reuse_one_connection(self, schedule_send):
+        self.queue("one", "two", "three")
+
+        self.assertEqual(send_queued_emails.apply().get(), "2 emails sent, 0 dropped")
+        # a full batch schedules the rest right away
+        schedule_send.assert_called_once_with(countdown=0)
+        send_queued_emails.apply()
+
+        self.assertEqual(self.sink.subjects(), ["one", "two", "three"])
+        self.assertEqual((self.sink.connections, queued_emails()), (1, 0))
+
+    def test_transient_failure_is_retried_in_order(self):
+        self.sink.replies = ["451 Try again later"]
+        self.queue("one", "two")
+
+        # eager retries run right away
+        send_queued_emails.apply()
+
+        self.assertEqual(self.sink.subjects(), ["one", "two"])
+        self.assertEqual(queued_emails(), 0)
+
+    @patch("users.tasks.schedule_send")
+    def test_queue_is_picked_up_again_after_the_last_retry(self, schedule_send):
+        self.sink.replies = ["451 Try again later"]
+        self.queue("one", "two")
+        schedule_send.reset_mock()
+
+        result = send_queued_emails.apply(retries=send_queued_emails.max_retries).get()
+
+        self.assertIn("0 emails sent, 0 dropped, 2 requeued", result)
+        self.assertEqual(queued_emails(), 2)
+        schedule_send.assert_called_once_with(countdown=MAX_BACKOFF)
+
+    def test_permanent_failure_is_dropped(self):
+        self.sink.replies = ["550 No such user"]
+        self.queue("one", "two")
+
+        with self.assertLogs("users.tasks", "WARNING") as logs:
+            self.assertEqual(send_queued_emails.apply().get(), "1 emails sent, 1 dropped")
+        self.assertEqual(self.sink.subjects(), ["two"])
+        self.assertIn("'one' to ['user@example.com'] dropped: (550", logs.output[0])
+
+    @patch("users.tasks.schedule_send")
+    def test_login_failure_requeues_the_batch(self, schedule_send):
+        self.queue("one", "two")
+
+        error = smtplib.SMTPAuthenticationError(535, b"Authentication failed")
+        with patch("users.tasks.get_mail_connection", side_effect=error):
+            result = send_queued_emails.apply(retries=send_queued_emails.max_retries).get()
+
+        self.assertIn("0 emails sent, 0 dropped, 2 requeued", result)
+        # not the messages' fault, no attempt is counted
+        self.assertEqual([data.get("attempts") for data in self.redis_list(QUEUE_KEY)], [None, None])
+        schedule_send.assert_called_once_with(countdown=MAX_BACKOFF)
+
+        send_queued_emails.apply()
+        self.assertEqual(self.sink.subjects(), ["one", "two"])
+
+    def test_message_is_dead_lettered_after_max_attempts(self):
+        self.sink.replies = ["451 Try again later"] * MAX_ATTEMPTS
+        self.queue("one", "two")
+
+        with self.assertLogs("users.tasks", "ERROR"):
+            send_queued_emails.apply()
+
+        self.assertEqual(self.sink.subjects(), ["two"])
+        dead = self.redis_list(DEAD_LETTER_KEY)
+        self.assertEqual([(data["subject"], data["attempts"]) for data in dead], [("one", MAX_ATTEMPTS)])
+        self.assertIn("451", dead[0]["error"])
+        self.assertEqual(queued_emails(), 0)
+
+    def test_interrupted_run_is_recovered(self):
+        self.queue("one", "two", "three")
+        # a run that took a batch and died before sending it
+        pop_emails(2)
+        self.assertEqual(queued_emails(), 1)
+
+        send_queued_emails.apply()
+        send_queued_emails.apply()
+
+        self.assertEqual(self.sink.subjects(), ["one", "two", "three"])
+        self.assertEqual(self.redis_list(PROCESSING_KEY), [])
+
+    def test_only_one_run_sends_at_a_time(self):
+        self.queue("one")
+        cache.add(SENDING_KEY, 1)
+
+        self.assertEqual(send_queued_emails.apply().get(), "another run is sending")
+        self.assertEqual(queued_emails(), 1)
+
+    def test_closed_connection_is_reopened(self):
+        self.sink.close_after_data = True
+        self.queue("one", "two")
+
+        send_queued_emails.apply()
+
+        self.assertEqual(self.sink.subjects(), ["one", "two"])
+        self.assertEqual(self.sink.connections, 2)
@@ -8,7 +8,11 @@ from django.conf import settings
 from django_ratelimit.decorators import ratelimit
 from functools import wraps
 from decimal import Decimal
-from django.db.models import Sum
+from django.core.cache import cache
+from django.db.models import Count, Q, Sum
+
+from coins.models import CoinHolding, CoinTransaction
+from wallets.models import WalletTransaction
 
 def set_auth_cookie(response, token_key, max_age):
     """
@@ -66,15 +70,56 @@ def ratelimit_response(key='ip', rate='5/m', method='POST'):
         return _wrapped_view
     return decorator
 
-def get_transaction_sum(wallet, tx_type, source=None):
+def user_stats_key(user_id) -> str:
+    return f"user-stats:{user_id}"
+
+def compute_user_stats(user) -> dict:
+    """
+    Collects the trading and wallet stats of a user with one conditional
+    aggregate per table.
+    """
+    trades = CoinTransaction.objects.filter(user=user).aggregate(
+        purchases=Count('pk', filter=Q(transaction_type='buy')),
+        sales=Count('pk', filter=Q(transaction_type='sell')),
+    )
+    held_coins = CoinHolding.objects.filter(user=user, amount__gt=0).count()
+
+    deposit, withdrawal, fiat = Q(transaction_type='deposit'), Q(transaction_type='withdrawal'), Q(transaction_source='fiat')
+    wallet = WalletTransaction.objects.filter(wallet__user=user).aggregate(
+        fiat_deposits=Sum('amount', filter=deposit & fiat),
+        fiat_withdrawals=Sum('amount', filter=withdrawal & fiat),
+        deposits=Sum('amount', filter=deposit),
+        withdrawals=Sum('amount', filter=withdrawal),
+    )
+    wallet = {name: total or Decimal('0') for name, total in wallet.items()}
+
+    return {
+        "coin_purchases": trades['purchases'],
+        "coin_sales": trades['sales'],
+        "held_coins": held_coins,
+        "wallet_fiat_deposits": wallet['fiat_deposits'],
+        "wallet_fiat_withdrawals": wallet['fiat_withdrawals'],
+        "wallet_total_balance": wallet['deposits'] - wallet['withdrawals'],
+    }
+
+def get_user_stats(user) -> dict:
+    """
+    Returns the stats of a user from the cache, computing them on a miss.
+    Transaction and holding writes invalidate the entry (see users.signals).
+    """
+    if not settings.USER_STATS_CACHE_TTL:
+        return compute_user_stats(user)
+
+    stats = cache.get(user_stats_key(user.pk))
+    if stats is None:
+        stats = compute_user_stats(user)
+        cache.set(user_stats_key(user.pk), stats, timeout=settings.USER_STATS_CACHE_TTL)
+    return stats
+
+def invalidate_user_stats(user_id):
     """
-    Returns the sum of all transactions of a given type
+    Drops the cached stats now and again after the surrounding transaction
+    commits, so a read in between cannot cache the uncommitted state.
     """
-    filters = {'transaction_type': tx_type}
-    if source:
-        filters['transaction_source'] = source
-    return (
-        wallet.transactions.filter(**filters)
-        .aggregate(total=Sum('amount'))['total']
-        or Decimal('0')
-    )
\ No newline at end of file
+    cache.delete(user_stats_key(user_id))
+    transaction.on_commit(lambda: cache.delete(user_stats_key(user_id)))
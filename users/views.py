@@ -1,63 +1,42 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from .serializer import PasswordResetConfirmSerializer, UserLoginSerializer, UserRegisterSerializer, UserUpdateSerializer, PasswordResetRequestSerializer
-from .utils import create_token_response, get_transaction_sum, ratelimit_response
+from .models import ExpiringToken
+from .utils import create_token_response, get_user_stats, ratelimit_response
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from django.utils.decorators import method_decorator
-from coins.models import CoinTransaction, CoinHolding
 from rest_framework import status
 from django.utils.http import urlsafe_base64_decode
 from django.contrib.auth.tokens import default_token_generator
 from django.contrib.auth import get_user_model
 from rest_framework import generics
 
-from decimal import Decimal
-from wallets.models import Wallet
+from config.metrics import RequestMetricsMixin
 
 User = get_user_model()
 
-class MeView(APIView):
+class MeView(RequestMetricsMixin, APIView):
     permission_classes = [IsAuthenticated]
 
     @method_decorator(ratelimit_response(rate='10/m', method='GET'))
     def get(self, request, *args, **kwargs):
         user = request.user
-
-        purchase_count = CoinTransaction.objects.filter(
-            user=user, transaction_type='buy'
-        ).count()
-        sale_count = CoinTransaction.objects.filter(
-            user=user, transaction_type='sell'
-        ).count()
-        held_coins_count = CoinHolding.objects.filter(
-            user=user, amount__gt=0
-        ).count()
-
-        wallet = Wallet.objects.filter(user=user).first()
-
-        if wallet:
-            deposits_fiat = get_transaction_sum(wallet, 'deposit', 'fiat')
-            withdrawals_fiat = get_transaction_sum(wallet, 'withdrawal', 'fiat')
-            deposits_total = get_transaction_sum(wallet, 'deposit')
-            withdrawals_total = get_transaction_sum(wallet, 'withdrawal')
-            balance_total = deposits_total - withdrawals_total
-        else:
-            deposits_fiat = withdrawals_fiat = balance_total = Decimal('0')
+        stats = get_user_stats(user)
 
         return Response({
             "id": str(user.id),
             "email": user.email,
             "username": user.username,
             "verified": user.verified,
-            "coin_purchases": purchase_count,
-            "coin_sales": sale_count,
-            "held_coins": held_coins_count,
-            "wallet_fiat_deposits": float(deposits_fiat),
-            "wallet_fiat_withdrawals": float(withdrawals_fiat),
-            "wallet_total_balance": float(balance_total),
+            "coin_purchases": stats["coin_purchases"],
+            "coin_sales": stats["coin_sales"],
+            "held_coins": stats["held_coins"],
+            "wallet_fiat_deposits": float(stats["wallet_fiat_deposits"]),
+            "wallet_fiat_withdrawals": float(stats["wallet_fiat_withdrawals"]),
+            "wallet_total_balance": float(stats["wallet_total_balance"]),
         })
 
-class MeUpdateView(APIView):
+class MeUpdateView(RequestMetricsMixin, APIView):
     permission_classes = [IsAuthenticated]
 
     def patch(self, request, *args, **kwargs):
@@ -76,9 +55,11 @@ class MeUpdateView(APIView):
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         
-class LoginView(generics.GenericAPIView):
+class LoginView(RequestMetricsMixin, generics.GenericAPIView):
     permission_classes = [AllowAny]
     serializer_class = UserLoginSerializer
+    # password hashing
+    throttle_costs = {"POST": 10}
 
     def post(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
@@ -87,19 +68,25 @@ class LoginView(generics.GenericAPIView):
 
         return create_token_response(user)
     
-class LogoutView(APIView):
+class LogoutView(RequestMetricsMixin, APIView):
     permission_classes = [IsAuthenticated]
 
     def post(self, request, *args, **kwargs):
+        # revokes the token; deleting it also drops it from the token cache
+        if isinstance(request.auth, ExpiringToken):
+            ExpiringToken.objects.filter(key=request.auth.key).delete()
+
         response = Response(status=200)
         response.delete_cookie('auth_token', path='/', domain=None)
         return response
 
-class RegisterView(generics.CreateAPIView):
+class RegisterView(RequestMetricsMixin, generics.CreateAPIView):
     permission_classes = [AllowAny]
     serializer_class = UserRegisterSerializer
+    # password hashing
+    throttle_costs = {"POST": 10}
 
-class PasswordResetRequestView(APIView):
+class PasswordResetRequestView(RequestMetricsMixin, APIView):
     permission_classes = [AllowAny]
 
     @method_decorator(ratelimit_response(rate='5/m', method='POST'))
@@ -113,8 +100,10 @@ class PasswordResetRequestView(APIView):
             )
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-class PasswordResetConfirmView(APIView):
+class PasswordResetConfirmView(RequestMetricsMixin, APIView):
     permission_classes = [AllowAny]
+    # password hashing
+    throttle_costs = {"POST": 10}
 
     def post(self, request):
         serializer = PasswordResetConfirmSerializer(data=request.data)
@@ -123,7 +112,7 @@ class PasswordResetConfirmView(APIView):
             return Response({"detail": "Password has been reset."})
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     
-class ConfirmEmailView(APIView):
+class ConfirmEmailView(RequestMetricsMixin, APIView):
     permission_classes = [AllowAny]
 
     def get(self, request):
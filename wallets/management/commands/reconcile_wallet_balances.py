@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import F
+
+from wallets.models import Wallet, ledger_sum
+
+
+class Command(BaseCommand):
+    help = "Verifies the running wallet balances against the full transaction ledger."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help="Overwrite wrong balances with the ledger sum.")
+
+    def handle(self, *args, **options):
+        wallets = (
+            Wallet.objects.annotate(ledger=ledger_sum('transactions__'))
+            .exclude(balance=F('ledger'))
+            .select_related('user')
+            .order_by('user__username')
+        )
+
+        mismatches = 0
+        for wallet in wallets.iterator():
+            mismatches += 1
+            self.stdout.write(f"{wallet}: balance {wallet.balance}, ledger {wallet.ledger}")
+
+            if options['fix']:
+                with transaction.atomic():
+                    # recomputed under the row lock, so concurrent transactions are not lost
+                    locked = Wallet.objects.select_for_update().get(pk=wallet.pk)
+                    locked.balance = locked.get_ledger_balance()
+                    locked.save(update_fields=['balance'])
+
+        if not mismatches:
+            self.stdout.write(self.style.SUCCESS("All wallet balances match the ledger."))
+        elif options['fix']:
+            self.stdout.write(self.style.SUCCESS(f"Fixed {mismatches} wallet balance(s)."))
+        else:
+            raise CommandError(f"{mismatches} wallet balance(s) do not match the ledger. Run with --fix to correct them.")
@@ -1,5 +1,6 @@
 import uuid
 from django.db import models, transaction
+from django.db.models.functions import Coalesce
 from django.core.exceptions import ValidationError
 from decimal import Decimal
 from django.conf import settings
@@ -8,25 +9,34 @@ from django.conf import settings
 class Wallet(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    # Running total of all transactions, updated together with every
+    # transaction (see WalletTransaction.save and wallets.signals)
+    balance = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal('0'), editable=False)
 
     def __str__(self):
         return f"{self.user.username}'s Wallet"
     
     @property
     def current_balance(self):
-        deposits = self.transactions.filter(transaction_type='deposit').aggregate(total=models.Sum('amount'))['total'] or Decimal('0')
-        withdrawals = self.transactions.filter(transaction_type='withdrawal').aggregate(total=models.Sum('amount'))['total'] or Decimal('0')
-        return deposits - withdrawals
+        return self.balance
+
+    def get_ledger_balance(self):
+        """
+        Sums the full transaction history, used to reconcile the running balance.
+        """
+        return self.transactions.aggregate(total=ledger_sum())['total']
 
     def apply_transaction(self, transaction_type, amount, transaction_source):
         if transaction_type not in dict(WalletTransaction.TRANSACTION_TYPES):
             raise ValueError("Invalid transaction type")
         if transaction_source not in dict(WalletTransaction.TRANSACTION_SOURCES):
             raise ValueError("Invalid transaction source")
-        if transaction_type == 'withdrawal' and self.current_balance < amount:
-            raise ValueError("Insufficient balance")
-        
+
         with transaction.atomic():
+            locked = Wallet.objects.select_for_update().only('balance').get(pk=self.pk)
+            if transaction_type == 'withdrawal' and locked.balance < amount:
+                raise ValueError("Insufficient balance")
+
             WalletTransaction.objects.create(
                 wallet=self,
                 transaction_type=transaction_type,
@@ -34,6 +44,17 @@ class Wallet(models.Model):
                 amount=amount.quantize(Decimal('0.01'))
             )
 
+def ledger_sum(prefix=''):
+    """
+    Signed sum of transaction amounts: deposits minus withdrawals.
+    prefix is the lookup path to the transactions, e.g. 'transactions__'.
+    """
+    signed = models.Case(
+        models.When(**{f'{prefix}transaction_type': 'withdrawal'}, then=-models.F(f'{prefix}amount')),
+        default=models.F(f'{prefix}amount'),
+    )
+    return Coalesce(models.Sum(signed), Decimal('0'), output_field=models.DecimalField(max_digits=14, decimal_places=2))
+
 class WalletTransaction(models.Model):
     TRANSACTION_TYPES = [
         ('deposit', 'Deposit'),
@@ -55,29 +76,57 @@ class WalletTransaction(models.Model):
     class Meta:
         verbose_name = "Transaction"
         verbose_name_plural = "Transactions"
+        indexes = [
+            # keyset pagination of a wallet's history, overall and per source
+            models.Index(fields=['wallet', '-created_at', '-id'], name='wallet_tx_created_idx'),
+            models.Index(fields=['wallet', 'transaction_source', '-created_at', '-id'], name='wallet_tx_source_created_idx'),
+            # sums per type and source; amount is a trailing key column, so the
+            # sums are answered from the index alone on every backend
+            models.Index(fields=['wallet', 'transaction_type', 'transaction_source', 'amount'], name='wallet_tx_type_source_idx'),
+        ]
     
     def __str__(self):
         return f"{self.wallet.user.username} {self.transaction_type} {self.amount}"
 
+    @property
+    def signed_amount(self):
+        return -self.amount if self.transaction_type == 'withdrawal' else self.amount
+
+    def get_stored(self):
+        """
+        Returns the saved version of this transaction, or None if it is new.
+        """
+        if self._state.adding:
+            return None
+        return WalletTransaction.objects.filter(pk=self.pk).only('wallet', 'transaction_type', 'amount').first()
+
     def clean(self):
         if self.amount <= 0:
             raise ValidationError({'amount': "Amount must be greater than zero."})
 
-        transactions = WalletTransaction.objects.filter(wallet=self.wallet)
-        if self.pk:
-            transactions = transactions.exclude(pk=self.pk)
+        balance = Wallet.objects.filter(pk=self.wallet_id).values_list('balance', flat=True).first() or Decimal('0')
+        stored = self.get_stored()
+        if stored and stored.wallet_id == self.wallet_id:
+            balance -= stored.signed_amount
 
-        deposits = transactions.filter(transaction_type='deposit').aggregate(total=models.Sum('amount'))['total'] or Decimal('0')
-        withdrawals = transactions.filter(transaction_type='withdrawal').aggregate(total=models.Sum('amount'))['total'] or Decimal('0')
-
-        if self.transaction_type == 'deposit':
-            deposits += self.amount
-        else:
-            withdrawals += self.amount
-
-        if deposits - withdrawals < 0:
+        if balance + self.signed_amount < 0:
             raise ValidationError({'amount': "Insufficient funds after this transaction."})
-        
+
     def save(self, *args, **kwargs):
-        self.full_clean()
-        super().save(*args, **kwargs)
\ No newline at end of file
+        with transaction.atomic():
+            # the wallet row lock serializes all balance changes of a wallet
+            wallet = Wallet.objects.select_for_update().get(pk=self.wallet_id)
+            if not WalletTransaction.wallet.is_cached(self):
+                # post_save receivers read the locked row instead of loading it again
+                WalletTransaction.wallet.field.set_cached_value(self, wallet)
+            stored = self.get_stored()
+            self.full_clean()
+            super().save(*args, **kwargs)
+
+            if stored:
+                Wallet.objects.filter(pk=stored.wallet_id).update(balance=models.F('balance') - stored.signed_amount)
+            Wallet.objects.filter(pk=self.wallet_id).update(balance=models.F('balance') + self.signed_amount)
+
+            if WalletTransaction.wallet.is_cached(self):
+                moved = stored is None or stored.wallet_id != self.wallet_id
+                self.wallet.balance = wallet.balance + self.signed_amount - (0 if moved else stored.signed_amount)
\ No newline at end of file
@@ -1,6 +1,7 @@
-from django.db.models.signals import post_save
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
-from wallets.models import Wallet
+from wallets.models import Wallet, WalletTransaction
 from django.contrib.auth import get_user_model
 
 User = get_user_model()
@@ -8,4 +9,12 @@ User = get_user_model()
 @receiver(post_save, sender=User)
 def create_wallet(sender, instance, created, **kwargs):
     if created:
-        Wallet.objects.get_or_create(user=instance)
\ No newline at end of file
+        Wallet.objects.get_or_create(user=instance)
+
+@receiver(post_delete, sender=WalletTransaction)
+def revert_wallet_balance(sender, instance, **kwargs):
+    """
+    Removes a deleted transaction from the wallet's running balance.
+    Also runs for queryset deletes.
+    """
+    Wallet.objects.filter(pk=instance.wallet_id).update(balance=F('balance') - instance.signed_amount)
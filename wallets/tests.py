@@ -1,3 +1,141 @@
+import json
+from decimal import Decimal
+from io import StringIO
+from unittest.mock import patch
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
+from django.core.management import CommandError, call_command
 from django.test import TestCase
+from django.urls import reverse
+from rest_framework.test import APIClient
 
-# Create your tests here.
+from config.pagination import KeysetPagination
+from config.testing import QueryPlanAssertionsMixin
+from wallets.models import Wallet, WalletTransaction
+
+
+class WalletBalanceTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(email="wallet@example.com", password="secret123")
+        self.wallet = Wallet.objects.get(user=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def add(self, transaction_type, amount):
+        return WalletTransaction.objects.create(
+            wallet=self.wallet, transaction_type=transaction_type,
+            transaction_source='fiat', amount=Decimal(amount),
+        )
+
+    def stored_balance(self):
+        return Wallet.objects.get(pk=self.wallet.pk).balance
+
+    def test_balance_follows_transactions(self):
+        self.add('deposit', '100.00')
+        withdrawal = self.add('withdrawal', '30.50')
+        self.assertEqual(self.stored_balance(), Decimal('69.50'))
+        self.assertEqual(self.wallet.balance, Decimal('69.50'))
+
+        withdrawal.amount = Decimal('40.00')
+        withdrawal.save()
+        self.assertEqual(self.stored_balance(), Decimal('60.00'))
+
+        withdrawal.delete()
+        self.assertEqual(self.stored_balance(), Decimal('100.00'))
+        self.assertEqual(self.stored_balance(), self.wallet.get_ledger_balance())
+
+    def test_overdraft_is_rejected(self):
+        self.add('deposit', '10.00')
+        with self.assertRaises(ValidationError):
+            self.add('withdrawal', '10.01')
+        with self.assertRaises(ValueError):
+            self.wallet.apply_transaction('withdrawal', Decimal('11'), 'fiat')
+        self.assertEqual(self.stored_balance(), Decimal('10.00'))
+
+    def test_balance_read_does_not_aggregate(self):
+        for _ in range(20):
+            self.add('deposit', '5.00')
+
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('my-wallet'))
+        self.assertEqual(response.data['balance'], 100.0)
+
+    def test_withdraw_view_returns_new_balance(self):
+        self.add('deposit', '50.00')
+        response = self.client.post(reverse('my-wallet-withdraw'), {'amount': '20', 'transaction_source': 'fiat'})
+        self.assertEqual(response.data['balance'], Decimal('30.00'))
+
+    def test_reconcile_command(self):
+        self.add('deposit', '25.00')
+        call_command('reconcile_wallet_balances', stdout=StringIO())
+
+        Wallet.objects.filter(pk=self.wallet.pk).update(balance=Decimal('1.00'))
+        with self.assertRaises(CommandError):
+            call_command('reconcile_wallet_balances', stdout=StringIO())
+
+        call_command('reconcile_wallet_balances', '--fix', stdout=StringIO())
+        self.assertEqual(self.stored_balance(), Decimal('25.00'))
+
+class WalletTransactionHistoryTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(email="history@example.com", password="secret123")
+        self.wallet = Wallet.objects.get(user=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        for amount in range(1, 8):
+            self.wallet.apply_transaction('deposit', Decimal(amount), 'fiat' if amount % 2 else 'coin')
+
+    def test_cursor_pages_cover_history_once(self):
+        url, amounts = reverse('my-wallet-transactions'), []
+        params = {'page_size': 3}
+        while url:
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(response.data['results']), 3)
+            amounts += [row['amount'] for row in response.data['results']]
+            url, params = response.data['next'], None
+
+        self.assertEqual(amounts, [f"{amount}.00" for amount in range(7, 0, -1)])
+
+    def test_history_is_paginated_by_default(self):
+        with patch.object(KeysetPagination, 'page_size', 3):
+            response = self.client.get(reverse('my-wallet-transactions'))
+        self.assertEqual([row['amount'] for row in response.data['results']], ['7.00', '6.00', '5.00'])
+        self.assertIsNotNone(response.data['next'])
+
+    def test_unpaginated_response_needs_opt_in(self):
+        response = self.client.get(reverse('my-wallet-transactions', args=['coin']), {'paginate': 'false'})
+        self.assertEqual([row['amount'] for row in response.data], ['6.00', '4.00', '2.00'])
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('my-wallet-transactions'), {'cursor': 'bm9wZQ'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_ndjson_export_streams_all_rows(self):
+        response = self.client.get(reverse('my-wallet-transactions'), {'export': 'ndjson'})
+
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual(len(rows), 7)
+        self.assertEqual(rows[0]['amount'], '7.00')
+
+class WalletQueryPlanTests(QueryPlanAssertionsMixin, TestCase):
+    """
+    Regression tests for the indexes of the hot per-wallet queries.
+    """
+    def setUp(self):
+        user = get_user_model().objects.create_user(email="plans@example.com", password="secret123")
+        self.wallet = Wallet.objects.get(user=user)
+
+    def test_history_uses_created_index(self):
+        queryset = self.wallet.transactions.order_by('-created_at', '-id')
+        self.assertUsesIndex(queryset, 'wallet_tx_created_idx')
+
+    def test_source_history_uses_source_created_index(self):
+        queryset = self.wallet.transactions.filter(transaction_source='coin').order_by('-created_at', '-id')
+        self.assertUsesIndex(queryset, 'wallet_tx_source_created_idx')
+
+    def test_sums_use_type_source_index(self):
+        queryset = self.wallet.transactions.filter(transaction_type='deposit', transaction_source='fiat')
+        self.assertUsesIndex(queryset.values('amount'), 'wallet_tx_type_source_idx')
@@ -3,10 +3,21 @@ from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework import status
 from decimal import Decimal
+from django.db import OperationalError
 
+from config.pagination import TransactionHistoryMixin
+from config.metrics import RequestMetricsMixin
 from wallets.serializer import WalletTransactionSerializer
 from .models import Wallet, WalletTransaction
 
+def wallet_busy_response():
+    """
+    The wallet stayed locked by other writes past the database timeout.
+    """
+    response = Response({'detail': 'Wallet is busy, please retry.'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    response['Retry-After'] = '1'
+    return response
+
 class WalletMixin:
     def get_wallet(self, request):
         try:
@@ -29,7 +40,7 @@ class WalletMixin:
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-class WalletTransactionsView(WalletMixin, APIView):
+class WalletTransactionsView(RequestMetricsMixin, WalletMixin, TransactionHistoryMixin, APIView):
     permission_classes = [IsAuthenticated]
 
     TRANSACTION_SOURCES = {
@@ -42,14 +53,13 @@ class WalletTransactionsView(WalletMixin, APIView):
         if not wallet:
             return self.wallet_not_found_response()
 
-        transactions = wallet.transactions.order_by('-created_at')
+        transactions = wallet.transactions.all()
         if source and source.lower() in self.TRANSACTION_SOURCES:
             transactions = transactions.filter(transaction_source=source.lower())
 
-        serializer = WalletTransactionSerializer(transactions, many=True)
-        return Response(serializer.data)
+        return self.list_response(request, transactions, WalletTransactionSerializer)
     
-class MyWalletView(WalletMixin, APIView):
+class MyWalletView(RequestMetricsMixin, WalletMixin, APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request, *args, **kwargs):
@@ -60,7 +70,7 @@ class MyWalletView(WalletMixin, APIView):
         data = {'id': str(wallet.id), 'balance': float(wallet.current_balance)}
         return Response(data, status=status.HTTP_200_OK)
 
-class DepositWalletView(WalletMixin, APIView):
+class DepositWalletView(RequestMetricsMixin, WalletMixin, APIView):
     permission_classes = [IsAuthenticated]
 
     def post(self, request, *args, **kwargs):
@@ -78,6 +88,8 @@ class DepositWalletView(WalletMixin, APIView):
 
         try:
             wallet.apply_transaction('deposit', amount, transaction_source)
+        except OperationalError:
+            return wallet_busy_response()
         except Exception as e:
             return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
@@ -87,7 +99,7 @@ class DepositWalletView(WalletMixin, APIView):
             'type': 'deposit'
         }, status=status.HTTP_200_OK)
     
-class WithdrawWalletView(WalletMixin, APIView):
+class WithdrawWalletView(RequestMetricsMixin, WalletMixin, APIView):
     permission_classes = [IsAuthenticated]
 
     def post(self, request, *args, **kwargs):
@@ -105,6 +117,8 @@ class WithdrawWalletView(WalletMixin, APIView):
 
         try:
             wallet.apply_transaction('withdrawal', amount, transaction_source)
+        except OperationalError:
+            return wallet_busy_response()
         except ValueError as e:
             return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 